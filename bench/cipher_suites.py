@@ -0,0 +1,79 @@
+# cipher_suites.py
+
+"""
+Benchmark: bytes on the wire and encrypt/decrypt throughput per cipher suite
+
+"legacy" is the original path: a Fernet token base64 encoded again and sent
+as a JSON line. Every other row is a suite/wire-format combination.
+
+    python bench/cipher_suites.py [--sizes 16,256,4096,65536]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'client')))
+
+from crypto_utils import CryptoUtils, SUPPORTED_SUITES
+from shared.protocol import Frame, SUITE_FERNET, WIRE_BINARY, WIRE_JSON
+
+
+def wire_size(ciphertext, suite, wire):
+    """Size of the relayed chat frame carrying this ciphertext"""
+    message = {"type": "message", "sender": "bench", "message": ciphertext, "encrypted": True}
+    if suite != SUITE_FERNET:
+        message["suite"] = suite
+    return len(Frame(message).encode(wire))
+
+
+def throughput(func, arg, min_time=0.3):
+    """Operations per second of func(arg)"""
+    iterations = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        for _ in range(100):
+            func(arg)
+        iterations += 100
+        elapsed = time.perf_counter() - start
+    return iterations / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='16,256,4096,65536', help='comma separated plaintext sizes')
+    args = parser.parse_args()
+
+    crypto = CryptoUtils()
+    crypto.generate_symmetric_key()
+
+    print(f"{'size':>6} {'path':<28} {'wire bytes':>10} {'ratio':>6} {'enc MB/s':>9} {'dec MB/s':>9}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        plaintext = os.urandom(size // 2).hex().encode()[:size]
+
+        rows = []
+        token = crypto.encrypt_message(plaintext)
+        rows.append((
+            "legacy fernet+b64 / json",
+            len(Frame({"type": "message", "sender": "bench", "message": token, "encrypted": True}).encode(WIRE_JSON)),
+            throughput(crypto.encrypt_message, plaintext),
+            throughput(crypto.decrypt_message, token),
+        ))
+        for suite in SUPPORTED_SUITES:
+            ciphertext = crypto.encrypt_bytes(plaintext, suite)
+            encrypt_rate = throughput(lambda p: crypto.encrypt_bytes(p, suite), plaintext)
+            decrypt_rate = throughput(lambda c: crypto.decrypt_message(c, suite), ciphertext)
+            for wire in (WIRE_JSON, WIRE_BINARY):
+                rows.append((f"{suite} / {wire}", wire_size(ciphertext, suite, wire), encrypt_rate, decrypt_rate))
+
+        for label, nbytes, encrypt_rate, decrypt_rate in rows:
+            print(f"{size:>6} {label:<28} {nbytes:>10} {nbytes / size:>5.2f}x "
+                  f"{encrypt_rate * size / 1e6:>9.1f} {decrypt_rate * size / 1e6:>9.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# compression.py
+
+"""
+Benchmark: wire bytes and CPU time of compress-then-encrypt per message kind
+
+Each workload is encrypted with the client's default suite, once as is and
+once per compression, and relayed in the binary wire format. CPU time is
+per message, for compress+encrypt on the sender and decrypt+decompress on
+every receiver.
+
+    python bench/compression.py [--threshold 256]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'client')))
+
+from compressor import Compressor, available_compressions, DEFAULT_COMPRESS_THRESHOLD
+from crypto_utils import CryptoUtils, SUPPORTED_SUITES
+from shared.protocol import Frame, WIRE_BINARY, WIRE_JSON
+
+
+def workloads():
+    """Message kinds seen in the chat, from tiny to pasted blobs"""
+    log = "".join(
+        f"2024-05-01T10:{i // 60:02d}:{i % 60:02d}.{i * 37 % 1000:03d}Z INFO worker-{i % 4} "
+        f"GET /api/v1/users/{1000 + i * 7} 200 {i * 13 % 97}ms\n"
+        for i in range(60)
+    )
+    blob = json.dumps([
+        {"id": i, "name": f"user{i}", "email": f"user{i}@example.com", "status": "active",
+         "created_at": f"2024-01-{i % 28 + 1:02d}T00:00:00Z", "tags": ["a", "b"]}
+        for i in range(25)
+    ], indent=2)
+    return [
+        ("chat line", "sounds good, see you at 3"),
+        ("paragraph", "The deploy went out at noon and the error rate stayed flat, "
+                      "so I am going to leave the flag on overnight and check again tomorrow. " * 2),
+        ("pasted log", log),
+        ("json blob", blob),
+        ("random hex", os.urandom(1024).hex()),
+    ]
+
+
+def per_message(func, arg, min_time=0.2):
+    """Seconds per call of func(arg)"""
+    iterations = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        for _ in range(50):
+            func(arg)
+        iterations += 50
+        elapsed = time.perf_counter() - start
+    return elapsed / iterations
+
+
+def wire_size(ciphertext, suite, compression, wire):
+    message = {"type": "message", "sender": "bench", "message": ciphertext, "encrypted": True, "suite": suite}
+    if compression:
+        message["compression"] = compression
+    return len(Frame(message).encode(wire))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threshold', type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help='messages shorter than this are not compressed')
+    args = parser.parse_args()
+
+    crypto = CryptoUtils()
+    crypto.generate_symmetric_key()
+    suite = SUPPORTED_SUITES[0]
+    variants = [("none", None, None), ("zlib", "zlib", Compressor(dictionary=b""))]
+    variants += [(f"{c}+dict", c, Compressor()) for c in available_compressions()]
+
+    print(f"suite {suite}, threshold {args.threshold} bytes\n")
+    print(f"{'message':<11} {'plain':>6} {'variant':<10} {'binary':>7} {'json':>7} {'saved':>6} "
+          f"{'send us':>8} {'recv us':>8}")
+    for label, text in workloads():
+        plaintext = text.encode()
+        baseline = None
+        for name, compression, compressor in variants:
+            def send(data):
+                if compression and len(data) >= args.threshold:
+                    compressed = compressor.compress(data, compression)
+                    if len(compressed) < len(data):
+                        return crypto.encrypt_bytes(compressed, suite), compression
+                return crypto.encrypt_bytes(data, suite), None
+
+            def receive(sent):
+                data = crypto.decrypt_bytes(sent[0], suite)
+                return compressor.decompress(data, sent[1]) if sent[1] else data
+
+            sent = send(plaintext)
+            assert receive(sent) == plaintext
+            binary = wire_size(sent[0], suite, sent[1], WIRE_BINARY)
+            baseline = baseline or binary
+            print(f"{label:<11} {len(plaintext):>6} {name:<10} {binary:>7} "
+                  f"{wire_size(sent[0], suite, sent[1], WIRE_JSON):>7} {1 - binary / baseline:>6.0%} "
+                  f"{per_message(send, plaintext) * 1e6:>8.1f} {per_message(receive, sent) * 1e6:>8.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
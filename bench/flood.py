@@ -0,0 +1,196 @@
+# flood.py
+
+"""
+Benchmark: latency of a quiet sender's messages while other users flood the room
+
+Starts a server in its own process (as loadgen.py does) and connects
+--flooders sessions that send --flood messages between them back to
+back, a talker
+that sends one message every --interval, and a reader with a small
+receive window that only handles --read-rate events per second, so its
+outbound queue on the server fills up. Reports how long each sender's
+messages took to reach the reader, and how long the reader waited for
+the key of each of --joins rooms it joined mid-flood, along with the
+server's chat_control_wait_seconds for key_exchange. Runs once with the
+server's rate limit off (fair scheduling and priority lanes alone) and
+once with it on.
+
+    python bench/flood.py --flood 5000 --flooders 4 --read-rate 1000 --talk 20 --joins 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from loadgen import ENGINES, SERVER_PASSWORD, run_server, free_port, wait_for_port, percentiles
+from async_client import AsyncChatClient, EVENT_MESSAGE, EVENT_READY
+from crypto_utils import generate_private_key
+from rate_limit import DEFAULT_RATE_LIMIT
+
+FLOOD_BATCH = 100  # Messages per send_many() from a flooder
+READ_BATCH = 10  # Events the reader takes between sleeps
+DRAIN_TIMEOUT = 60.0
+READER_RECEIVE_BUFFER = 16 * 1024
+
+# Small kernel buffers and writes keep the reader's backlog in the server's
+# fair queue; no handshake workers or ping deadlines to keep it one process
+SERVER_OPTIONS = {"handshake_workers": 0, "ping_interval": None, "send_buffer": 32 * 1024, "flush_bytes": 16 * 1024}
+
+
+def stamped(padding):
+    return json.dumps({"sent": time.perf_counter(), "pad": padding})
+
+
+async def read_slowly(session, read_rate, latencies, joins):
+    """Record per-sender latency and room key waits, taking read_rate events per second"""
+    handled = 0
+    async for event in session:
+        if event.type == EVENT_MESSAGE and not event.encrypted:
+            latencies.setdefault(event.sender, []).append(time.perf_counter() - json.loads(event.message)["sent"])
+        elif event.type == EVENT_READY and event.room in joins.asked:
+            joins.waits[event.room] = time.perf_counter() - joins.asked[event.room]
+        handled += 1
+        if handled % READ_BATCH == 0:
+            await asyncio.sleep(READ_BATCH / read_rate)
+
+
+async def flood(session, count, padding):
+    for first in range(0, count, FLOOD_BATCH):
+        await session.send_many([stamped(padding) for _ in range(min(FLOOD_BATCH, count - first))])
+
+
+async def talk(session, count, interval, padding):
+    for _ in range(count):
+        await session.send(stamped(padding))
+        await asyncio.sleep(interval)
+
+
+class Joins:
+    """When the reader asked to join each room, and how long its key took"""
+
+    def __init__(self):
+        self.asked = {}
+        self.waits = {}
+
+
+async def join_rooms(session, count, interval, joins):
+    for i in range(count):
+        await asyncio.sleep(interval)
+        room = f"side{i}"
+        joins.asked[room] = time.perf_counter()
+        await session.join_room(room)
+
+
+async def measure(args, port):
+    key = generate_private_key()
+    reader = AsyncChatClient(private_key=key, max_events=64)
+    talker = AsyncChatClient(private_key=key, max_events=0)
+    flooders = [AsyncChatClient(private_key=key, max_events=0) for _ in range(args.flooders)]
+    await reader.connect('localhost', port, "reader", SERVER_PASSWORD)
+    # A small receive window makes the reader behave like a client on a slow link
+    reader.writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, READER_RECEIVE_BUFFER)
+    await talker.connect('localhost', port, "talker", SERVER_PASSWORD)
+    for i, flooder in enumerate(flooders):
+        await flooder.connect('localhost', port, f"flooder{i}", SERVER_PASSWORD)
+
+    latencies = {}
+    joins = Joins()
+    consumer = asyncio.ensure_future(read_slowly(reader, args.read_rate, latencies, joins))
+    padding = "x" * args.size
+    started = time.perf_counter()
+    await asyncio.gather(*(flood(flooder, args.flood // args.flooders, padding) for flooder in flooders),
+                         talk(talker, args.talk, args.interval, padding),
+                         join_rooms(reader, args.joins, args.talk * args.interval / (args.joins + 1), joins))
+
+    # Wait for the talker's last message and every room key; flood frames may still be queued or dropped
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while ((len(latencies.get("talker", ())) < args.talk or len(joins.waits) < args.joins)
+           and time.perf_counter() < deadline):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    for session in flooders + [talker, reader]:
+        await session.close()
+    await consumer
+
+    results = {"seconds": elapsed}
+    talked = latencies.pop("talker", [])
+    flooded = [latency for samples in latencies.values() for latency in samples]
+    results["talker"] = {"sent": args.talk, "received": len(talked), **percentiles(talked)}
+    results["flooders"] = {"sent": args.flood // args.flooders * args.flooders, "received": len(flooded),
+                           **percentiles(flooded)}
+    results["room_key"] = {"joins": args.joins, "received": len(joins.waits), **percentiles(list(joins.waits.values()))}
+    return results
+
+
+def mean_wait_ms(metrics_port, frame_type):
+    """Mean chat_control_wait_seconds of one frame type, scraped from the server"""
+    with urllib.request.urlopen(f"http://localhost:{metrics_port}/metrics", timeout=5) as response:
+        text = response.read().decode()
+    series = {}
+    for line in text.splitlines():
+        name, _, value = line.rpartition(' ')
+        if name in (f'chat_control_wait_seconds_sum{{type="{frame_type}"}}',
+                    f'chat_control_wait_seconds_count{{type="{frame_type}"}}'):
+            series[name.split('{')[0].rsplit('_', 1)[1]] = float(value)
+    if not series.get("count"):
+        return None
+    return series["sum"] / series["count"] * 1e3
+
+
+def run(args, rate_limit):
+    port = free_port()
+    metrics_port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--engine', args.engine,
+               '--rate-limit', str(rate_limit or 0), '--metrics-port', str(metrics_port)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = asyncio.run(measure(args, port))
+        results["room_key"]["server_wait_mean_ms"] = mean_wait_ms(metrics_port, "key_exchange")
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--flood', type=int, default=5000, help='messages the flooders send in all')
+    parser.add_argument('--flooders', type=int, default=4, help='users flooding the room')
+    parser.add_argument('--talk', type=int, default=20, help='messages the talker sends')
+    parser.add_argument('--joins', type=int, default=5, help='rooms the reader joins during the flood')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between the talker\'s messages')
+    parser.add_argument('--read-rate', type=float, default=1000, help='events per second the reader handles')
+    parser.add_argument('--size', type=int, default=128, help='plaintext bytes per message')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help='server messages per second per user for the limited run')
+    parser.add_argument('--engine', choices=ENGINES, default="threads")
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.engine, args.serve, dict(SERVER_OPTIONS, rate_limit=args.rate_limit or None,
+                                                 metrics_port=args.metrics_port))
+        return
+
+    results = {
+        "engine": args.engine,
+        "unlimited": run(args, None),
+        "rate_limited": run(args, args.rate_limit),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
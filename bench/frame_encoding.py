@@ -0,0 +1,81 @@
+# frame_encoding.py
+
+"""
+Micro-benchmark: per-message fan-out cost as the room grows
+
+Compares the old path (json.dumps once, then newline check, concatenation
+and UTF-8 encode for every recipient) with a shared pre-encoded Frame.
+Sockets are replaced by a sink that just keeps a reference to the payload,
+so only serialization and encoding work is measured.
+
+    python bench/frame_encoding.py [--sizes 10,100,1000,10000]
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from shared.protocol import Frame
+
+
+class SinkSocket:
+    def __init__(self):
+        self.last = None
+
+    def sendall(self, data):
+        self.last = data
+
+
+def legacy_fanout(message, sockets):
+    """The pre-Frame path from UserManager.broadcast"""
+    chat_msg = json.dumps(message)
+    for sock in sockets:
+        if not chat_msg.endswith('\n'):
+            message_to_send = chat_msg + '\n'
+        else:
+            message_to_send = chat_msg
+        sock.sendall(message_to_send.encode())
+
+
+def frame_fanout(message, sockets):
+    frame = Frame(message)
+    for sock in sockets:
+        sock.sendall(frame.encode())
+
+
+def measure(fanout, message, sockets, min_time=0.2):
+    """Return average seconds per broadcast"""
+    iterations = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        fanout(message, sockets)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='comma separated room sizes')
+    parser.add_argument('--payload', type=int, default=256, help='plaintext size in bytes')
+    args = parser.parse_args()
+
+    ciphertext = base64.b64encode(os.urandom(args.payload * 2)).decode()
+    message = {"type": "message", "sender": "bench", "message": ciphertext, "encrypted": True}
+
+    print(f"{'room':>8} {'legacy us/msg':>14} {'frame us/msg':>13} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        sockets = [SinkSocket() for _ in range(size)]
+        legacy = measure(legacy_fanout, message, sockets)
+        frame = measure(frame_fanout, message, sockets)
+        print(f"{size:>8} {legacy * 1e6:>14.1f} {frame * 1e6:>13.1f} {legacy / frame:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
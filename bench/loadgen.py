@@ -0,0 +1,284 @@
+# loadgen.py
+
+"""
+Load generator: many headless clients against a local chat server
+
+Starts a ChatServer (or AsyncChatServer) in its own process on a free
+localhost port, connects --clients AsyncChatClient sessions, all on one
+event loop, through the real handshake (RSA key exchange included) and
+has them send encrypted messages at a combined --rate. Every message carries its send time inside the
+ciphertext, so each receiver measures end-to-end latency after
+decrypting. Reports handshake rate and latency, message latency
+percentiles, throughput, and the server's CPU and RSS, as JSON.
+
+    python bench/loadgen.py --clients 50 --rate 500 --size 128 --duration 10 --output run.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from async_client import AsyncChatClient, EVENT_MESSAGE
+from crypto_utils import generate_private_key
+from shared.protocol import WIRE_FORMATS
+
+ENGINES = ("threads", "asyncio")
+SERVER_PASSWORD = "secret123"
+SAMPLE_INTERVAL = 0.5
+
+
+def run_server(engine, port, options):
+    """Entry point of the server process (loadgen.py --serve PORT)"""
+    from log import configure_logging
+    if engine == "asyncio":
+        from async_server import AsyncChatServer as Server
+    else:
+        from server import ChatServer as Server
+    configure_logging()
+    server = Server('localhost', port, **options)
+    # terminate() then shuts down the key wrapping pool instead of orphaning it
+    server.stop_on_sigterm()
+    server.server_password = SERVER_PASSWORD
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass  # start() has already stopped the server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+def process_usage(pid):
+    """CPU seconds and RSS bytes of a process and its children, or None off Linux"""
+    if not os.path.exists(f"/proc/{pid}/stat"):
+        return None
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    cpu = 0.0
+    rss = 0
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Selected percentiles of samples in milliseconds"""
+    if not samples:
+        return {f"p{p}_ms": None for p in points}
+    ordered = sorted(samples)
+    result = {f"p{p}_ms": ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1e3 for p in points}
+    result["max_ms"] = ordered[-1] * 1e3
+    return result
+
+
+class LoadClient:
+    """Headless AsyncChatClient session that records end-to-end latency"""
+
+    def __init__(self, name, private_key, wire_formats, latencies):
+        self.name = name
+        self.session = AsyncChatClient(private_key=private_key, max_events=None)
+        self.session.wire_formats = wire_formats
+        self.latencies = latencies  # Shared list every receiver appends to
+        self.received = 0
+        self.consumer = None
+
+    async def connect(self, port, timeout):
+        """Connect and wait for the room key; returns the handshake time in seconds"""
+        start = time.perf_counter()
+        await self.session.connect('localhost', port, self.name, SERVER_PASSWORD, timeout)
+        elapsed = time.perf_counter() - start
+        self.consumer = asyncio.ensure_future(self._receive())
+        return elapsed
+
+    async def send(self, padding):
+        """Send one encrypted message stamped with the current time"""
+        await self.session.send(json.dumps({"sent": time.perf_counter(), "pad": padding}))
+
+    async def close(self):
+        await self.session.close()
+        if self.consumer:
+            await self.consumer
+
+    async def _receive(self):
+        async for event in self.session:
+            if event.type == EVENT_MESSAGE and not event.encrypted:
+                self.latencies.append(time.perf_counter() - json.loads(event.message)["sent"])
+                self.received += 1
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run_load(args, port, server_pid):
+    """Connect the clients, send at the target rate and collect the results"""
+    # Key generation is client-side cost; keep it out of the handshake numbers
+    if args.shared_key:
+        keys = [generate_private_key()] * args.clients
+    else:
+        keys = [generate_private_key() for _ in range(args.clients)]
+    wire_formats = [args.wire] if args.wire else list(WIRE_FORMATS)
+    latencies = []
+    clients = [LoadClient(f"load{i}", keys[i], wire_formats, latencies) for i in range(args.clients)]
+    connecting = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with connecting:
+            return await client.connect(port, 60.0)
+
+    try:
+        usage_start = process_usage(server_pid)
+        start = time.perf_counter()
+        handshake_times = await asyncio.gather(*(connect(client) for client in clients))
+        handshake_elapsed = time.perf_counter() - start
+        usage_connected = process_usage(server_pid)
+
+        # Every message reaches every other client plus the sender's own echo
+        padding = "x" * max(0, args.size - 40)
+        count = int(args.rate * args.duration)
+        peak_rss = usage_connected[1] if usage_connected else None
+        next_sample = time.perf_counter() + SAMPLE_INTERVAL
+        start = time.perf_counter()
+        for i in range(count):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await clients[i % len(clients)].send(padding)
+            if peak_rss is not None and time.perf_counter() >= next_sample:
+                next_sample += SAMPLE_INTERVAL
+                peak_rss = max(peak_rss, process_usage(server_pid)[1])
+        send_elapsed = time.perf_counter() - start
+
+        # Let deliveries in flight land
+        expected = count * len(clients)
+        deadline = time.perf_counter() + 10.0
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        drain_elapsed = time.perf_counter() - start
+        usage_end = process_usage(server_pid)
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+
+    results = {
+        "config": vars(args),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "handshakes": {
+            "count": len(clients),
+            "elapsed_s": handshake_elapsed,
+            "per_second": len(clients) / handshake_elapsed,
+            **percentiles(handshake_times),
+        },
+        "messages": {
+            "sent": count,
+            "send_rate": count / send_elapsed if send_elapsed else None,
+            "deliveries_expected": expected,
+            "deliveries": len(latencies),
+            "deliveries_per_second": len(latencies) / drain_elapsed if drain_elapsed else None,
+            "bytes_received": sum(client.session.bytes_received for client in clients),
+        },
+        "latency": percentiles(latencies),
+        "server": None,
+    }
+    if usage_end:
+        results["server"] = {
+            "handshake_cpu_s": usage_connected[0] - usage_start[0],
+            "messaging_cpu_s": usage_end[0] - usage_connected[0],
+            "messaging_cpu_percent": (usage_end[0] - usage_connected[0]) / drain_elapsed * 100,
+            "rss_mb_connected": usage_connected[1] / 2**20,
+            "rss_mb_peak": max(peak_rss, usage_end[1]) / 2**20,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=200, help='messages per second across all clients')
+    parser.add_argument('--size', type=int, default=128, help='plaintext bytes per message')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--engine', choices=ENGINES, default="threads")
+    parser.add_argument('--wire', choices=WIRE_FORMATS, help='only offer this wire format')
+    parser.add_argument('--handshake-workers', type=int, help='server RSA pool size (default one per core)')
+    parser.add_argument('--connect-concurrency', type=int, default=16, help='handshakes in flight at once')
+    parser.add_argument('--shared-key', action='store_true',
+                        help='use one RSA key pair for every client (exercises the wrapped key cache)')
+    parser.add_argument('--output', help='write the JSON results to this file as well')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    options = {"rate_limit": None}  # Measure the pipeline, not the per-user limit
+    if args.handshake_workers is not None:
+        options["handshake_workers"] = args.handshake_workers
+    if args.serve:
+        run_server(args.engine, args.serve, options)
+        return
+
+    # Keep anything the server prints out of the JSON on stdout
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--engine', args.engine]
+    if args.handshake_workers is not None:
+        command += ['--handshake-workers', str(args.handshake_workers)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = asyncio.run(run_load(args, port, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# resumption.py
+
+"""
+Benchmark: reconnect time with a full handshake vs a resumption ticket
+
+Runs a ChatServer in this process and times AsyncChatClient.connect()
+from opening the socket until the lobby key is usable:
+  full     - RSA key exchange; each connect uses a different pre-generated
+             key pair so the server's key wrap cache never hits
+  resumed  - the same session reconnecting with the ticket it was handed
+             on its previous connection
+
+    python bench/resumption.py --connects 200 --workers 1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from async_client import AsyncChatClient
+from crypto_utils import generate_private_key
+from server import ChatServer
+
+SERVER_PASSWORD = "secret123"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+async def timed_connect(session, port, username):
+    started = time.perf_counter()
+    await session.connect('localhost', port, username, SERVER_PASSWORD)
+    elapsed = time.perf_counter() - started
+    await session.close()
+    async for _ in session:
+        pass
+    return elapsed
+
+
+async def run_full(port, keys):
+    timings = []
+    for i, key in enumerate(keys):
+        session = AsyncChatClient(private_key=key, max_events=None)
+        timings.append(await timed_connect(session, port, f"full{i}"))
+    return timings
+
+
+async def run_resumed(port, key, connects):
+    session = AsyncChatClient(private_key=key, max_events=None)
+    await timed_connect(session, port, "resumer")  # Full handshake that issues the first ticket
+    timings = []
+    for _ in range(connects):
+        if session.ticket is None:
+            raise RuntimeError("Server did not issue a resumption ticket")
+        timings.append(await timed_connect(session, port, "resumer"))
+    return timings
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "connects": len(timings),
+        "mean_ms": statistics.mean(timings) * 1e3,
+        "p50_ms": statistics.median(timings) * 1e3,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connects', type=int, default=100, help='connects per mode')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='server handshake workers (default one per core, 0 wraps on the connection thread)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    port = free_port()
+    server = ChatServer('localhost', port, handshake_workers=args.workers)
+    server.server_password = SERVER_PASSWORD
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+
+    # Key generation is the client's cost either way; keep it out of the timings
+    keys = [generate_private_key() for _ in range(args.connects + 1)]
+    try:
+        results = {
+            "full": summarize(asyncio.run(run_full(port, keys[1:]))),
+            "resumed": summarize(asyncio.run(run_resumed(port, keys[0], args.connects))),
+        }
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for mode, result in results.items():
+        print(f"{mode:<8} {result['connects']:>5} connects  mean {result['mean_ms']:>7.2f} ms  "
+              f"p50 {result['p50_ms']:>7.2f} ms  p95 {result['p95_ms']:>7.2f} ms")
+    print(f"resumed p50 is {results['full']['p50_ms'] / results['resumed']['p50_ms']:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
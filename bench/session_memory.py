@@ -0,0 +1,125 @@
+# session_memory.py
+
+"""
+Memory budget check: server RSS growth per idle session
+
+Starts a server in its own process (as loadgen.py does), measures its RSS,
+connects --sessions AsyncChatClient sessions through the full handshake
+and leaves them idle in the lobby, then measures again. Exits non-zero
+if the growth per session is over --budget KiB, so it can gate a change
+that makes connections heavier; tests/test_session_memory.py runs it
+with a few hundred sessions.
+
+Every join is announced to everyone already in the lobby, so connecting
+takes time quadratic in --sessions: about 35 s for 1000 on one core.
+
+    python bench/session_memory.py --sessions 1000 --engine asyncio --budget 24
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(ROOT, 'server'))
+
+from loadgen import ENGINES, SERVER_PASSWORD, run_server, free_port, wait_for_port, process_usage
+from async_client import AsyncChatClient
+from async_server import raise_fd_limit
+from crypto_utils import generate_private_key
+
+DEFAULT_SESSIONS = 1000
+DEFAULT_BUDGET_KIB = 24
+DEFAULT_CONNECT_CONCURRENCY = 64
+SETTLE_SECONDS = 2.0
+
+# One process without key wrapping workers, so the RSS is the server's alone.
+# Deadlines are off: connecting thousands of sessions on a small machine can
+# delay pongs past ping_timeout, and the sessions are meant to stay.
+SERVER_OPTIONS = {"handshake_workers": 0, "handshake_timeout": None, "ping_interval": None}
+
+
+async def open_sessions(port, count, concurrency):
+    """Connect count idle sessions sharing one key pair; returns them once all are in"""
+    private_key = generate_private_key()
+    sessions = [AsyncChatClient(private_key=private_key, max_events=0) for _ in range(count)]
+    slots = asyncio.Semaphore(concurrency)
+
+    async def connect(index, session):
+        async with slots:
+            await session.connect('localhost', port, f"idle{index}", SERVER_PASSWORD)
+
+    await asyncio.gather(*(connect(i, session) for i, session in enumerate(sessions)))
+    return sessions
+
+
+async def measure(port, server_pid, count, connect_concurrency):
+    await asyncio.sleep(SETTLE_SECONDS)
+    rss_before = process_usage(server_pid)[1]
+
+    started = time.perf_counter()
+    sessions = await open_sessions(port, count, connect_concurrency)
+    connect_seconds = time.perf_counter() - started
+
+    # Let the server finish queued writes and settle before sampling
+    await asyncio.sleep(SETTLE_SECONDS)
+    rss_after = process_usage(server_pid)[1]
+    await asyncio.gather(*(session.close() for session in sessions))
+
+    return {
+        "sessions": count,
+        "connect_seconds": connect_seconds,
+        "rss_mb_before": rss_before / 2**20,
+        "rss_mb_after": rss_after / 2**20,
+        "kib_per_session": (rss_after - rss_before) / count / 1024,
+    }
+
+
+def run(sessions=DEFAULT_SESSIONS, engine="asyncio", budget=DEFAULT_BUDGET_KIB,
+        connect_concurrency=DEFAULT_CONNECT_CONCURRENCY):
+    """Measure a fresh server process; within_budget in the results is the verdict"""
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--engine', engine]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = asyncio.run(measure(port, server.pid, sessions, connect_concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+    results["engine"] = engine
+    results["budget_kib"] = budget
+    results["within_budget"] = results["kib_per_session"] <= budget
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS)
+    parser.add_argument('--engine', choices=ENGINES, default="asyncio")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_KIB, help='allowed RSS growth per session in KiB')
+    parser.add_argument('--connect-concurrency', type=int, default=DEFAULT_CONNECT_CONCURRENCY,
+                        help='handshakes in flight at once')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.engine, args.serve, SERVER_OPTIONS)
+        return
+
+    if process_usage(os.getpid()) is None:
+        sys.exit("RSS is read from /proc; this check only runs on Linux")
+    raise_fd_limit()
+
+    results = run(args.sessions, args.engine, args.budget, args.connect_concurrency)
+    print(json.dumps(results, indent=2))
+    if not results["within_budget"]:
+        sys.exit(f"{results['kib_per_session']:.1f} KiB per session is over the {args.budget} KiB budget")
+
+
+if __name__ == "__main__":
+    main()
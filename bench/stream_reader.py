@@ -0,0 +1,108 @@
+# stream_reader.py
+
+"""
+Benchmark: receive-loop reassembly cost, legacy string buffer vs FrameReader
+
+Two workloads are replayed from memory through a fake socket:
+  large - a few 1 MB frames arriving in 1 KiB reads
+  burst - 10k small frames delivered in 64 KiB reads
+
+The legacy loop is the original `buffer += data` / `split('\\n', 1)` code.
+
+    python bench/stream_reader.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from shared.protocol import Frame, WIRE_BINARY, WIRE_JSON
+from shared.stream_reader import FrameReader
+
+
+class ReplaySocket:
+    """Serves a fixed byte stream in chunks of at most chunk_size"""
+
+    def __init__(self, data, chunk_size):
+        self.data = memoryview(data)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def recv(self, bufsize):
+        n = min(bufsize, self.chunk_size)
+        chunk = self.data[self.pos:self.pos + n].tobytes()
+        self.pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        n = min(len(buffer), self.chunk_size, len(self.data) - self.pos)
+        buffer[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def legacy_loop(sock, read_size):
+    buffer = ""
+    frames = 0
+    while True:
+        data = sock.recv(read_size).decode('utf-8', errors='ignore')
+        if not data:
+            break
+        buffer += data
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            frames += 1
+    return frames
+
+
+def reader_loop(sock, wire):
+    reader = FrameReader(wire)
+    frames = 0
+    while reader.recv_into(sock):
+        for record in reader.frames():
+            frames += 1
+    return frames
+
+
+def make_stream(count, payload_size, wire):
+    ciphertext = os.urandom(payload_size)
+    message = {"type": "message", "sender": "bench", "message": ciphertext, "encrypted": True}
+    return Frame(message).encode(wire) * count
+
+
+def run(name, count, payload_size, chunk_size):
+    results = []
+    json_stream = make_stream(count, payload_size, WIRE_JSON)
+
+    start = time.perf_counter()
+    frames = legacy_loop(ReplaySocket(json_stream, chunk_size), chunk_size)
+    results.append(("legacy json", time.perf_counter() - start, frames))
+
+    for wire in (WIRE_JSON, WIRE_BINARY):
+        stream = json_stream if wire == WIRE_JSON else make_stream(count, payload_size, wire)
+        start = time.perf_counter()
+        frames = reader_loop(ReplaySocket(stream, chunk_size), wire)
+        results.append((f"reader {wire}", time.perf_counter() - start, frames))
+
+    print(f"{name}: {count} frames x {payload_size} byte payload, {chunk_size} byte reads")
+    for label, elapsed, frames in results:
+        assert frames == count, f"{label} decoded {frames} frames"
+        print(f"  {label:<14} {elapsed * 1e3:>9.1f} ms  {elapsed / count * 1e6:>9.1f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--large-frames', type=int, default=4)
+    parser.add_argument('--burst-frames', type=int, default=10000)
+    args = parser.parse_args()
+
+    # base64 inflates the JSON stream, so size the payload to ~1 MB on the wire
+    run("large", args.large_frames, 3 * 1024 * 1024 // 4 // 4 * 4, 1024)
+    run("burst", args.burst_frames, 96, 65536)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# timer_wheel.py
+
+"""
+Benchmark: cost of connection deadlines on the hashed timer wheel
+
+Arms one timer per connection, spread evenly over the ping interval, and
+measures what a server tick costs as connections grow: sweeping the wheel
+and re-arming the timers of connections that were active, as
+Liveness.expired() does every second.
+
+    python bench/timer_wheel.py --connections 1000,10000,50000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+
+from liveness import Liveness, DEFAULT_PING_INTERVAL
+
+
+class Connection:
+    """Just the attributes Liveness reads"""
+
+    def __init__(self, now):
+        self.username = "bench"
+        self.closed = False
+        self.last_seen = now
+
+
+def run(count, ticks, interval):
+    liveness = Liveness(ping_interval=interval)
+    origin = liveness.wheel.origin
+    connections = [Connection(origin) for _ in range(count)]
+
+    started = time.perf_counter()
+    for i, connection in enumerate(connections):
+        liveness.wheel.schedule(connection, interval * (i + 1) / count, origin)
+    schedule_seconds = time.perf_counter() - started
+
+    tick_seconds = []
+    fired = 0
+    for tick in range(1, ticks + 1):
+        now = origin + tick * liveness.wheel.tick
+        for connection in connections:
+            connection.last_seen = now  # Everyone is active, so every fired timer is re-armed
+        started = time.perf_counter()
+        due = liveness.wheel.advance(now)
+        for connection in due:
+            liveness.check(connection, now)
+        tick_seconds.append(time.perf_counter() - started)
+        fired += len(due)
+
+    return {
+        "connections": count,
+        "schedule_us_per_timer": schedule_seconds / count * 1e6,
+        "timers_fired": fired,
+        "tick_ms_mean": statistics.mean(tick_seconds) * 1e3,
+        "tick_ms_max": max(tick_seconds) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', default='1000,10000,50000', help='comma separated connection counts')
+    parser.add_argument('--ticks', type=int, default=60, help='ticks to sweep per run')
+    parser.add_argument('--interval', type=float, default=DEFAULT_PING_INTERVAL, help='ping interval in seconds')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = [run(int(count), args.ticks, args.interval) for count in args.connections.split(',') if count]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"{result['connections']:>7} connections  schedule {result['schedule_us_per_timer']:>5.2f} us/timer  "
+              f"tick mean {result['tick_ms_mean']:>7.3f} ms  max {result['tick_ms_max']:>7.3f} ms  "
+              f"({result['timers_fired']} fired)")
+
+
+if __name__ == "__main__":
+    main()
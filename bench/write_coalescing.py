@@ -0,0 +1,124 @@
+# write_coalescing.py
+
+"""
+Benchmark: send syscalls per message and delivery latency of QueuedSocket
+
+Frames are produced at a fixed rate into one QueuedSocket over a local
+socketpair and read back on the other end. Each rate is run with:
+  per-frame  - one write per frame, as the writer did before coalescing
+  coalesce   - whatever is queued when the writer wakes goes in one sendmsg()
+  window Nms - additionally wait up to N ms for more frames to join a write
+
+    python bench/write_coalescing.py --rates 1000,10000,50000 --windows 1,5
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+
+from outbound import OutboundQueue, QueuedSocket, DEFAULT_FLUSH_BYTES
+from shared.protocol import Frame, WIRE_JSON
+from shared.stream_reader import FrameReader
+
+
+class CountingSocket:
+    """Passes writes through to a socket, counting the calls"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.writes = 0
+
+    def sendall(self, data):
+        self.writes += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.writes += 1
+        return self.sock.sendmsg(buffers)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+def receive(sock, count, latencies):
+    reader = FrameReader(WIRE_JSON)
+    while len(latencies) < count and reader.recv_into(sock):
+        now = time.perf_counter()
+        for record in reader.frames():
+            latencies.append(now - json.loads(bytes(record))["sent"])
+
+
+def run(rate, duration, flush_window, flush_bytes, payload):
+    count = max(1, int(rate * duration))
+    ours, theirs = socket.socketpair()
+    counting = CountingSocket(ours)
+    sender = QueuedSocket(counting, OutboundQueue(maxsize=count + 1), flush_window, flush_bytes)
+    latencies = []
+    receiver = threading.Thread(target=receive, args=(theirs, count, latencies), daemon=True)
+    receiver.start()
+
+    start = time.perf_counter()
+    for i in range(count):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        message = {"type": "message", "sender": "bench", "message": payload, "encrypted": True,
+                   "sent": time.perf_counter()}
+        sender.send_frame(Frame(message))
+    elapsed = time.perf_counter() - start
+
+    receiver.join()
+    sender.close()
+    sender.writer.join()
+    theirs.close()
+    latencies.sort()
+    return {
+        "messages": count,
+        "achieved_rate": count / elapsed,
+        "writes": counting.writes,
+        "writes_per_message": counting.writes / count,
+        "p50_ms": statistics.median(latencies) * 1e3,
+        "p99_ms": latencies[min(count - 1, int(count * 0.99))] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rates', default='1000,10000,50000', help='comma separated messages per second')
+    parser.add_argument('--windows', default='1,5', help='comma separated flush windows in ms')
+    parser.add_argument('--duration', type=float, default=1.0, help='seconds per run')
+    parser.add_argument('--payload', type=int, default=128, help='ciphertext bytes per message')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    modes = [("per-frame", 0.0, 0), ("coalesce", 0.0, DEFAULT_FLUSH_BYTES)]
+    modes += [(f"window {w}ms", float(w) / 1e3, DEFAULT_FLUSH_BYTES) for w in args.windows.split(',') if w]
+    payload = os.urandom(args.payload)
+
+    results = []
+    for rate in (int(r) for r in args.rates.split(',')):
+        for label, flush_window, flush_bytes in modes:
+            result = run(rate, args.duration, flush_window, flush_bytes, payload)
+            result.update(rate=rate, mode=label)
+            results.append(result)
+            if not args.json:
+                print(f"{rate:>7}/s  {label:<12} {result['achieved_rate']:>9.0f}/s sent  "
+                      f"{result['writes_per_message']:>6.3f} writes/msg  "
+                      f"p50 {result['p50_ms']:>7.3f} ms  p99 {result['p99_ms']:>7.3f} ms")
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+# async_client.py
+
+"""
+Headless asyncio chat client
+
+An AsyncChatClient is one chat session. A receive task reads frames,
+decrypts chat messages and queues ChatEvents, which callers consume with
+`async for event in client`. Nothing here touches Tk or starts a thread
+per session, so one event loop can hold thousands of sessions for bots
+and load tests.
+"""
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from crypto_utils import CryptoUtils, SUPPORTED_SUITES, shared_key_pool
+from compressor import Compressor, available_compressions, DEFAULT_COMPRESS_THRESHOLD
+from pipeline import run_batch, run_in_order
+from shared.protocol import (Protocol, Frame, WIRE_JSON, WIRE_FORMATS, SUITE_FERNET, DEFAULT_ROOM, USER_JOINED,
+                             USER_LEFT, PING)
+from shared.stream_reader import FrameReader, DEFAULT_MAX_FRAME_SIZE
+
+READ_SIZE = 65536
+DEFAULT_CONNECT_TIMEOUT = 30.0
+DEFAULT_MAX_EVENTS = 1024
+
+# Event types
+EVENT_MESSAGE = "message"            # sender, message (decrypted text), encrypted (True if it could not be decrypted)
+EVENT_SYSTEM = "system"              # message
+EVENT_READY = "ready"                # The key of room arrived; messages to it are now encrypted
+EVENT_USERS = "users"                # users: full roster of room
+EVENT_USER_JOINED = "user_joined"    # sender joined room
+EVENT_USER_LEFT = "user_left"        # sender left room
+EVENT_AUTH_FAILED = "auth_failed"    # message: the server's reason
+EVENT_DISCONNECTED = "disconnected"  # Always the last event of a connection
+
+ChatEvent = namedtuple('ChatEvent', 'type room sender message encrypted users',
+                       defaults=(DEFAULT_ROOM, None, None, False, None))
+
+
+class HandshakeError(ConnectionError):
+    """Raised by connect() when the server refuses the handshake"""
+
+
+class AsyncChatClient:
+    """One chat session driven by an asyncio event loop
+
+    Events are queued in arrival order. Once max_events are waiting, the
+    receive task stops reading until the consumer catches up, so a slow
+    consumer pushes back on the server instead of growing memory; the
+    server's slow-client policy decides what happens next. max_events=0
+    discards events (send-only bots), None lets them queue without limit.
+
+    Chat messages are decrypted on the loop by default. With
+    decrypt_workers, each burst of messages is decrypted on a thread pool
+    and still delivered in order; that pays off for a single busy session,
+    not for thousands of quiet ones sharing a loop.
+    """
+
+    def __init__(self, key_file=None, key_pool=None, rotate_keys=True, private_key=None, decrypt_workers=0,
+                 compression=False, compress_threshold=DEFAULT_COMPRESS_THRESHOLD, max_events=DEFAULT_MAX_EVENTS):
+        self.connected = False
+        self.username = None
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.bytes_received = 0
+
+        # RSA keys: private_key when given (e.g. one key shared by many bots),
+        # a stored key pair when key_file is set, otherwise a fresh pair per
+        # session (rotate_keys) served from a pool generated ahead of need,
+        # by default the one pool every client in the process shares
+        self.key_file = key_file
+        self.rotate_keys = rotate_keys
+        if key_pool is None and not key_file and private_key is None:
+            key_pool = shared_key_pool()
+        self.crypto = CryptoUtils(key_pool)
+        if private_key is not None:
+            self.crypto.private_key = private_key
+            self.crypto.public_key = private_key.public_key()
+            self.rotate_keys = False
+
+        self.decrypt_workers = decrypt_workers
+        self.executor = ThreadPoolExecutor(max_workers=decrypt_workers) if decrypt_workers else None
+        self.wire = WIRE_JSON  # Switched when the server acknowledges our offer
+        self.wire_formats = WIRE_FORMATS
+        self.max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.cipher_suites = SUPPORTED_SUITES
+
+        # Compress-then-encrypt is opt-in: compressed length can reveal how much
+        # of a message an attacker who can inject text guessed right. Incoming
+        # compressed messages are always understood.
+        self.compression = compression
+        self.compress_threshold = compress_threshold  # Shorter messages are never compressed
+        self.compressor = Compressor()
+        self.send_compression = None  # Named by the server's welcome when both sides opted in
+
+        # Rooms we are in: room -> CryptoUtils holding that room's key
+        self.current_room = DEFAULT_ROOM
+        self.room_crypto = {DEFAULT_ROOM: self.crypto}
+        self.rosters = {}  # room -> (version, members): last snapshot plus the deltas since
+        self.syncing = set()  # Rooms waiting for a fresh snapshot after a version gap
+
+        self.max_events = max_events
+        self.events = None
+        self.events_wanted = None  # Set while the event queue has room
+        self.pending = []  # (func, args) jobs of the burst being read; func None is a ready event
+        self.ready = None
+        self.welcomed = False
+        self.refusal = None
+
+        # Resumption ticket from the last handshake, valid for reconnecting to
+        # ticket_target as the same user with the same key pair and lobby key
+        self.ticket = None
+        self.ticket_target = None
+
+    async def connect(self, host, port, username, password, timeout=DEFAULT_CONNECT_TIMEOUT):
+        """Connect, authenticate and wait for the lobby key
+
+        Raises HandshakeError if the server refuses us. Whatever happens,
+        the event stream of this connection ends with the connection.
+        """
+        loop = asyncio.get_running_loop()
+        self.username = username
+        self.wire = WIRE_JSON
+        self.send_compression = None
+        self.current_room = DEFAULT_ROOM
+        self.room_crypto = {DEFAULT_ROOM: self.crypto}
+        self.rosters = {}
+        self.syncing = set()
+        self.events = asyncio.Queue()
+        self.events_wanted = asyncio.Event()
+        self.events_wanted.set()
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.welcomed = False
+        self.refusal = None
+
+        # Tickets are single use; the server sends a new one with the lobby key
+        ticket = self.ticket if self.ticket_target == (host, port, username) and self.crypto.fernet else None
+        self.ticket = None
+        self.ticket_target = (host, port, username)
+
+        try:
+            # Key generation or loading may block; keep it off the loop. A
+            # ticket is bound to our key pair, so resuming keeps the old one.
+            if ticket is None:
+                await loop.run_in_executor(None, self._prepare_rsa_keys)
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except BaseException:
+            self.events.put_nowait(None)
+            raise
+        self.connected = True
+
+        # Send handshake with server password
+        handshake = {
+            "type": "handshake",
+            "username": username,
+            "server_password": password,
+            "public_key": self.crypto.get_public_key_pem().decode(),
+            "wire": list(self.wire_formats),
+            "cipher_suites": list(self.cipher_suites)
+        }
+        if self.compression:
+            handshake["compression"] = available_compressions()
+        if ticket:
+            handshake["ticket"] = ticket
+        self._write([handshake])
+        self.receiver = asyncio.ensure_future(self._receive_messages())
+
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise
+        if self.refusal is not None:
+            raise HandshakeError(self.refusal)
+        if not self.connected:
+            raise ConnectionError("Connection closed during the handshake")
+        return self
+
+    def _prepare_rsa_keys(self):
+        """Make sure a key pair is ready for this session"""
+        if self.key_file:
+            if self.crypto.private_key is None:
+                self.crypto.load_or_generate_rsa_keys(self.key_file)
+        elif self.rotate_keys or self.crypto.private_key is None:
+            self.crypto.generate_rsa_keys()
+
+    async def close(self):
+        """Disconnect from the server; the event stream ends after EVENT_DISCONNECTED"""
+        self.connected = False
+        if self.writer:
+            self.writer.close()
+        if self.events_wanted:
+            self.events_wanted.set()  # The receive task may be waiting on the consumer
+        if self.receiver:
+            await asyncio.gather(self.receiver, return_exceptions=True)
+
+    async def __aiter__(self):
+        """Events of the current connection, ending after EVENT_DISCONNECTED"""
+        events, events_wanted = self.events, self.events_wanted
+        if events is None:
+            return
+        while True:
+            event = await events.get()
+            if self.max_events is None or events.qsize() < self.max_events:
+                events_wanted.set()
+            if event is None:
+                return
+            yield event
+
+    async def send(self, message, room=None):
+        """Send a chat message to a room, the current one by default"""
+        if not self.connected:
+            return
+
+        self._write([self._chat_payload(message, room=room or self.current_room)])
+        await self._drain()
+
+    async def send_many(self, messages, room=None):
+        """Encrypt a batch of chat messages and send them in one write"""
+        if not self.connected:
+            return
+
+        room = room or self.current_room
+        crypto = self.room_crypto.get(room)
+        if crypto and crypto.fernet:
+            try:
+                packed = [self._compress(message) for message in messages]
+                ciphertexts = crypto.encrypt_many([data for data, _ in packed])
+                payloads = [self._chat_payload(None, ciphertext, room, compression)
+                            for ciphertext, (_, compression) in zip(ciphertexts, packed)]
+            except Exception as e:
+                print(f"Encryption error: {e}")
+                payloads = [self._chat_payload(message, room=room) for message in messages]
+        else:
+            payloads = [self._chat_payload(message, room=room) for message in messages]
+
+        self._write(payloads)
+        await self._drain()
+
+    async def join_room(self, room):
+        """Join a room, or switch to it if we are already in it"""
+        if not self.connected:
+            return
+
+        if room in self.room_crypto:
+            self._switch_room(room)
+            return
+        self._write([Protocol.create_join_room(room)])
+        await self._drain()
+
+    async def leave_room(self, room=None):
+        """Leave a room, the current one by default"""
+        room = room or self.current_room
+        if not self.connected or room == DEFAULT_ROOM:
+            return
+
+        self._write([Protocol.create_leave_room(room)])
+        self.room_crypto.pop(room, None)
+        self.rosters.pop(room, None)
+        self.syncing.discard(room)
+        if room == self.current_room:
+            self._switch_room(DEFAULT_ROOM)
+        await self._drain()
+
+    def get_users(self, room=None):
+        """Members of a room as last reported by the server"""
+        return list(self.rosters.get(room or self.current_room, (0, []))[1])
+
+    def _write(self, payloads):
+        """Queue messages on the transport in the negotiated wire format"""
+        if not self.connected:
+            return
+        try:
+            self.writer.write(b"".join(Frame(payload).encode(self.wire) for payload in payloads))
+        except Exception as e:
+            print(f"Send error: {e}")
+            self._abort()
+
+    async def _drain(self):
+        """Wait while the transport's buffer is over its high-water mark"""
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            if self.connected:
+                print(f"Send error: {e}")
+            self._abort()
+
+    def _abort(self):
+        self.connected = False
+        if self.writer:
+            self.writer.close()
+
+    def _chat_payload(self, message, ciphertext=None, room=DEFAULT_ROOM, compression=None):
+        """Build a chat payload, encrypting message if the room key is available"""
+        crypto = self.room_crypto.get(room)
+        if ciphertext is None and crypto and crypto.fernet:
+            try:
+                plaintext, compression = self._compress(message)
+                ciphertext = crypto.encrypt_bytes(plaintext)
+            except Exception as e:
+                print(f"Encryption error: {e}")
+                compression = None
+
+        if ciphertext is None:
+            payload = {
+                "type": "message",
+                "message": message,
+                "encrypted": False
+            }
+        else:
+            payload = {
+                "type": "message",
+                "message": ciphertext,
+                "encrypted": True
+            }
+            if crypto.suite != SUITE_FERNET:
+                payload["suite"] = crypto.suite
+            if compression:
+                payload["compression"] = compression
+        if room != DEFAULT_ROOM:
+            payload["room"] = room
+        return payload
+
+    def _compress(self, message):
+        """Compress a message about to be encrypted, if negotiated and worth it
+
+        Returns the bytes to encrypt and the compression used, or None.
+        """
+        data = message.encode() if isinstance(message, str) else message
+        if self.send_compression and len(data) >= self.compress_threshold:
+            compressed = self.compressor.compress(data, self.send_compression)
+            if len(compressed) < len(data):
+                return compressed, self.send_compression
+        return data, None
+
+    def _switch_room(self, room):
+        """Make room the target of sent messages and report its member list
+
+        A room just joined has no roster until the server's snapshot arrives;
+        the snapshot reports it then, so the previous list stays up meanwhile.
+        """
+        self.current_room = room
+        if room in self.rosters:
+            self._emit(ChatEvent(EVENT_USERS, room, users=self.get_users(room)))
+
+    async def _receive_messages(self):
+        """Read frames until the connection closes, queueing events per burst"""
+        frame_reader = FrameReader(self.wire, self.max_frame_size)
+        try:
+            while self.connected:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+
+                self.bytes_received += len(data)
+                frame_reader.feed(data)
+                for record in frame_reader.frames():
+                    self._process_message(record)
+                    frame_reader.wire = self.wire
+                await self._flush_events()
+
+        except Exception as e:
+            if self.connected:
+                print(f"Receive error: {e}")
+        finally:
+            self._abort()
+            self.ready.set()
+            # The end of the stream is queued even past max_events
+            self._emit(ChatEvent(EVENT_DISCONNECTED))
+            jobs, self.pending = self.pending, []
+            self._queue_events(run_batch(jobs))
+            self.events.put_nowait(None)
+
+    def _emit(self, event):
+        """Queue an event behind any messages of this burst still to be decrypted"""
+        self.pending.append((None, event))
+
+    async def _flush_events(self):
+        """Decrypt the burst that was just read and queue its events in order"""
+        jobs, self.pending = self.pending, []
+        if jobs:
+            self._queue_events(await run_in_order(jobs, self.executor, self.decrypt_workers))
+        if self.max_events is not None and self.events.qsize() >= self.max_events > 0:
+            self.events_wanted.clear()
+            await self.events_wanted.wait()
+
+    def _queue_events(self, events):
+        if self.max_events == 0:
+            return
+        for event in events:
+            self.events.put_nowait(event)
+
+    def _process_message(self, message_data):
+        """Process incoming message"""
+        try:
+            data = Protocol.decode(message_data, self.wire)
+            msg_type = data.get("type")
+
+            if msg_type == "key_exchange":
+                self._handle_key_exchange(data)
+            elif msg_type == "user_list":
+                self._handle_user_list(data)
+            elif msg_type in (USER_JOINED, USER_LEFT):
+                self._handle_presence(data)
+            elif msg_type == PING:
+                self._write([Protocol.create_pong()])
+            elif msg_type == "message":
+                # Decrypted with the room key as of now, even if a later frame
+                # of this burst replaces it
+                crypto = self.room_crypto.get(data.get("room", DEFAULT_ROOM))
+                self.pending.append((self._decrypt_message, (crypto, data)))
+            elif msg_type == "system":
+                if "wire" in data:
+                    # Every later frame uses the format the server picked
+                    self.wire = data["wire"]
+                    self.welcomed = True
+                elif not self.welcomed and self.refusal is None:
+                    # Answered our handshake without accepting it
+                    self.refusal = data["message"]
+                    self._abort()
+                if data.get("compression") and self.compression:
+                    self.send_compression = data["compression"]
+                self._emit(ChatEvent(EVENT_SYSTEM, data.get("room", DEFAULT_ROOM), message=data["message"]))
+                if data.get("resumed"):
+                    self._resume(data)
+            elif msg_type == "auth_error":
+                # Server rejected our password
+                self.refusal = f"Authentication failed: {data['message']}"
+                self._emit(ChatEvent(EVENT_AUTH_FAILED, message=data["message"]))
+                self._abort()
+
+        except ValueError as e:
+            print(f"Invalid frame received: {e}")
+
+    def _handle_user_list(self, data):
+        """Replace a room's roster with a full snapshot"""
+        room = data.get("room", DEFAULT_ROOM)
+        version = data.get("version", 0)
+        roster = self.rosters.get(room)
+        if roster and version and version < roster[0]:
+            return  # Older than deltas we already applied
+
+        users = list(data["users"])
+        self.rosters[room] = (version, users)
+        self.syncing.discard(room)
+        self._emit(ChatEvent(EVENT_USERS, room, users=list(users)))
+
+    def _handle_presence(self, data):
+        """Apply a user_joined/user_left delta, or ask for a snapshot after a gap"""
+        room = data.get("room", DEFAULT_ROOM)
+        roster = self.rosters.get(room)
+        if roster is None or room in self.syncing:
+            return  # A snapshot is on its way and will include this change
+
+        version, users = roster
+        if data["version"] <= version:
+            return
+        if data["version"] != version + 1:
+            self.syncing.add(room)
+            self._write([Protocol.create_user_list_request(room)])
+            return
+
+        username = data["username"]
+        joined = data["type"] == USER_JOINED
+        if joined and username not in users:
+            users.append(username)
+        elif not joined and username in users:
+            users.remove(username)
+        self.rosters[room] = (data["version"], users)
+        self._emit(ChatEvent(EVENT_USER_JOINED if joined else EVENT_USER_LEFT, room, username))
+
+    def _handle_key_exchange(self, data):
+        """Handle symmetric key exchange"""
+        try:
+            encrypted_key = data["encrypted_key"]
+
+            # Decrypt the symmetric key
+            decrypted_key = self.crypto.decrypt_with_private_key(encrypted_key)
+
+            room = data.get("room", DEFAULT_ROOM)
+            if room == DEFAULT_ROOM:
+                crypto = self.crypto
+            else:
+                # Other rooms only need a symmetric key, not a key pair
+                crypto = CryptoUtils()
+
+            # Import the symmetric key and the suite the server picked for sending
+            crypto.import_symmetric_key(decrypted_key)
+            crypto.suite = data.get("cipher_suite", self.crypto.suite)
+            self.room_crypto[room] = crypto
+
+            self._emit(ChatEvent(EVENT_READY, room))
+            if room == DEFAULT_ROOM:
+                self.ticket = data.get("ticket")
+                self.ready.set()
+            else:
+                self._switch_room(room)
+
+        except Exception as e:
+            print(f"Key exchange error: {e}")
+
+    def _resume(self, data):
+        """The server accepted our ticket: the lobby key we still hold is current"""
+        self.crypto.suite = data.get("cipher_suite", SUITE_FERNET)
+        self.ticket = data.get("ticket")
+        self._emit(ChatEvent(EVENT_READY))
+        self.ready.set()
+
+    def _decrypt_message(self, crypto, data):
+        """Decrypt a chat message into its event; runs on the decrypt pool if there is one"""
+        room = data.get("room", DEFAULT_ROOM)
+        sender = data.get("sender", "Unknown")
+        message = data["message"]
+        encrypted = data.get("encrypted", False)
+
+        if encrypted and crypto and crypto.fernet:
+            try:
+                plaintext = crypto.decrypt_bytes(message, data.get("suite", SUITE_FERNET))
+                if "compression" in data:
+                    plaintext = self.compressor.decompress(plaintext, data["compression"])
+                return ChatEvent(EVENT_MESSAGE, room, sender, plaintext.decode())
+            except Exception:
+                return ChatEvent(EVENT_MESSAGE, room, sender, "[Decryption failed]", True)
+        return ChatEvent(EVENT_MESSAGE, room, sender, message, encrypted)
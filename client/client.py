@@ -1,184 +1,134 @@
 # client.py
-import socket
-import json
+import asyncio
 import threading
-from crypto_utils import CryptoUtils
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from async_client import (AsyncChatClient, EVENT_MESSAGE, EVENT_SYSTEM, EVENT_READY, EVENT_USERS, EVENT_USER_JOINED,
+                          EVENT_USER_LEFT, EVENT_AUTH_FAILED, EVENT_DISCONNECTED)
+from compressor import DEFAULT_COMPRESS_THRESHOLD
+from pipeline import default_workers
 from gui import ChatGUI
+from shared.protocol import DEFAULT_ROOM
 
 class ChatClient:
-    def __init__(self):
-        self.socket = None
-        self.connected = False
-        self.username = None
-        self.crypto = CryptoUtils()
+    """Tk-facing client: runs an AsyncChatClient on its own event loop thread
+
+    Calls from the GUI thread are handed to the loop, and every event of the
+    session is queued on the GUI, which renders them in batches.
+    """
+    
+    def __init__(self, key_file=None, key_pool=None, rotate_keys=True, decrypt_workers=None,
+                 compression=False, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        # Incoming messages are decrypted on a worker pool but shown in arrival
+        # order; 0 workers decrypts inline on the loop thread
+        if decrypt_workers is None:
+            decrypt_workers = default_workers()
+        self.session = AsyncChatClient(key_file, key_pool, rotate_keys, decrypt_workers=decrypt_workers,
+                                       compression=compression, compress_threshold=compress_threshold,
+                                       max_events=None)
         self.gui = None
-        self.receiving = False
+        self.loop = None
+        
+    @property
+    def connected(self):
+        return self.session.connected
+        
+    @property
+    def username(self):
+        return self.session.username
+        
+    @property
+    def current_room(self):
+        return self.session.current_room
         
     def set_gui(self, gui):
         """Set the GUI reference"""
         self.gui = gui
         
     def connect(self, host, port, username, password):
-        """Connect to the chat server"""
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((host, port))
-            self.connected = True
-            self.username = username
-            
-            # Generate RSA keys
-            self.crypto.generate_rsa_keys()
-            public_key_pem = self.crypto.get_public_key_pem().decode()
-            
-            # Send handshake with server password
-            handshake = {
-                "type": "handshake",
-                "username": username,
-                "server_password": password,  # Send server password
-                "public_key": public_key_pem
-            }
-            self._send_json(handshake)
-            
-            # Start receiving thread
-            self.receiving = True
-            threading.Thread(target=self._receive_messages, daemon=True).start()
+        """Connect to the chat server and wait for the handshake to finish"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
             
+        connecting = self._run(self.session.connect(host, port, username, password))
+        try:
+            connecting.result()
             return True
-            
         except Exception as e:
             print(f"Connection error: {e}")
             return False
+        finally:
+            # Show whatever the server said, including why it refused us
+            self._run(self._forward_events())
             
     def disconnect(self):
         """Disconnect from server"""
-        self.receiving = False
-        self.connected = False
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
-            self.socket = None
-            
-    def _send_json(self, data):
-        """Send JSON data to server"""
-        try:
-            json_data = json.dumps(data)
-            self.socket.sendall(json_data.encode() + b'\n')
-        except Exception as e:
-            print(f"Send error: {e}")
-            self.disconnect()
-            
-    def send_message(self, message):
-        """Send chat message to server"""
-        if not self.connected:
-            return
-            
-        # Encrypt message if symmetric key is available
-        if self.crypto.fernet:
-            try:
-                encrypted_msg = self.crypto.encrypt_message(message)
-                payload = {
-                    "type": "message",
-                    "message": encrypted_msg,
-                    "encrypted": True
-                }
-            except Exception as e:
-                print(f"Encryption error: {e}")
-                payload = {
-                    "type": "message", 
-                    "message": message,
-                    "encrypted": False
-                }
-        else:
-            payload = {
-                "type": "message",
-                "message": message,
-                "encrypted": False
-            }
-            
-        self._send_json(payload)
+        if self.loop:
+            self._run(self.session.close()).result()
+            
+    def send_message(self, message, room=None):
+        """Send chat message to a room, the current one by default"""
+        if self.connected:
+            self._run(self.session.send(message, room))
+            
+    def send_many(self, messages, room=None):
+        """Encrypt a batch of chat messages and send them in one write"""
+        if self.connected:
+            self._run(self.session.send_many(messages, room))
+            
+    def join_room(self, room):
+        """Join a room, or switch to it if we are already in it"""
+        if self.connected:
+            self._run(self.session.join_room(room))
+            
+    def leave_room(self, room=None):
+        """Leave a room, the current one by default"""
+        if self.connected:
+            self._run(self.session.leave_room(room))
+            
+    def _run(self, coroutine):
+        """Schedule a coroutine on the session's loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
         
-    def _receive_messages(self):
-        """Receive messages from server"""
-        buffer = ""
-        while self.receiving:
-            try:
-                data = self.socket.recv(1024).decode()
-                if not data:
-                    break
-                    
-                buffer += data
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    self._process_message(line)
-                    
-            except Exception as e:
-                if self.receiving:
-                    print(f"Receive error: {e}")
-                break
-                
-        self.disconnect()
-        if self.gui:
-            self.gui.root.after(0, lambda: self.gui.display_message("System", "Disconnected from server"))
-            
-    def _process_message(self, message_data):
-        """Process incoming message"""
-        try:
-            data = json.loads(message_data)
-            msg_type = data.get("type")
-            
-            if msg_type == "key_exchange":
-                self._handle_key_exchange(data)
-            elif msg_type == "user_list":
-                if self.gui:
-                    self.gui.root.after(0, lambda: self.gui.update_users_list(data["users"]))
-            elif msg_type == "message":
-                self._handle_chat_message(data)
-            elif msg_type == "system":
-                if self.gui:
-                    self.gui.root.after(0, lambda: self.gui.display_message("System", data["message"]))
-            elif msg_type == "auth_error":
-                # Server rejected our password
-                if self.gui:
-                    self.gui.root.after(0, lambda: self.gui.display_message("System", f"Authentication failed: {data['message']}"))
-                self.disconnect()
-                    
-        except json.JSONDecodeError as e:
-            print(f"Invalid JSON received: {e}")
-            
-    def _handle_key_exchange(self, data):
-        """Handle symmetric key exchange"""
-        try:
-            encrypted_key = data["encrypted_key"]
-            
-            # Decrypt the symmetric key
-            decrypted_key = self.crypto.decrypt_with_private_key(encrypted_key)
-            
-            # Import the symmetric key
-            self.crypto.import_symmetric_key(decrypted_key)
-            
+    async def _forward_events(self):
+        """Hand session events to the GUI until the connection ends"""
+        async for event in self.session:
             if self.gui:
-                self.gui.root.after(0, lambda: self.gui.display_message("System", "Secure connection established! You can now send encrypted messages."))
+                self._show_event(event)
                 
-        except Exception as e:
-            print(f"Key exchange error: {e}")
-            
-    def _handle_chat_message(self, data):
-        """Handle incoming chat message"""
-        sender = data.get("sender", "Unknown")
-        message = data["message"]
-        encrypted = data.get("encrypted", False)
-        
-        if self.gui:
-            if encrypted and self.crypto.fernet:
-                try:
-                    decrypted_msg = self.crypto.decrypt_message(message)
-                    self.gui.root.after(0, lambda: self.gui.display_message(sender, decrypted_msg))
-                except Exception as e:
-                    self.gui.root.after(0, lambda: self.gui.display_message(sender, f"[Decryption failed]", True))
-            else:
-                self.gui.root.after(0, lambda: self.gui.display_message(sender, message, encrypted))
+    def _show_event(self, event):
+        """Queue the GUI update for an event; the GUI applies them once per frame"""
+        room = event.room
+        if event.type == EVENT_MESSAGE:
+            self.gui.display_message(self._room_label(room, event.sender), event.message, event.encrypted)
+        elif event.type == EVENT_SYSTEM:
+            self.gui.display_message("System", self._room_label(room, event.message))
+        elif event.type == EVENT_READY and room == DEFAULT_ROOM:
+            self.gui.display_message("System", "Secure connection established! You can now send encrypted messages.")
+        elif event.type == EVENT_AUTH_FAILED:
+            self.gui.display_message("System", f"Authentication failed: {event.message}")
+        elif event.type == EVENT_DISCONNECTED:
+            self.gui.display_message("System", "Disconnected from server")
+            
+        # Member lists only follow the room messages are sent to
+        elif room != self.session.current_room:
+            return
+        elif event.type == EVENT_USERS:
+            self.gui.post(lambda: self.gui.update_users_list(event.users))
+        elif event.type == EVENT_USER_JOINED:
+            self.gui.post(lambda: self.gui.add_user(event.sender))
+        elif event.type == EVENT_USER_LEFT:
+            self.gui.post(lambda: self.gui.remove_user(event.sender))
+            
+    def _room_label(self, room, text):
+        """Prefix text with the room it belongs to, unless that is the lobby"""
+        if room == DEFAULT_ROOM:
+            return text
+        return f"[{room}] {text}"
 
 def main():
     client = ChatClient()
@@ -0,0 +1,95 @@
+# compressor.py
+import os
+import sys
+import threading
+import zlib
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from shared.protocol import COMPRESSIONS, COMPRESSION_ZLIB, COMPRESSION_ZSTD
+from shared.stream_reader import DEFAULT_MAX_FRAME_SIZE
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib is always available
+    zstandard = None
+
+DEFAULT_COMPRESS_THRESHOLD = 256  # Smaller messages are sent as they are
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Preset dictionary shared by every client. Chat messages are too short for
+# a compressor to learn much from a single one; priming it with strings
+# common in pasted logs and JSON lets even a few hundred bytes shrink.
+# Changing it breaks decompression of messages from older clients.
+PRESET_DICTIONARY = (
+    b'Traceback (most recent call last):\n  File "/usr/lib/python3/site-packages/'
+    b'", line , in <module>\n    raise Exception Error: ValueError: KeyError: TypeError: '
+    b'RuntimeError: ConnectionError: TimeoutError: AttributeError: not found failed '
+    b'DEBUG INFO WARNING WARN ERROR CRITICAL FATAL 2024-01-01T00:00:00.000Z 00:00:00,000 '
+    b'GET POST PUT DELETE HTTP/1.1" 200 404 500 https://localhost:8080/api/v1/ '
+    b'null, true, false, "id": "name": "type": "status": "message": "error": "data": '
+    b'"timestamp": "created_at": "updated_at": "user": "username": "email": "value": '
+    b'"items": [{"key": "url": "version": "count": "result": "code": "description": '
+    b'{"type": "message", "sender": "text": "content": "level": "info", "success": '
+    b'    def self, return None\n        if  for  in  import  from  the  and  to  of  is '
+)
+
+def available_compressions():
+    """Compressions this build can produce, in preference order"""
+    return [c for c in COMPRESSIONS if c != COMPRESSION_ZSTD or zstandard is not None]
+
+class Compressor:
+    """Compresses chat plaintext with a preset dictionary, and undoes it
+
+    Safe to share between the send path and the decrypt workers: zlib
+    objects are created per message and zstd contexts are kept per thread.
+    """
+
+    def __init__(self, dictionary=PRESET_DICTIONARY, max_size=DEFAULT_MAX_FRAME_SIZE):
+        self.dictionary = dictionary
+        self.max_size = max_size  # Larger output is refused as a decompression bomb
+        self.local = threading.local()
+        self.zstd_dict = None
+        if zstandard is not None and dictionary:
+            self.zstd_dict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+    def compress(self, data, compression):
+        """Compress data with the named algorithm"""
+        if compression == COMPRESSION_ZLIB:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.dictionary)
+            return compressor.compress(data) + compressor.flush()
+        if compression == COMPRESSION_ZSTD and zstandard is not None:
+            return self._zstd().compress(data)
+        raise ValueError(f"Unsupported compression {compression!r}")
+
+    def decompress(self, data, compression):
+        """Undo compress(), refusing output larger than max_size"""
+        if compression == COMPRESSION_ZLIB:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.dictionary)
+            plaintext = decompressor.decompress(data, self.max_size)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Decompressed message too large")
+            return plaintext
+        if compression == COMPRESSION_ZSTD and zstandard is not None:
+            # max_output_size only bounds frames that leave out their size;
+            # a declared size is allocated as is, so check it first
+            if zstandard.frame_content_size(data) > self.max_size:
+                raise ValueError("Decompressed message too large")
+            return self._zstd_decompressor().decompress(data, max_output_size=self.max_size)
+        raise ValueError(f"Unsupported compression {compression!r}")
+
+    def _zstd(self):
+        compressor = getattr(self.local, 'zstd', None)
+        if compressor is None:
+            # write_content_size lets the receiver bound the output up front
+            compressor = self.local.zstd = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=self.zstd_dict, write_content_size=True
+            )
+        return compressor
+
+    def _zstd_decompressor(self):
+        decompressor = getattr(self.local, 'unzstd', None)
+        if decompressor is None:
+            decompressor = self.local.unzstd = zstandard.ZstdDecompressor(dict_data=self.zstd_dict)
+        return decompressor
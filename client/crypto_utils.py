@@ -1,28 +1,172 @@
 # crypto_utils.py
 import os
 import base64
+import sys
+import threading
+from collections import deque
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
 from cryptography.fernet import Fernet
+from cryptography.exceptions import UnsupportedAlgorithm
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from shared.protocol import CIPHER_SUITES, SUITE_AES_GCM, SUITE_CHACHA20, SUITE_FERNET
+
+RSA_KEY_SIZE = 2048
+BATCH_CHUNK_SIZE = 256
+DEFAULT_KEY_POOL_SIZE = 1
+
+AEAD_SUITES = {
+    SUITE_AES_GCM: AESGCM,
+    SUITE_CHACHA20: ChaCha20Poly1305,
+}
+AEAD_NONCE_SIZE = 12
+
+def generate_private_key(key_size=RSA_KEY_SIZE):
+    """Generate a fresh RSA private key"""
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=key_size,
+        backend=default_backend()
+    )
+
+def supported_suites():
+    """Cipher suites this build of cryptography can run, in preference order"""
+    suites = []
+    for suite in CIPHER_SUITES:
+        cipher_class = AEAD_SUITES.get(suite)
+        if cipher_class:
+            try:
+                cipher_class(bytes(32))
+            except UnsupportedAlgorithm:
+                continue
+        suites.append(suite)
+    return suites
+
+class RSAKeyPool:
+    """Keeps a few RSA key pairs generated ahead of need
+
+    A background thread tops the pool up to `size` keys, so a client that
+    uses a fresh key pair per session takes one instantly instead of paying
+    for key generation on connect. One pool can be shared by many clients.
+    """
+    
+    def __init__(self, size=DEFAULT_KEY_POOL_SIZE, key_size=RSA_KEY_SIZE):
+        self.size = size
+        self.key_size = key_size
+        self.keys = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+        
+    def start(self):
+        """Start generating keys in the background"""
+        with self.cond:
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._fill, daemon=True)
+                self.thread.start()
+        return self
+        
+    def take(self, timeout=None):
+        """Take a pre-generated private key, waiting for one if the pool is empty"""
+        self.start()
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.keys or self.closed, timeout=timeout):
+                raise TimeoutError("No RSA key available")
+            if not self.keys:
+                raise RuntimeError("Key pool closed")
+            private_key = self.keys.popleft()
+            self.cond.notify_all()
+            return private_key
+            
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            
+    def _fill(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or len(self.keys) < self.size)
+                if self.closed:
+                    return
+            private_key = generate_private_key(self.key_size)
+            with self.cond:
+                self.keys.append(private_key)
+                self.cond.notify_all()
+
+_shared_key_pool = None
+_shared_key_pool_lock = threading.Lock()
+
+def shared_key_pool():
+    """The RSAKeyPool clients use unless given a key or pool of their own
+
+    One per process, so its background thread starts with the first key
+    taken and then serves every client.
+    """
+    global _shared_key_pool
+    with _shared_key_pool_lock:
+        if _shared_key_pool is None:
+            _shared_key_pool = RSAKeyPool()
+        return _shared_key_pool
+
+SUPPORTED_SUITES = supported_suites()
 
 class CryptoUtils:
-    def __init__(self):
+    def __init__(self, key_pool=None):
         self.private_key = None
         self.public_key = None
         self.symmetric_key = None
         self.fernet = None
+        self.aead = {}  # suite -> reusable AEAD cipher derived from the room key
+        self.suite = SUITE_FERNET  # Suite used for outgoing messages
+        self.key_pool = key_pool  # Optional RSAKeyPool serving pre-generated keys
         
     def generate_rsa_keys(self):
         """Generate RSA key pair for asymmetric encryption"""
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
+        if self.key_pool:
+            self.private_key = self.key_pool.take()
+        else:
+            self.private_key = generate_private_key()
+        self.public_key = self.private_key.public_key()
+        
+    def save_rsa_keys(self, path, password=None):
+        """Store the private key as PKCS#8 PEM, readable only by the owner"""
+        if password:
+            encryption = serialization.BestAvailableEncryption(password.encode())
+        else:
+            encryption = serialization.NoEncryption()
+        pem = self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=encryption
         )
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(pem)
+            
+    def load_rsa_keys(self, path, password=None):
+        """Load a key pair stored by save_rsa_keys"""
+        with open(path, 'rb') as key_file:
+            self.private_key = serialization.load_pem_private_key(
+                key_file.read(),
+                password=password.encode() if password else None,
+                backend=default_backend()
+            )
         self.public_key = self.private_key.public_key()
         
+    def load_or_generate_rsa_keys(self, path, password=None):
+        """Load the stored key pair, creating and storing one on first use"""
+        if os.path.exists(path):
+            self.load_rsa_keys(path, password)
+        else:
+            self.generate_rsa_keys()
+            self.save_rsa_keys(path, password)
+        
     def get_public_key_pem(self):
         """Get public key in PEM format"""
         return self.public_key.public_bytes(
@@ -42,7 +186,7 @@ class CryptoUtils:
     def generate_symmetric_key(self):
         """Generate symmetric key for AES encryption"""
         self.symmetric_key = Fernet.generate_key()
-        self.fernet = Fernet(self.symmetric_key)
+        self._init_ciphers()
         
     def encrypt_with_public_key(self, data):
         """Encrypt data with RSA public key"""
@@ -74,24 +218,102 @@ class CryptoUtils:
         )
         return decrypted
         
-    def encrypt_message(self, message):
+    def encrypt_message(self, message, suite=None):
         """Encrypt message with symmetric key"""
+        return base64.b64encode(self.encrypt_bytes(message, suite)).decode()
+        
+    def encrypt_bytes(self, message, suite=None):
+        """Encrypt message with symmetric key, returning the raw ciphertext
+
+        Fernet returns its token; the AEAD suites return nonce + ciphertext.
+        """
         if self.fernet is None:
             raise ValueError("Symmetric key not generated")
         if isinstance(message, str):
             message = message.encode()
-        encrypted = self.fernet.encrypt(message)
-        return base64.b64encode(encrypted).decode()
+        suite = suite or self.suite
+        if suite == SUITE_FERNET:
+            return self.fernet.encrypt(message)
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+        return nonce + self._aead(suite).encrypt(nonce, message, None)
         
-    def decrypt_message(self, encrypted_message):
+    def decrypt_message(self, encrypted_message, suite=SUITE_FERNET):
         """Decrypt message with symmetric key"""
+        return self.decrypt_bytes(encrypted_message, suite).decode()
+        
+    def decrypt_bytes(self, encrypted_message, suite=SUITE_FERNET):
+        """Decrypt message with symmetric key, returning the raw plaintext"""
         if self.fernet is None:
             raise ValueError("Symmetric key not generated")
         if isinstance(encrypted_message, str):
             encrypted_message = base64.b64decode(encrypted_message)
-        decrypted = self.fernet.decrypt(encrypted_message)
-        return decrypted.decode()
+        if suite == SUITE_FERNET:
+            return self.fernet.decrypt(encrypted_message)
+        nonce = encrypted_message[:AEAD_NONCE_SIZE]
+        return self._aead(suite).decrypt(nonce, encrypted_message[AEAD_NONCE_SIZE:], None)
         
+    def encrypt_many(self, messages, suite=None, executor=None):
+        """Encrypt a batch of messages, returning raw ciphertexts in order
+
+        With an executor the batch is split into chunks that run in parallel.
+        """
+        return self._map_batch(lambda message: self.encrypt_bytes(message, suite), messages, executor)
+        
+    def decrypt_many(self, encrypted_messages, suites=SUITE_FERNET, executor=None, return_exceptions=False):
+        """Decrypt a batch of messages, returning plaintexts in order
+
+        suites is one suite for the whole batch or one per message. With
+        return_exceptions a message that fails to decrypt yields its
+        exception instead of aborting the batch.
+        """
+        if isinstance(suites, str):
+            suites = [suites] * len(encrypted_messages)
+            
+        def decrypt(item):
+            try:
+                return self.decrypt_message(*item)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+                
+        return self._map_batch(decrypt, list(zip(encrypted_messages, suites)), executor)
+        
+    @staticmethod
+    def _map_batch(func, items, executor):
+        items = list(items)
+        if executor is None or len(items) <= BATCH_CHUNK_SIZE:
+            return [func(item) for item in items]
+        chunks = [items[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(items), BATCH_CHUNK_SIZE)]
+        results = []
+        for chunk_results in executor.map(lambda chunk: [func(item) for item in chunk], chunks):
+            results.extend(chunk_results)
+        return results
+        
+    def _aead(self, suite):
+        cipher = self.aead.get(suite)
+        if cipher is None:
+            raise ValueError(f"Unsupported cipher suite {suite!r}")
+        return cipher
+        
+    def _init_ciphers(self):
+        """Build the reusable cipher objects for the current room key"""
+        self.fernet = Fernet(self.symmetric_key)
+        raw_key = base64.urlsafe_b64decode(self.symmetric_key)
+        self.aead = {}
+        for suite, cipher_class in AEAD_SUITES.items():
+            if suite not in SUPPORTED_SUITES:
+                continue
+            # Independent key per suite, derived from the shared room key
+            suite_key = HKDF(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=None,
+                info=suite.encode(),
+                backend=default_backend()
+            ).derive(raw_key)
+            self.aead[suite] = cipher_class(suite_key)
+            
     def export_symmetric_key(self):
         """Export symmetric key for sharing"""
         return base64.b64encode(self.symmetric_key).decode()
@@ -101,4 +323,4 @@ class CryptoUtils:
         if isinstance(key_data, str):
             key_data = base64.b64decode(key_data)
         self.symmetric_key = key_data
-        self.fernet = Fernet(self.symmetric_key)
\ No newline at end of file
+        self._init_ciphers()
\ No newline at end of file
@@ -2,10 +2,28 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import threading
+from collections import deque
+
+FRAME_INTERVAL_MS = 16  # Queued updates are applied at most once per frame
+DEFAULT_SCROLLBACK = 5000  # Chat lines kept before the oldest are trimmed
 
 class ChatGUI:
-    def __init__(self, client):
+    """Tk chat window
+
+    display_message() and post() may be called from any thread. They only
+    queue work; the Tk thread applies everything queued once per frame,
+    with all new chat lines inserted in one go, so a burst of messages
+    costs one widget update rather than one per message.
+    """
+    
+    def __init__(self, client, scrollback=DEFAULT_SCROLLBACK):
         self.client = client
+        self.scrollback = scrollback
+        self.line_count = 0  # Lines in the chat display
+        self.updates = deque()  # Callables to run on the Tk thread
+        self.pending_lines = deque(maxlen=scrollback)  # Lines not yet shown; older ones would be trimmed anyway
+        self.render_lock = threading.Lock()
+        self.render_scheduled = False
         self.root = tk.Tk()
         self.setup_gui()
         
@@ -155,29 +173,95 @@ class ChatGUI:
         """Send message to server"""
         message = self.message_entry.get().strip()
         if message and self.client.connected:
-            self.client.send_message(message)
+            command, _, argument = message.partition(" ")
+            if command == "/join" and argument.strip():
+                self.client.join_room(argument.strip())
+            elif command == "/leave":
+                self.client.leave_room(argument.strip() or None)
+            else:
+                self.client.send_message(message)
             self.message_entry.delete(0, tk.END)
             
     def display_message(self, sender, message, encrypted=False):
-        """Display message in chat area"""
-        self.chat_display.config(state=tk.NORMAL)
-        
+        """Queue a message for the chat area; shown on the next frame"""
         if encrypted:
-            self.chat_display.insert(tk.END, f"[ENCRYPTED] {sender}: {message}\n")
+            line = f"[ENCRYPTED] {sender}: {message}\n"
+        elif sender == "System":
+            line = f"*** {message} ***\n"
         else:
-            if sender == "System":
-                self.chat_display.insert(tk.END, f"*** {message} ***\n")
-            else:
-                self.chat_display.insert(tk.END, f"{sender}: {message}\n")
-                
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
+            line = f"{sender}: {message}\n"
+            
+        with self.render_lock:
+            self.pending_lines.append(line)
+        self._schedule_render()
+        
+    def post(self, update):
+        """Queue a callable to run on the Tk thread on the next frame"""
+        with self.render_lock:
+            self.updates.append(update)
+        self._schedule_render()
+        
+    def _schedule_render(self):
+        with self.render_lock:
+            if self.render_scheduled:
+                return
+            self.render_scheduled = True
+        self.root.after(FRAME_INTERVAL_MS, self._render)
+        
+    def _render(self):
+        """Apply everything queued since the last frame"""
+        with self.render_lock:
+            self.render_scheduled = False
+            updates, self.updates = self.updates, deque()
+            lines = list(self.pending_lines)
+            self.pending_lines.clear()
+            
+        for update in updates:
+            update()
+        if lines:
+            self._append_lines(lines)
+            
+    def _append_lines(self, lines):
+        """Insert chat lines in one batch and trim the scrollback"""
+        display = self.chat_display
+        # Only follow new lines if the user has not scrolled up to read
+        at_bottom = display.yview()[1] >= 1.0
+        text = "".join(lines)
+        
+        display.config(state=tk.NORMAL)
+        display.insert(tk.END, text)
+        self.line_count += text.count("\n")
+        excess = self.line_count - self.scrollback
+        if excess > 0:
+            display.delete("1.0", f"{excess + 1}.0")
+            self.line_count -= excess
+        display.config(state=tk.DISABLED)
+        
+        if at_bottom:
+            display.yview_moveto(1.0)
         
     def update_users_list(self, users):
-        """Update the online users list"""
-        self.users_listbox.delete(0, tk.END)
+        """Update the online users list, touching only the rows that changed"""
+        listed = self.users_listbox.get(0, tk.END)
+        wanted = set(users)
+        for index in range(len(listed) - 1, -1, -1):
+            if listed[index] not in wanted:
+                self.users_listbox.delete(index)
+        listed = set(listed)
         for user in users:
-            self.users_listbox.insert(tk.END, user)
+            if user not in listed:
+                self.users_listbox.insert(tk.END, user)
+                
+    def add_user(self, username):
+        """Add one user to the online users list"""
+        if username not in self.users_listbox.get(0, tk.END):
+            self.users_listbox.insert(tk.END, username)
+            
+    def remove_user(self, username):
+        """Remove one user from the online users list"""
+        listed = self.users_listbox.get(0, tk.END)
+        if username in listed:
+            self.users_listbox.delete(listed.index(username))
             
     def run(self):
         """Start the GUI"""
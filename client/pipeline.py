@@ -0,0 +1,30 @@
+# pipeline.py
+import asyncio
+import os
+
+MIN_BATCH_SIZE = 16
+
+def default_workers():
+    """Decrypt workers to use by default: none on a single-core host"""
+    cores = os.cpu_count() or 1
+    return min(4, cores) if cores > 1 else 0
+
+def run_batch(batch):
+    """Run (func, args) jobs in order; a job whose func is None is already done and yields args"""
+    return [func(*args) if func else args for func, args in batch]
+
+async def run_in_order(jobs, executor=None, workers=1):
+    """Run a burst of (func, args) jobs and return their results in submission order
+
+    Without an executor the jobs run inline. Otherwise the burst is split
+    into up to `workers` batches of at least MIN_BATCH_SIZE jobs that run
+    in parallel on the executor, so per-job overhead stays low and the
+    results still come back in the order the jobs were queued.
+    """
+    if executor is None:
+        return run_batch(jobs)
+    loop = asyncio.get_running_loop()
+    size = max(MIN_BATCH_SIZE, -(-len(jobs) // max(1, workers)))
+    batches = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    results = await asyncio.gather(*(loop.run_in_executor(executor, run_batch, batch) for batch in batches))
+    return [result for batch_results in results for result in batch_results]
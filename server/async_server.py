@@ -0,0 +1,336 @@
+# async_server.py
+
+import asyncio
+import signal
+import socket
+import threading
+import time
+
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from server import ChatServer
+from shared.protocol import DEFAULT_ROOM
+from shared.stream_reader import FrameReader
+from key_wrap import HandshakeBusy
+from log import get_logger, configure_logging
+from metrics import CONNECTIONS_ACCEPTED, CONNECTIONS_OPEN, HANDSHAKE_SECONDS, FRAMES_DROPPED, QUEUE_DEPTH, BYTES_RECEIVED, BYTES_SENT
+from outbound import (FrameSender, LaneQueue, QueueFullError, check_policy, lane_name, DEFAULT_QUEUE_SIZE, DEFAULT_CONTROL_QUEUE_SIZE,
+                      DEFAULT_BLOCK_TIMEOUT, DROP_OLDEST, BLOCK, DEFAULT_FLUSH_WINDOW, DEFAULT_FLUSH_BYTES)
+
+READ_SIZE = 65536
+
+log = get_logger("async_server")
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class StreamSocket(FrameSender):
+    """Socket-like adapter around an asyncio StreamWriter
+
+    Lets the handshake and UserManager code keep calling sendall()/close()
+    regardless of which engine owns the connection. sendall() only appends
+    to a bounded per-client queue that a writer task drains, so it never
+    blocks the event loop. Since the loop cannot wait, the BLOCK policy
+    lets the queue overrun and drops the client if it is still over its
+    limit after block_timeout. Frames queued within flush_window of the
+    first one, up to flush_bytes, reach the transport as one write.
+    Control frames have their own lane and limit, as in OutboundQueue.
+    """
+
+    def __init__(self, writer, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT,
+                 flush_window=DEFAULT_FLUSH_WINDOW, flush_bytes=DEFAULT_FLUSH_BYTES, control_size=DEFAULT_CONTROL_QUEUE_SIZE):
+        self.writer = writer
+        self.maxsize = maxsize
+        self.control_size = control_size
+        self.policy = check_policy(policy)
+        self.block_timeout = block_timeout
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        self.frames = LaneQueue(maxsize, control_size)
+        self.queued_bytes = 0
+        self.flush_now = False  # An urgent frame is queued
+        self.flush_waiter = None  # Future the writer waits on during a flush window
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.opened_at = self.last_seen = time.monotonic()
+        self.dropped = 0
+        self.overflow_check = None
+        self.wire_lock = threading.Lock()
+        self.task = asyncio.ensure_future(self._write_frames())
+
+    def sendall(self, data, flush=False, flow=None, control=None):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        if self.frames.full(control):
+            dropped = self.frames.drop(control) if self.policy == DROP_OLDEST else None
+            if dropped is not None:
+                self.queued_bytes -= len(dropped)
+                self.dropped += 1
+                FRAMES_DROPPED.inc(lane=lane_name(control))
+            elif self.policy != BLOCK:
+                # DISCONNECT, or nothing in the lane could be dropped
+                self.close_reason = self.close_reason or "queue_full"
+                self.abort()
+                raise QueueFullError("Outbound queue full")
+            elif self.overflow_check is None:
+                loop = asyncio.get_running_loop()
+                self.overflow_check = loop.call_later(self.block_timeout, self._check_overflow)
+        self.frames.append(data, flow, control)
+        self.queued_bytes += len(data)
+        self.flush_now = self.flush_now or flush
+        if self.flush_now or self.queued_bytes >= self.flush_bytes:
+            self._end_flush_window()
+        self.wakeup.set()
+
+    def close(self):
+        """Close once every queued frame has been written"""
+        self.closed = True
+        self._end_flush_window()
+        self.wakeup.set()
+
+    def abort(self):
+        """Close immediately, discarding queued frames"""
+        self.closed = True
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.writer.transport.abort()
+        self._end_flush_window()
+        self.wakeup.set()
+
+    async def _wait_flush_window(self):
+        # Give more frames flush_window to join the batch unless one is urgent
+        if self.closed or self.flush_now or self.queued_bytes >= self.flush_bytes:
+            return
+        loop = asyncio.get_running_loop()
+        self.flush_waiter = loop.create_future()
+        timer = loop.call_later(self.flush_window, self._end_flush_window)
+        try:
+            await self.flush_waiter
+        finally:
+            timer.cancel()
+            self.flush_waiter = None
+
+    def _end_flush_window(self):
+        if self.flush_waiter is not None and not self.flush_waiter.done():
+            self.flush_waiter.set_result(None)
+
+    def _check_overflow(self):
+        self.overflow_check = None
+        if self.frames.overflowing():
+            log.warning("Dropping client whose queue stayed over its limit (%s chat, %s control frames)",
+                        self.maxsize, self.control_size)
+            self.close_reason = self.close_reason or "queue_full"
+            self.abort()
+
+    async def _write_frames(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                if self.flush_window > 0:
+                    await self._wait_flush_window()
+                self.wakeup.clear()
+                batch = []
+                size = 0
+                while self.frames and (not batch or size + len(self.frames.peek()) <= self.flush_bytes):
+                    data = self.frames.popleft()
+                    batch.append(data)
+                    size += len(data)
+                self.queued_bytes -= size
+                self.flush_now = self.flush_now and bool(self.frames)
+                if self.frames:
+                    self.wakeup.set()
+                if batch:
+                    QUEUE_DEPTH.observe(len(batch) + len(self.frames))
+                    self.writer.writelines(batch)
+                    BYTES_SENT.inc(size)
+                await self.writer.drain()
+                if self.closed and not self.frames:
+                    break
+        except (ConnectionError, OSError):
+            self.close_reason = self.close_reason or "write_error"
+            self.closed = True
+            self.frames.clear()
+        finally:
+            if self.overflow_check:
+                self.overflow_check.cancel()
+            self.writer.close()
+
+
+class AsyncChatServer(ChatServer):
+    """Chat server running every connection on a single asyncio event loop
+
+    Speaks exactly the same protocol as ChatServer but uses one coroutine per
+    client instead of one thread, so tens of thousands of idle connections
+    cost a few KiB each rather than a thread stack.
+    """
+
+    def __init__(self, host='localhost', port=8888, backlog=socket.SOMAXCONN, **queue_options):
+        super().__init__(host, port, backlog, **queue_options)
+        self.server = None
+        self.loop = None
+        self.sigterm_stops = False
+        self.handlers = {}  # Connection handler task -> its StreamSocket
+
+    def start(self):
+        """Start the chat server"""
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            log.error("Server error: %s", e)
+        finally:
+            self.stop()
+
+    async def serve(self):
+        """Accept connections until stop() is called"""
+        self.loop = asyncio.get_running_loop()
+        if self.sigterm_stops:
+            self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.key_wrapper.start()
+        self.start_metrics()
+        self.server = await asyncio.start_server(
+            self.handle_client,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port or None
+        )
+        self.running = True
+        liveness = asyncio.ensure_future(self.run_liveness())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            if self.running:
+                raise  # Cancelled by something other than stop()
+        finally:
+            liveness.cancel()
+        await self.close_connections()
+
+    async def close_connections(self):
+        """Drop every client and let its handler finish, rather than leave it to be cancelled"""
+        for client_socket in list(self.handlers.values()):
+            client_socket.abort()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def run_liveness(self):
+        """Sweep the connection deadlines once a tick on the event loop"""
+        while self.running:
+            await asyncio.sleep(self.liveness.wheel.tick)
+            self.check_liveness()
+
+    def stop(self):
+        """Stop the server"""
+        self.running = False
+        if self.server and self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.release_resources()
+        log.info("Server stopped")
+
+    def stop_on_sigterm(self):
+        """Let SIGTERM stop the server like Ctrl+C, handled on the event loop once it runs"""
+        self.sigterm_stops = True
+
+    async def handle_client(self, reader, writer):
+        """Handle individual client connection"""
+        address = writer.get_extra_info('peername')
+        if self.send_buffer:
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        client_socket = StreamSocket(writer, self.queue_size, self.queue_policy, self.queue_timeout,
+                                     self.flush_window, self.flush_bytes, self.control_queue_size)
+        frame_reader = FrameReader(max_frame_size=self.max_frame_size)
+        username = None
+        error = None
+        handler = asyncio.current_task()
+        self.handlers[handler] = client_socket
+        self.liveness.accepted(client_socket)
+        CONNECTIONS_ACCEPTED.inc()
+        CONNECTIONS_OPEN.inc()
+        log.debug("Connection attempt from %s", address)
+
+        try:
+            while self.running and not client_socket.closed:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+
+                BYTES_RECEIVED.inc(len(data))
+                client_socket.last_seen = time.monotonic()
+                frame_reader.feed(data)
+                for record in frame_reader.frames():
+                    username = self.process_client_message(record, client_socket, username, address)
+                    frame_reader.wire = client_socket.wire
+
+        except Exception as e:
+            error = e
+            log.info("Client handling error from %s: %s", address, e)
+        finally:
+            self.liveness.closed(client_socket)
+            if username and client_socket.username:
+                self.handle_disconnect(username)
+
+            client_socket.close()
+            self.record_disconnect(client_socket, error)
+            del self.handlers[handler]
+
+    def start_key_exchange(self, username, client_socket, public_key_pem, cipher_suite=None, room=DEFAULT_ROOM):
+        """Wrap the room key on the pool without blocking the event loop"""
+        started = time.perf_counter()
+        try:
+            future = self.key_wrapper.submit(public_key_pem, self.get_room_key(room))
+        except HandshakeBusy:
+            return self.key_exchange_busy(username, client_socket, room)
+        except Exception as e:
+            self.key_exchange_failed(username, client_socket, e)
+            return True
+
+        asyncio.ensure_future(self._finish_key_exchange(username, client_socket, future, cipher_suite, room, started))
+        return True
+
+    async def _finish_key_exchange(self, username, client_socket, future, cipher_suite, room, started):
+        try:
+            encrypted_key = await asyncio.wrap_future(future)
+        except Exception as e:
+            if not client_socket.closed:
+                self.key_exchange_failed(username, client_socket, e)
+            return
+
+        # Submit to result, so time spent queued for a pool worker counts
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - started, stage="key_wrap")
+
+        # The client may have gone away, or left the room, while the pool was busy
+        if not client_socket.closed and self.user_manager.is_member(username, room):
+            self.finish_key_exchange(username, client_socket, encrypted_key, cipher_suite, room)
+
+
+def raise_fd_limit():
+    """Raise the open file soft limit to the hard limit"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main():
+    configure_logging()
+    server = AsyncChatServer()
+    server.stop_on_sigterm()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        log.info("Shutting down server...")
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,788 @@
+# backplane.py
+
+"""
+Pub/sub backplane joining several server nodes into one chat
+
+Nodes publish broadcast frames and report joins and leaves to a hub. The
+hub relays broadcasts, orders membership changes into versioned presence
+events and hands every node the secret its room keys are derived from.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import ipaddress
+import os
+import socket
+import ssl
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from server import ChatServer
+from async_server import AsyncChatServer
+from user_manager import UserManager
+from tickets import TicketSealer
+from shared.protocol import Frame, Protocol, WIRE_BINARY, DEFAULT_ROOM, USER_JOINED, USER_LEFT
+from shared.stream_reader import FrameReader, MAX_FRAME_LIMIT
+from log import get_logger, configure_logging
+
+log = get_logger("backplane")
+
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+
+# Backplane messages. They travel as binary frames with the generic type
+# code; a BUS_BROADCAST header is always followed by the frame being broadcast.
+BUS_HELLO = "bus_hello"          # node -> hub: register; hub -> node: secret and roster
+BUS_BROADCAST = "bus_broadcast"  # Relayed to every other node
+BUS_JOIN = "bus_join"            # node -> hub: a local user joined a room
+BUS_LEAVE = "bus_leave"          # node -> hub: a local user left a room
+BUS_PRESENCE = "bus_presence"    # hub -> all nodes: ordered, versioned membership change
+BUS_DUPLICATE = "bus_duplicate"  # hub -> node: username is already logged in elsewhere
+
+BUS_MAX_FRAME_SIZE = MAX_FRAME_LIMIT - 1
+HELLO_ROSTER_CHUNK = 1000  # Room members per hello frame; a large roster takes several
+
+# The hub gives every node the secret all room keys come from, so it only
+# listens beyond loopback with a token and TLS
+DEFAULT_HUB_HOST = "127.0.0.1"
+DEFAULT_HUB_PORT = 8899
+
+# Cross-node writes are coalesced for at most DEFAULT_MAX_DELAY seconds,
+# or until DEFAULT_MAX_BATCH bytes are waiting
+DEFAULT_MAX_DELAY = 0.002
+DEFAULT_MAX_BATCH = 64 * 1024
+DEFAULT_MAX_BUFFER = 64 * 1024 * 1024
+
+
+class BackplaneError(ConnectionError):
+    """Raised when a node cannot join the backplane"""
+
+
+def derive_room_key(secret, room):
+    """Fernet key for a room, identical on every node sharing secret"""
+    digest = hmac.new(secret, room.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest)
+
+
+def derive_ticket_key(secret):
+    """Fernet key sealing resumption tickets on every node sharing secret
+
+    Derived from the empty name, which is never a valid room, so it can
+    never equal a room key.
+    """
+    return derive_room_key(secret, "")
+
+
+def is_loopback(host):
+    """True if host only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        try:
+            return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+        except (OSError, ValueError):
+            return False
+
+
+def bus_frame(message):
+    return Frame(message).encode(WIRE_BINARY)
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class BatchWriter:
+    """Coalesces small writes to one socket
+
+    write() only appends. A writer thread sends everything queued in one
+    sendall, waiting at most max_delay for more data once something is
+    queued, so batching adds a bounded amount of latency per hop. Writers
+    block while more than max_buffer bytes are waiting.
+    """
+
+    def __init__(self, sock, max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH, max_buffer=DEFAULT_MAX_BUFFER):
+        self.sock = sock
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.chunks = []
+        self.size = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.size < self.max_buffer)
+            if self.closed:
+                raise ConnectionError("Backplane connection closed")
+            self.chunks.append(data)
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def close(self):
+        """Stop once everything queued has been sent"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.chunks or self.closed)
+                    if not self.chunks:
+                        return
+                    deadline = time.monotonic() + self.max_delay
+                    while self.size < self.max_batch and not self.closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    data = b"".join(self.chunks)
+                    self.chunks = []
+                    self.size = 0
+                    self.cond.notify_all()
+                self.sock.sendall(data)
+        except OSError:
+            with self.cond:
+                self.closed = True
+                self.chunks = []
+                self.cond.notify_all()
+
+
+class BackplaneHub:
+    """Relays broadcasts between nodes and owns the federation-wide roster
+
+    Nodes report joins and leaves; the hub applies them in one order,
+    assigns each room's roster version and announces the change to every
+    node. When a node goes away its users are removed. Peers are objects
+    with a write(data) method that queue bytes for one node.
+    """
+
+    def __init__(self, secret=None, token=None):
+        self.secret = secret or os.urandom(32)
+        self.token = token  # Nodes must present it in their hello when set
+        self.peers = {}    # node id -> peer
+        self.users = {}    # username -> (node id, set of rooms)
+        self.rooms = {}    # room -> set of usernames
+        self.versions = {}  # room -> roster version
+        self.lock = threading.Lock()
+
+    def attach(self, node, peer, token=None):
+        """Register a node; its hello reply is the first thing written to peer
+
+        The reply carries the secret, so the token is checked before anything
+        is written. The node is only registered once the whole reply has been
+        written, so a node whose hello fails never receives relayed traffic.
+        """
+        if self.token is not None and not hmac.compare_digest(str(token or "").encode(), self.token.encode()):
+            raise BackplaneError(f"Node {node} presented a bad token")
+        with self.lock:
+            if node in self.peers:
+                raise BackplaneError(f"Node {node} is already attached")
+            for data in self._hello_frames():
+                peer.write(data)
+            self.peers[node] = peer
+        log.info("Node %s attached to the backplane", node)
+
+    def _hello_frames(self):
+        """The secret and the roster, HELLO_ROSTER_CHUNK members per frame"""
+        # Caller holds the lock
+        members = [(room, username) for room in sorted(self.rooms) for username in sorted(self.rooms[room])]
+        hellos = []
+        for start in range(0, max(len(members), 1), HELLO_ROSTER_CHUNK):
+            rooms = {}
+            for room, username in members[start:start + HELLO_ROSTER_CHUNK]:
+                rooms.setdefault(room, []).append(username)
+            hellos.append({
+                "type": BUS_HELLO,
+                "rooms": rooms,
+                "versions": {room: self.versions[room] for room in rooms},
+                "more": True
+            })
+        hellos[0]["secret"] = base64.b64encode(self.secret).decode()
+        del hellos[-1]["more"]
+        return [bus_frame(hello) for hello in hellos]
+
+    def detach(self, node, peer):
+        """Forget a node and everyone logged in through it"""
+        with self.lock:
+            if self.peers.get(node) is not peer:
+                return
+            del self.peers[node]
+            for username, (owner, rooms) in list(self.users.items()):
+                if owner == node:
+                    for room in sorted(rooms):
+                        self._remove_member(username, room)
+        log.info("Node %s detached from the backplane", node)
+
+    def handle(self, node, message, payload=None):
+        """Process one message from a node; payload is the raw frame of a broadcast"""
+        msg_type = message.get("type")
+        if msg_type == BUS_BROADCAST:
+            self._relay(node, bus_frame(message) + payload)
+        elif msg_type == BUS_JOIN:
+            self._join(node, message["username"], message["room"])
+        elif msg_type == BUS_LEAVE:
+            self._leave(node, message["username"], message["room"])
+
+    def _relay(self, origin, data):
+        with self.lock:
+            for node, peer in self.peers.items():
+                if node != origin:
+                    self._send(peer, data)
+
+    def _join(self, node, username, room):
+        with self.lock:
+            owner, rooms = self.users.get(username, (node, set()))
+            if owner != node:
+                self._send(self.peers.get(node), bus_frame({"type": BUS_DUPLICATE, "username": username}))
+                return
+            if room in rooms:
+                return
+            rooms.add(room)
+            self.users[username] = (owner, rooms)
+            self.rooms.setdefault(room, set()).add(username)
+            self._announce(USER_JOINED, username, room)
+
+    def _leave(self, node, username, room):
+        with self.lock:
+            owner, rooms = self.users.get(username, (None, ()))
+            if owner == node and room in rooms:
+                self._remove_member(username, room)
+
+    def _remove_member(self, username, room):
+        # Caller holds the lock
+        owner, rooms = self.users[username]
+        rooms.discard(room)
+        if not rooms:
+            del self.users[username]
+        members = self.rooms[room]
+        members.discard(username)
+        self._announce(USER_LEFT, username, room)
+        if not members:
+            del self.rooms[room]
+            del self.versions[room]
+
+    def _announce(self, msg_type, username, room):
+        # Caller holds the lock, so every node sees changes in the same order
+        version = self.versions.get(room, 0) + 1
+        self.versions[room] = version
+        data = bus_frame({
+            "type": BUS_PRESENCE,
+            "presence": msg_type,
+            "username": username,
+            "room": room,
+            "version": version
+        })
+        for peer in self.peers.values():
+            self._send(peer, data)
+
+    def _send(self, peer, data):
+        if peer is None:
+            return
+        try:
+            peer.write(data)
+        except ConnectionError:
+            pass  # Its connection is going away and will detach
+
+
+class BackplaneServer(BackplaneHub):
+    """BackplaneHub that nodes reach over TCP, or a Unix socket when address is a path"""
+
+    def __init__(self, address, secret=None, token=None, ssl_context=None,
+                 max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH):
+        super().__init__(secret, token)
+        self.address = address
+        self.ssl_context = ssl_context
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.socket = None
+
+    def start(self):
+        """Listen for nodes in the background
+
+        A TCP address other than loopback is refused unless nodes must
+        present a token over TLS: the hello hands out the secret every room
+        key is derived from.
+        """
+        if not isinstance(self.address, str) and not is_loopback(self.address[0]):
+            if self.token is None or self.ssl_context is None:
+                raise ValueError(f"Refusing to serve the backplane on {self.address[0]} without a token and TLS")
+        if isinstance(self.address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen()
+        self.address = self.socket.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        node = None
+        peer = None
+        header = None  # BUS_BROADCAST waiting for its frame
+        try:
+            if self.ssl_context:
+                conn = self.ssl_context.wrap_socket(conn, server_side=True)
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = FrameReader(WIRE_BINARY, BUS_MAX_FRAME_SIZE)
+            while reader.recv_into(conn):
+                for record in reader.frames():
+                    if header is not None:
+                        self.handle(node, header, bytes(record))
+                        header = None
+                        continue
+                    message = Protocol.decode(record, WIRE_BINARY)
+                    if node is None:
+                        # Nothing is relayed until the hello has passed the token check
+                        if message.get("type") != BUS_HELLO:
+                            raise BackplaneError(f"Connection sent {message.get('type')} before a hello")
+                        peer = BatchWriter(conn, self.max_delay, self.max_batch)
+                        self.attach(message["node"], peer, message.get("token"))
+                        node = message["node"]
+                    elif message.get("type") == BUS_BROADCAST:
+                        header = message
+                    else:
+                        self.handle(node, message)
+        except (OSError, ValueError) as e:
+            log.warning("Backplane connection to node %s failed: %s", node, e)
+        finally:
+            if node is not None:
+                self.detach(node, peer)
+            if peer is not None:
+                peer.close()
+                peer.thread.join()
+            conn.close()
+
+
+class Backplane(ABC):
+    """One node's connection to the backplane
+
+    connect() blocks until the hub's hello arrives with the secret room keys
+    are derived from and the current roster. After start(handler), every
+    later message is passed to handler(message, frame) on a background
+    thread; frame is the broadcast Frame for BUS_BROADCAST and None otherwise.
+    """
+
+    def __init__(self, node=None, token=None):
+        self.node = default_node_id() if node is None else node
+        self.token = token
+        self.reader = FrameReader(WIRE_BINARY, BUS_MAX_FRAME_SIZE)
+        self.header = None
+        self.handler = None
+        self.secret = None
+        self.rooms = {}
+        self.versions = {}
+
+    @abstractmethod
+    def connect(self):
+        pass
+
+    @abstractmethod
+    def start(self, handler):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def write(self, data):
+        pass
+
+    def send(self, message, frame=None):
+        data = bus_frame(message)
+        if frame is not None:
+            data += frame.encode(WIRE_BINARY)
+        self.write(data)
+
+    def publish(self, frame, exclude_user=None, room=None):
+        """Hand a broadcast to the other nodes"""
+        self.send({"type": BUS_BROADCAST, "exclude": exclude_user, "room": room}, frame)
+
+    def _hello(self):
+        message = {"type": BUS_HELLO, "node": self.node}
+        if self.token is not None:
+            message["token"] = self.token
+        return message
+
+    def _accept_hello(self, hello):
+        """Take in one part of the hub's hello; True once the last part is in"""
+        if "secret" in hello:
+            self.secret = base64.b64decode(hello["secret"])
+        for room, members in hello["rooms"].items():
+            self.rooms.setdefault(room, []).extend(members)
+        self.versions.update(hello["versions"])
+        return not hello.get("more")
+
+    def _dispatch(self, record):
+        if self.header is not None:
+            header, self.header = self.header, None
+            self.handler(header, Frame.from_binary(record))
+            return
+        message = Protocol.decode(record, WIRE_BINARY)
+        if message.get("type") == BUS_BROADCAST:
+            self.header = message
+        else:
+            self.handler(message, None)
+
+
+class LoopbackBackplane(Backplane):
+    """In-process backplane: every node shares one BackplaneHub object
+
+    Messages still go through the binary encoding, so several servers in
+    one process behave exactly like nodes on a real backplane.
+    """
+
+    def __init__(self, hub, node=None, token=None):
+        super().__init__(node, token)
+        self.hub = hub
+        self.inbox = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def connect(self):
+        self.hub.attach(self.node, self, self.token)
+        while True:
+            # attach() has queued the whole hello, one part per write
+            with self.cond:
+                data = self.inbox.popleft()
+            self.reader.feed(data)
+            for record in self.reader.frames():
+                if self._accept_hello(Protocol.decode(record, WIRE_BINARY)):
+                    return self
+
+    def start(self, handler):
+        self.handler = handler
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def close(self):
+        self.hub.detach(self.node, self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def write(self, data):
+        """Called by the hub: queue data for this node"""
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("Backplane connection closed")
+            self.inbox.append(data)
+            self.cond.notify_all()
+
+    def send(self, message, frame=None):
+        payload = frame.encode(WIRE_BINARY) if frame is not None else None
+        self.hub.handle(self.node, message, payload)
+
+    def _deliver(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.inbox or self.closed)
+                if self.closed:
+                    return
+                data = self.inbox.popleft()
+            self.reader.feed(data)
+            for record in self.reader.frames():
+                self._dispatch(record)
+
+
+class SocketBackplane(Backplane):
+    """Backplane connection to a BackplaneServer over a stream socket"""
+
+    def __init__(self, address, node=None, token=None, ssl_context=None,
+                 max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH):
+        super().__init__(node, token)
+        self.address = address
+        self.ssl_context = ssl_context
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.socket = None
+        self.writer = None
+
+    def connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+        else:
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.ssl_context:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.address[0])
+        self.socket = sock
+        self.writer = BatchWriter(sock, self.max_delay, self.max_batch)
+        self.send(self._hello())
+        while True:
+            if not self.reader.recv_into(sock):
+                raise BackplaneError("Backplane closed during hello")
+            for record in self.reader.frames():
+                if self._accept_hello(Protocol.decode(record, WIRE_BINARY)):
+                    return self
+
+    def start(self, handler):
+        self.handler = handler
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer.thread.join()
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def _read(self):
+        try:
+            while True:
+                # Records that arrived with the hello are handled before reading more
+                for record in self.reader.frames():
+                    self._dispatch(record)
+                if not self.reader.recv_into(self.socket):
+                    break
+        except (OSError, ValueError) as e:
+            log.error("Backplane error: %s", e)
+        log.error("Lost connection to the backplane")
+
+
+class UnixBackplane(SocketBackplane):
+    """Backplane connection over a local Unix socket"""
+
+    def __init__(self, path, node=None, token=None, **options):
+        super().__init__(path, node, token, **options)
+
+
+class TcpBackplane(SocketBackplane):
+    """Backplane connection over TCP"""
+
+    def __init__(self, host, port, node=None, token=None, **options):
+        super().__init__((host, port), node, token, **options)
+
+
+class FederatedUserManager(UserManager):
+    """UserManager for one node of a federation
+
+    Sockets and room membership stay local to the node that owns the
+    connection. Broadcasts are also published on the backplane, and rosters
+    and their versions come from the hub, which sees every node's joins
+    and leaves.
+    """
+
+    def __init__(self, backplane, dispatch):
+        super().__init__()
+        self.backplane = backplane
+        self.dispatch = dispatch  # Runs backplane callbacks where the engine expects them
+        self.on_relay = None  # Called with (frame, room) for each broadcast from another node
+        self.roster = {room: set(members) for room, members in backplane.rooms.items()}
+        self.roster_versions = dict(backplane.versions)
+
+    def add_user(self, username, socket, public_key):
+        """Add a new user, refusing names already online on another node"""
+        with self.lock:
+            if username in self.roster.get(DEFAULT_ROOM, ()):
+                return False
+        return super().add_user(username, socket, public_key)
+
+    def get_roster(self, room):
+        """Get a room's federation-wide roster version and members
+
+        Local members are always included: a user's own join may still be
+        on its way back from the hub when their snapshot is taken.
+        """
+        with self.lock:
+            members = self.roster.get(room, set()) | self.rooms.get(room, set())
+            return self.roster_versions.get(room, 0), sorted(members)
+
+    def broadcast(self, message, exclude_user=None, room=None):
+        """Broadcast to local users and to every other node"""
+        frame = message if isinstance(message, Frame) else Frame.from_text(message)
+        try:
+            self.backplane.publish(frame, exclude_user, room)
+        except ConnectionError as e:
+            log.warning("Backplane publish failed: %s", e)
+        return super().broadcast(frame, exclude_user, room)
+
+    def broadcast_presence(self, msg_type, username, room, version):
+        """Report a local join/leave to the hub, which versions and announces it"""
+        try:
+            self.backplane.send({
+                "type": BUS_JOIN if msg_type == USER_JOINED else BUS_LEAVE,
+                "username": username,
+                "room": room
+            })
+        except ConnectionError as e:
+            log.warning("Backplane publish failed: %s", e)
+
+    def broadcast_departures(self, room, usernames):
+        """Report each leave to the hub, which versions and announces them"""
+        for username in usernames:
+            self.broadcast_presence(USER_LEFT, username, room, 0)
+
+    def handle_backplane_message(self, message, frame):
+        """Backplane reader callback"""
+        msg_type = message.get("type")
+        if msg_type == BUS_BROADCAST:
+            self.dispatch(self.relay, frame, message.get("exclude"), message.get("room"))
+        elif msg_type == BUS_PRESENCE:
+            self.dispatch(self.apply_presence, message)
+        elif msg_type == BUS_DUPLICATE:
+            self.dispatch(self.evict, message["username"])
+
+    def relay(self, frame, exclude_user, room):
+        """Deliver another node's broadcast to local users"""
+        super().broadcast(frame, exclude_user, room)
+        if self.on_relay:
+            self.on_relay(frame, room)
+            
+    def apply_presence(self, message):
+        """Apply a hub-ordered membership change and tell local members"""
+        room = message["room"]
+        username = message["username"]
+        with self.lock:
+            members = self.roster.setdefault(room, set())
+            self.roster_versions[room] = message["version"]
+            if message["presence"] == USER_JOINED:
+                members.add(username)
+            else:
+                members.discard(username)
+                if not members:
+                    del self.roster[room]
+                    del self.roster_versions[room]
+        # The user's own node delivers it to them too, so a snapshot taken
+        # before the hub's echo still catches up to this version
+        frame = self.presence_frame(message["presence"], username, room, message["version"])
+        super().broadcast(frame, room=room)
+
+    def evict(self, username):
+        """Drop a local login the hub found was already online elsewhere"""
+        session = self.get_user(username)
+        if session is None:
+            return
+        # Removed quietly: the hub never announced this login
+        super().remove_user(username)
+        try:
+            session.socket.send_frame(Frame({
+                "type": "system",
+                "message": "Username already taken"
+            }))
+        except Exception:
+            pass
+        session.socket.close()
+
+
+class FederationMixin:
+    """Turns a server engine into one node on a backplane"""
+
+    def __init__(self, backplane, *args, **kwargs):
+        self.backplane = backplane
+        super().__init__(*args, **kwargs)
+        self.user_manager = FederatedUserManager(backplane, self.dispatch)
+        self.user_manager.on_relay = self.record_relayed
+        self.symmetric_key = self.room_keys[DEFAULT_ROOM] = self.new_room_key(DEFAULT_ROOM)
+
+    def new_room_key(self, room):
+        """Room keys are derived from the backplane secret so every node agrees"""
+        return derive_room_key(self.backplane.secret, room)
+
+    def new_ticket_sealer(self, lifetime):
+        """Any node can resume a session another node started"""
+        return TicketSealer(lifetime, derive_ticket_key(self.backplane.secret))
+
+    def record_relayed(self, frame, room):
+        """Keep other nodes' chat messages in this node's history too"""
+        if frame.type == "message" and frame.message.get("encrypted"):
+            self.record_history(room or DEFAULT_ROOM, frame)
+
+    def dispatch(self, callback, *args):
+        callback(*args)
+
+
+class FederatedChatServer(FederationMixin, ChatServer):
+    """Threaded server node"""
+
+
+class AsyncFederatedChatServer(FederationMixin, AsyncChatServer):
+    """asyncio server node; backplane callbacks run on the event loop"""
+
+    def dispatch(self, callback, *args):
+        loop = self.loop
+        if loop is None:
+            callback(*args)
+        else:
+            loop.call_soon_threadsafe(callback, *args)
+
+
+ENGINES = {
+    ENGINE_THREADS: FederatedChatServer,
+    ENGINE_ASYNCIO: AsyncFederatedChatServer,
+}
+
+
+def join_backplane(backplane, engine=ENGINE_THREADS, *args, **kwargs):
+    """Connect to the backplane and build a server node on it"""
+    backplane.connect()
+    server = ENGINES[engine](backplane, *args, **kwargs)
+    backplane.start(server.user_manager.handle_backplane_message)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Standalone backplane hub")
+    parser.add_argument('port', nargs='?', type=int, default=DEFAULT_HUB_PORT)
+    parser.add_argument('token', nargs='?', help='nodes must present this token')
+    parser.add_argument('--host', default=DEFAULT_HUB_HOST,
+                        help='address to listen on; anything but loopback needs a token and --certfile')
+    parser.add_argument('--certfile', help='PEM certificate chain for TLS')
+    parser.add_argument('--keyfile', help='PEM private key, if not in --certfile')
+    args = parser.parse_args()
+    
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+    configure_logging()
+    try:
+        hub = BackplaneServer((args.host, args.port), token=args.token, ssl_context=ssl_context).start()
+    except ValueError as e:
+        parser.error(str(e))
+    log.info("Backplane listening on %s:%s", args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        log.info("Shutting down backplane...")
+        hub.close()
+
+if __name__ == "__main__":
+    main()
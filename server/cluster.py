@@ -0,0 +1,101 @@
+# cluster.py
+
+"""
+Multi-process server: worker processes share one port via SO_REUSEPORT and
+exchange broadcasts and presence over a local Unix-socket backplane
+"""
+
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backplane import BackplaneServer, UnixBackplane, join_backplane, ENGINES, ENGINE_THREADS
+from log import get_logger, configure_logging
+
+log = get_logger("cluster")
+
+
+def run_worker(worker, bus_path, host, port, engine, server_options):
+    """Entry point of a worker process"""
+    # Every worker is already its own process, so wrap keys inline by default
+    server_options = dict(server_options)
+    server_options.setdefault('handshake_workers', 0)
+    # Metrics are per process, so each worker serves them on its own port
+    if server_options.get('metrics_port'):
+        server_options['metrics_port'] += worker
+    configure_logging()
+    server = join_backplane(UnixBackplane(bus_path, worker), engine, host, port, reuse_port=True, **server_options)
+    server.stop_on_sigterm()  # The supervisor stops workers with terminate()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+class ClusterSupervisor:
+    """Starts worker processes that accept on the same port
+
+    The kernel spreads incoming connections across the workers'
+    SO_REUSEPORT listeners. The supervisor itself only runs the backplane hub.
+    """
+
+    def __init__(self, workers=None, host='localhost', port=8888, engine=ENGINE_THREADS, **server_options):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("SO_REUSEPORT is not available on this platform")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {tuple(ENGINES)}")
+        self.workers = workers or os.cpu_count() or 1
+        self.host = host
+        self.port = port
+        self.engine = engine
+        self.server_options = server_options
+        self.bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+        self.hub = BackplaneServer(os.path.join(self.bus_dir, 'bus.sock'))
+        self.processes = []
+
+    def start(self):
+        """Run the workers until they all exit"""
+        self.hub.start()
+        context = multiprocessing.get_context('spawn')
+        for worker in range(self.workers):
+            process = context.Process(
+                target=run_worker,
+                args=(worker, self.hub.address, self.host, self.port, self.engine, self.server_options),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+        log.info("Cluster of %s %s workers on %s:%s", self.workers, self.engine, self.host, self.port)
+        try:
+            for process in self.processes:
+                process.join()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        self.hub.close()
+        shutil.rmtree(self.bus_dir, ignore_errors=True)
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    engine = sys.argv[2] if len(sys.argv) > 2 else ENGINE_THREADS
+    configure_logging()
+    supervisor = ClusterSupervisor(workers, engine=engine)
+    try:
+        supervisor.start()
+    except KeyboardInterrupt:
+        log.info("Shutting down cluster...")
+        supervisor.stop()
+
+if __name__ == "__main__":
+    main()
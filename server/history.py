@@ -0,0 +1,370 @@
+# history.py
+
+"""
+Append-only, segmented chat history with a sparse index per room
+"""
+
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from shared.protocol import BINARY_HEADER, WIRE_BINARY
+from log import get_logger
+
+log = get_logger("history")
+
+# A segment file is a header followed by binary wire frames back to back,
+# so a run of history is already in the form a binary client reads.
+SEGMENT_HEADER = struct.Struct('!4sQd8s')  # magic, first seq, created, room key tag
+SEGMENT_MAGIC = b'CHL2'  # CHL1 segments hold frames with a u16 meta length
+INDEX_ENTRY = struct.Struct('!QQ')  # seq, offset of that frame in the segment
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 4096  # Bytes of frames between sparse index entries
+DEFAULT_RETENTION_BYTES = 256 * 1024 * 1024  # Per room
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+RETENTION_CHECK_INTERVAL = 60.0
+DEFAULT_MAX_OPEN_ROOMS = 256  # Room logs kept open; each holds its segments' files and maps
+
+
+def key_tag(room_key):
+    """Short tag naming the room key a segment's ciphertext is encrypted with"""
+    return hashlib.sha256(room_key).digest()[:8]
+
+
+class Segment:
+    """One log file plus its sparse seq -> offset index"""
+
+    def __init__(self, path, base_seq, created, tag):
+        self.path = path
+        self.index_path = path[:-len('.log')] + '.idx'
+        self.base_seq = base_seq
+        self.created = created
+        self.tag = tag
+        self.next_seq = base_seq
+        self.size = SEGMENT_HEADER.size
+        self.index_seqs = [base_seq]
+        self.index_offsets = [SEGMENT_HEADER.size]
+        self.indexed_at = SEGMENT_HEADER.size
+        self.file = None
+        self.index_file = None
+        self.map = None  # Cached mmap once the segment is sealed
+
+    @classmethod
+    def create(cls, directory, base_seq, tag):
+        segment = cls(os.path.join(directory, f"{base_seq:020d}.log"), base_seq, time.time(), tag)
+        segment.file = open(segment.path, 'xb')
+        segment.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, base_seq, segment.created, tag))
+        segment.file.flush()
+        segment.index_file = open(segment.index_path, 'wb')
+        return segment
+
+    @classmethod
+    def load(cls, path):
+        """Open an existing segment, dropping a partly written last frame"""
+        with open(path, 'rb') as f:
+            magic, base_seq, created, tag = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a history segment")
+        segment = cls(path, base_seq, created, tag)
+        file_size = os.path.getsize(path)
+
+        # Persisted index entries, ignoring any that point past the data
+        if os.path.exists(segment.index_path):
+            with open(segment.index_path, 'rb') as f:
+                data = f.read()
+            for seq, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                if offset < file_size and seq > segment.index_seqs[-1]:
+                    segment.index_seqs.append(seq)
+                    segment.index_offsets.append(offset)
+
+        # Walk the frames after the last index entry to find the end
+        seq, offset = segment.index_seqs[-1], segment.index_offsets[-1]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        position = 0
+        while len(tail) - position >= BINARY_HEADER.size:
+            size = BINARY_HEADER.size + BINARY_HEADER.unpack_from(tail, position)[0]
+            if len(tail) - position < size:
+                break
+            position += size
+            seq += 1
+        segment.next_seq = seq
+        segment.size = offset + position
+        segment.indexed_at = segment.index_offsets[-1]
+        if segment.size < file_size:
+            os.truncate(path, segment.size)
+        return segment
+
+    def open_for_append(self):
+        self.file = open(self.path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        # Rewrite the index so it matches what load() kept
+        self.index_file.truncate(0)
+        for seq, offset in zip(self.index_seqs[1:], self.index_offsets[1:]):
+            self.index_file.write(INDEX_ENTRY.pack(seq, offset))
+        self.index_file.flush()
+
+    def append(self, data):
+        seq = self.next_seq
+        if self.size - self.indexed_at >= DEFAULT_INDEX_INTERVAL and seq != self.index_seqs[-1]:
+            self.index_seqs.append(seq)
+            self.index_offsets.append(self.size)
+            self.indexed_at = self.size
+            self.index_file.write(INDEX_ENTRY.pack(seq, self.size))
+            self.index_file.flush()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.next_seq += 1
+        return seq
+
+    def seal(self):
+        """Stop appending; later reads use a cached mmap"""
+        for f in (self.file, self.index_file):
+            if f:
+                f.close()
+        self.file = self.index_file = None
+
+    def read_from(self, seq):
+        """All frames from seq to the end of the segment, in one contiguous read"""
+        seq = max(seq, self.base_seq)
+        if seq >= self.next_seq:
+            return b""
+        mapped = self.map
+        if mapped is None:
+            with open(self.path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            if self.file is None:
+                self.map = mapped
+
+        # O(log n) seek through the sparse index, then a short walk
+        slot = bisect.bisect_right(self.index_seqs, seq) - 1
+        position, current = self.index_offsets[slot], self.index_seqs[slot]
+        while current < seq:
+            position += BINARY_HEADER.size + BINARY_HEADER.unpack_from(mapped, position)[0]
+            current += 1
+        data = mapped[position:self.size]
+        if mapped is not self.map:
+            mapped.close()
+        return data
+
+    def delete(self):
+        self.seal()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class RoomLog:
+    """History of one room: a list of segments, the newest one active"""
+
+    def __init__(self, directory, segment_size, retention_bytes, retention_seconds):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.checked_at = time.monotonic()
+        self.users = 0  # HistoryLog calls in progress; only an unused log is closed
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                self._load_segment(os.path.join(directory, name))
+        if self.segments:
+            self.segments[-1].open_for_append()
+        self.enforce_retention()
+
+    def _load_segment(self, path):
+        try:
+            self.segments.append(Segment.load(path))
+        except ValueError as e:
+            # Another format's frames cannot be replayed, and its name may be reused
+            log.warning("Discarding history segment: %s", e)
+            Segment(path, 0, 0, b"").delete()
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].next_seq if self.segments else 0
+
+    def append(self, data, tag):
+        """Append one encoded frame, returning its sequence number"""
+        with self.lock:
+            active = self.segments[-1] if self.segments else None
+            if active is None or active.tag != tag or active.size + len(data) > self.segment_size:
+                if active is not None and active.next_seq == active.base_seq:
+                    # Never written to; its name is about to be reused
+                    active.delete()
+                    self.segments.pop()
+                elif active is not None:
+                    active.seal()
+                self.segments.append(Segment.create(self.directory, self.next_seq, tag))
+                self._enforce_retention()
+            elif time.monotonic() - self.checked_at >= RETENTION_CHECK_INTERVAL:
+                self._enforce_retention()
+            return self.segments[-1].append(data)
+
+    def read_since(self, seq, tag):
+        """Frames with sequence number >= seq that were encrypted under tag"""
+        with self.lock:
+            first = self._first_readable(tag)
+            if first is None:
+                return b""
+            start = bisect.bisect_right([s.base_seq for s in self.segments], seq) - 1
+            start = max(start, first)
+            return b"".join(segment.read_from(seq) for segment in self.segments[start:])
+
+    def read_last(self, count, tag):
+        """The last count frames encrypted under tag"""
+        with self.lock:
+            first = self._first_readable(tag)
+            if first is None or count <= 0:
+                return b""
+            seq = max(self.next_seq - count, self.segments[first].base_seq)
+            return b"".join(segment.read_from(seq) for segment in self.segments[first:])
+
+    def _first_readable(self, tag):
+        # Index of the oldest segment in the newest run written under tag
+        first = None
+        for position in range(len(self.segments) - 1, -1, -1):
+            if self.segments[position].tag != tag:
+                break
+            first = position
+        return first
+
+    def enforce_retention(self):
+        with self.lock:
+            self._enforce_retention()
+
+    def _enforce_retention(self):
+        # Only whole sealed segments are dropped, oldest first
+        self.checked_at = time.monotonic()
+        cutoff = time.time() - self.retention_seconds if self.retention_seconds else None
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retention_bytes and total > self.retention_bytes
+            too_old = cutoff is not None and os.path.getmtime(oldest.path) < cutoff
+            if not (too_big or too_old):
+                break
+            total -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.seal()
+                if segment.map is not None:
+                    segment.map.close()
+                    segment.map = None
+
+
+class HistoryLog:
+    """Per-room append-only history of relayed chat frames
+
+    Frames are stored in their binary wire encoding, in segment files that
+    roll over at segment_size or whenever the room key changes. Segments
+    are dropped once a room's history exceeds retention_bytes or a segment
+    has not been written for retention_seconds. Reads only return history
+    encrypted under the given room key, since nothing older can be read by
+    the clients it would go to.
+
+    Only the max_open_rooms most recently used rooms keep their files open;
+    the others are closed and reloaded from disk when next used.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retention_bytes=DEFAULT_RETENTION_BYTES, retention_seconds=DEFAULT_RETENTION_SECONDS,
+                 max_open_rooms=DEFAULT_MAX_OPEN_ROOMS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.max_open_rooms = max_open_rooms
+        self.rooms = OrderedDict()  # room -> RoomLog, least recently used first
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, room, frame, room_key):
+        """Record a Frame; returns its sequence number within the room"""
+        log = self._open(room)
+        try:
+            return log.append(frame.encode(WIRE_BINARY), key_tag(room_key))
+        finally:
+            self._release(log)
+
+    def read_since(self, room, seq, room_key):
+        """Concatenated binary frames of the room from seq on"""
+        log = self._open(room)
+        try:
+            return log.read_since(seq, key_tag(room_key))
+        finally:
+            self._release(log)
+
+    def read_last(self, room, count, room_key):
+        """Concatenated binary frames of the room's last count messages"""
+        log = self._open(room)
+        try:
+            return log.read_last(count, key_tag(room_key))
+        finally:
+            self._release(log)
+
+    def close(self):
+        with self.lock:
+            for log in self.rooms.values():
+                log.close()
+            self.rooms.clear()
+
+    def _open(self, room):
+        """The room's log, marked in use until _release()"""
+        with self.lock:
+            log = self.rooms.get(room)
+            if log is None:
+                # Room names may contain anything, so directories are named by hash
+                name = hashlib.sha256(room.encode()).hexdigest()[:32]
+                log = self.rooms[room] = RoomLog(
+                    os.path.join(self.directory, name),
+                    self.segment_size,
+                    self.retention_bytes,
+                    self.retention_seconds
+                )
+            else:
+                self.rooms.move_to_end(room)
+            log.users += 1
+            self._evict()
+            return log
+
+    def _release(self, log):
+        with self.lock:
+            log.users -= 1
+            self._evict()
+
+    def _evict(self):
+        # Caller holds the lock; a log in use is skipped and closed on a later call
+        excess = len(self.rooms) - self.max_open_rooms
+        if excess <= 0:
+            return
+        for room, log in list(self.rooms.items()):
+            if excess <= 0:
+                break
+            if log.users == 0:
+                log.close()
+                del self.rooms[room]
+                excess -= 1
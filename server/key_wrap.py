@@ -0,0 +1,153 @@
+# key_wrap.py
+
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.backends import default_backend
+
+from metrics import KEY_WRAP_CACHE
+
+DEFAULT_MAX_PENDING = 256
+DEFAULT_ADMISSION_TIMEOUT = 5.0
+DEFAULT_CACHE_SIZE = 4096
+
+# Parsed public keys, per process (each pool worker keeps its own)
+_parsed_keys = OrderedDict()
+_parsed_keys_lock = threading.Lock()
+
+
+class HandshakeBusy(Exception):
+    """Raised when too many handshakes are already waiting for the pool"""
+
+
+def fingerprint(public_key_pem):
+    """Stable identifier for a client's public key"""
+    if isinstance(public_key_pem, str):
+        public_key_pem = public_key_pem.encode()
+    return hashlib.sha256(public_key_pem.strip()).hexdigest()
+
+
+def wrap_key(key_fingerprint, public_key_pem, symmetric_key, cache_size=DEFAULT_CACHE_SIZE):
+    """Encrypt symmetric_key with the client's RSA public key (RSA-OAEP)
+
+    Runs inside a pool worker, so it must stay a picklable top-level function.
+    """
+    with _parsed_keys_lock:
+        public_key = _parsed_keys.get(key_fingerprint)
+        if public_key is not None:
+            _parsed_keys.move_to_end(key_fingerprint)
+    if public_key is None:
+        if isinstance(public_key_pem, str):
+            public_key_pem = public_key_pem.encode()
+        public_key = serialization.load_pem_public_key(public_key_pem, backend=default_backend())
+        with _parsed_keys_lock:
+            _parsed_keys[key_fingerprint] = public_key
+            while len(_parsed_keys) > cache_size:
+                _parsed_keys.popitem(last=False)
+
+    return public_key.encrypt(
+        symmetric_key,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+
+
+class KeyWrapper:
+    """Wraps room keys for new clients on a bounded process pool
+
+    RSA work runs on a pool of worker processes so a reconnect storm uses
+    every core instead of stalling connection threads or the event loop.
+    At most max_pending wraps may be queued; beyond that, callers wait up to
+    their timeout for a slot and then get HandshakeBusy. Wrapped keys are
+    cached by (public key fingerprint, room key), so a client reconnecting
+    with the same key pair skips both the PEM parse and the encryption.
+
+    With workers=0 the wrap runs inline in the caller.
+    """
+
+    def __init__(self, workers=None, max_pending=DEFAULT_MAX_PENDING, cache_size=DEFAULT_CACHE_SIZE):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.cache_size = cache_size
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """Start the worker processes ahead of the first handshake"""
+        with self.lock:
+            if self.pool is None and self.workers:
+                # spawn avoids forking a process that already runs threads
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, public_key_pem, symmetric_key, timeout=0):
+        """Start wrapping symmetric_key for a client; returns a Future of the ciphertext"""
+        key_fingerprint = fingerprint(public_key_pem)
+        cache_key = (key_fingerprint, symmetric_key)
+        with self.lock:
+            encrypted_key = self.cache.get(cache_key)
+            if encrypted_key is not None:
+                self.cache.move_to_end(cache_key)
+                self.hits += 1
+                KEY_WRAP_CACHE.inc(result="hit")
+        if encrypted_key is not None:
+            future = Future()
+            future.set_result(encrypted_key)
+            return future
+
+        if timeout:
+            admitted = self.slots.acquire(timeout=timeout)
+        else:
+            admitted = self.slots.acquire(blocking=False)
+        if not admitted:
+            raise HandshakeBusy("Too many handshakes in progress")
+        self.misses += 1
+        KEY_WRAP_CACHE.inc(result="miss")
+
+        try:
+            if self.workers:
+                self.start()
+                future = self.pool.submit(wrap_key, key_fingerprint, public_key_pem, symmetric_key, self.cache_size)
+            else:
+                future = Future()
+                future.set_result(wrap_key(key_fingerprint, public_key_pem, symmetric_key, self.cache_size))
+        except BaseException:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda done: self._finished(cache_key, done))
+        return future
+
+    def wrap(self, public_key_pem, symmetric_key, timeout=DEFAULT_ADMISSION_TIMEOUT):
+        """Wrap symmetric_key for a client, blocking until done"""
+        return self.submit(public_key_pem, symmetric_key, timeout).result()
+
+    def _finished(self, cache_key, future):
+        self.slots.release()
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            self.cache[cache_key] = future.result()
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
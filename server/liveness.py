@@ -0,0 +1,132 @@
+# liveness.py
+
+"""
+Handshake and idle deadlines for every connection on one hashed timer wheel
+"""
+
+import threading
+import time
+
+DEFAULT_TICK = 1.0  # Seconds; deadlines fire up to one tick late
+DEFAULT_SLOTS = 512
+DEFAULT_HANDSHAKE_TIMEOUT = 15.0  # From accept until the server accepts the handshake
+DEFAULT_PING_INTERVAL = 30.0  # Silence after which a client is pinged
+DEFAULT_PING_TIMEOUT = 15.0  # Further silence after the ping before it is dropped
+
+# What check() tells the server to do with a connection
+PING = "ping"
+HANDSHAKE_TIMEOUT = "handshake_timeout"
+IDLE_TIMEOUT = "idle_timeout"
+
+
+class TimerWheel:
+    """Hashed timer wheel keyed by arbitrary hashable objects
+
+    A timer lives in the slot of its deadline tick modulo the wheel size, so
+    scheduling and cancelling cost O(1) and each tick only looks at one
+    slot. Timers more than one revolution away stay in their slot until
+    their tick comes round.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, now=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # key -> deadline tick
+        self.deadlines = {}  # key -> deadline tick
+        self.origin = time.monotonic() if now is None else now
+        self.current = 0  # Last tick advanced through
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, delay, now=None):
+        """Fire key after delay seconds, replacing any timer it already has"""
+        now = time.monotonic() if now is None else now
+        deadline = -int(-(now + delay - self.origin) // self.tick)
+        with self.lock:
+            deadline = max(self.current + 1, deadline)  # Never in a tick that was already swept
+            old = self.deadlines.get(key)
+            if old is not None:
+                del self.slots[old % len(self.slots)][key]
+            self.deadlines[key] = deadline
+            self.slots[deadline % len(self.slots)][key] = deadline
+
+    def cancel(self, key):
+        with self.lock:
+            deadline = self.deadlines.pop(key, None)
+            if deadline is not None:
+                del self.slots[deadline % len(self.slots)][key]
+
+    def advance(self, now=None):
+        """Sweep every tick up to now, returning the keys whose timers fired"""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.origin) // self.tick)
+        expired = []
+        with self.lock:
+            # After a stall longer than one revolution, each slot is swept once
+            first = max(self.current + 1, target - len(self.slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self.slots[tick % len(self.slots)]
+                due = [key for key, deadline in slot.items() if deadline <= target]
+                for key in due:
+                    del slot[key]
+                    del self.deadlines[key]
+                expired.extend(due)
+            self.current = max(self.current, target)
+        return expired
+
+
+class Liveness:
+    """Decides when a connection is pinged or dropped
+
+    Receiving only stamps the connection's last_seen; nothing is
+    rescheduled per frame. When a connection's timer fires, check()
+    compares last_seen with the deadlines and either re-arms the timer
+    for the next one, or says to ping or drop the connection.
+    """
+
+    def __init__(self, handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT, ping_interval=DEFAULT_PING_INTERVAL,
+                 ping_timeout=DEFAULT_PING_TIMEOUT, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.handshake_timeout = handshake_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.wheel = TimerWheel(tick, slots)
+
+    def accepted(self, client_socket):
+        """Start the handshake deadline of a new connection"""
+        if self.handshake_timeout:
+            self.wheel.schedule(client_socket, self.handshake_timeout)
+
+    def authenticated(self, client_socket):
+        """Replace the handshake deadline with idle checks"""
+        if self.ping_interval:
+            self.wheel.schedule(client_socket, self.ping_interval)
+        else:
+            self.wheel.cancel(client_socket)
+
+    def closed(self, client_socket):
+        self.wheel.cancel(client_socket)
+
+    def expired(self, now=None):
+        """(socket, action) for every connection whose timer fired; PING ones are re-armed"""
+        now = time.monotonic() if now is None else now
+        actions = []
+        for client_socket in self.wheel.advance(now):
+            action = self.check(client_socket, now)
+            if action:
+                actions.append((client_socket, action))
+        return actions
+
+    def check(self, client_socket, now):
+        if client_socket.closed:
+            return None
+        if client_socket.username is None:
+            return HANDSHAKE_TIMEOUT
+        idle = now - client_socket.last_seen
+        if idle < self.ping_interval:
+            self.wheel.schedule(client_socket, self.ping_interval - idle, now)
+            return None
+        if idle < self.ping_interval + self.ping_timeout:
+            self.wheel.schedule(client_socket, self.ping_interval + self.ping_timeout - idle, now)
+            return PING
+        return IDLE_TIMEOUT
@@ -0,0 +1,43 @@
+# log.py
+
+"""
+Level-gated logging that never writes to stdout on the calling thread
+"""
+
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER_NAME = "chat"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+_listener = None
+
+
+def get_logger(name=None):
+    """Logger for a server module; records go to the "chat" hierarchy"""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+def configure_logging(level=logging.INFO, stream=None):
+    """Route "chat" records through a queue to a background writer thread
+
+    Callers only format and enqueue a record, and only when its level is
+    enabled, so a slow terminal or pipe cannot stall a broadcast.
+    Calling this again changes the level.
+    """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    if _listener is None:
+        records = queue.SimpleQueue()
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(logging.Formatter(LOG_FORMAT))
+        _listener = QueueListener(records, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+    return logger
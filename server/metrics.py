@@ -0,0 +1,257 @@
+# metrics.py
+
+"""
+In-process counters, gauges and latency histograms, served as plain text
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_METRICS_PORT = 9100
+# Seconds, from 100 us to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Frames
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """One named metric with a value per label set"""
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {format_labels(key): value for key, value in self.series.items()}
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.series.get(label_key(labels), 0)
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a function when rendered"""
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self.lock:
+            return self.series.get(label_key(labels), 0)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+    def snapshot(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        key = label_key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        result = {}
+        for key, values in series.items():
+            count = sum(values[:-1])
+            result[format_labels(key)] = {
+                "count": count,
+                "sum": values[-1],
+                "buckets": dict(zip(map(str, self.buckets + ("+Inf",)), values[:-1])),
+            }
+        return result
+
+
+class Registry:
+    """Named metrics of one process"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """All metrics as a dict, e.g. for dumping to JSON"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+
+class MetricsServer:
+    """Serves a registry as plain text on GET /metrics
+
+    Meant for localhost scraping; it exposes counts and timings only,
+    never usernames or message content.
+    """
+
+    def __init__(self, registry=None, host='localhost', port=DEFAULT_METRICS_PORT):
+        self.registry = registry or REGISTRY
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+# Process-wide registry and the server's instruments
+REGISTRY = Registry()
+
+CONNECTIONS_ACCEPTED = REGISTRY.counter("chat_connections_accepted_total", "Connections accepted")
+CONNECTIONS_OPEN = REGISTRY.gauge("chat_connections_open", "Connections currently open")
+USERS_ONLINE = REGISTRY.gauge("chat_users_online", "Users past the handshake")
+DISCONNECTS = REGISTRY.counter("chat_disconnects_total", "Closed connections by reason")
+HANDSHAKES = REGISTRY.counter("chat_handshakes_total", "Handshakes by outcome")
+HANDSHAKE_SECONDS = REGISTRY.histogram(
+    "chat_handshake_seconds", "Handshake time by stage (auth, key_wrap, total from accept to key_exchange, resumed from accept to welcome)"
+)
+KEY_WRAP_CACHE = REGISTRY.counter("chat_key_wrap_cache_total", "Room key wraps by cache result")
+MESSAGES_RELAYED = REGISTRY.counter("chat_messages_relayed_total", "Chat messages accepted for relay")
+MESSAGES_THROTTLED = REGISTRY.counter("chat_messages_throttled_total", "Chat messages refused by a sender's rate limit")
+FANOUT_SECONDS = REGISTRY.histogram("chat_fanout_seconds", "Time to queue one frame for all its recipients")
+FRAMES_QUEUED = REGISTRY.counter("chat_frames_queued_total", "Frames queued to clients by broadcasts")
+FRAMES_DROPPED = REGISTRY.counter("chat_frames_dropped_total", "Frames discarded by the drop_oldest policy, by lane")
+CONTROL_WAIT_SECONDS = REGISTRY.histogram(
+    "chat_control_wait_seconds", "Time control frames (key_exchange, system, ...) waited in a client's queue, by type"
+)
+QUEUE_DEPTH = REGISTRY.histogram(
+    "chat_outbound_queue_depth", "Frames waiting in a client's queue when its writer picks up a batch", DEPTH_BUCKETS
+)
+PINGS_SENT = REGISTRY.counter("chat_pings_sent_total", "Pings sent to clients that went quiet")
+BYTES_RECEIVED = REGISTRY.counter("chat_bytes_received_total", "Bytes read from clients")
+BYTES_SENT = REGISTRY.counter("chat_bytes_sent_total", "Bytes written to clients")
@@ -0,0 +1,432 @@
+# outbound.py
+
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from shared.protocol import (Frame, WIRE_BINARY, WIRE_JSON, KEY_EXCHANGE, AUTH_ERROR, MESSAGE, SYSTEM, USER_LIST,
+                             USER_JOINED, USER_LEFT, PING, PONG, iter_frames)
+from metrics import FRAMES_DROPPED, QUEUE_DEPTH, CONTROL_WAIT_SECONDS, BYTES_SENT
+
+# Policies for a client whose outbound queue stays full
+DROP_OLDEST = "drop_oldest"   # Discard the oldest queued frame to make room
+DISCONNECT = "disconnect"     # Drop the client
+BLOCK = "block"               # Wait up to block_timeout for room, then drop the client
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+DEFAULT_QUEUE_SIZE = 1024  # Chat frames
+DEFAULT_CONTROL_QUEUE_SIZE = 256  # Control frames, limited separately
+DEFAULT_BLOCK_TIMEOUT = 1.0
+
+# Frames a client needs to keep working: they are written before any queued chat
+CONTROL_TYPES = frozenset({KEY_EXCHANGE, AUTH_ERROR, SYSTEM, USER_LIST, USER_JOINED, USER_LEFT, PING, PONG})
+
+# Control frames a client cannot recover from losing; a full control lane of
+# only these disconnects the client under every policy
+KEEP_TYPES = frozenset({KEY_EXCHANGE, AUTH_ERROR, USER_LIST})
+
+# Output coalescing: frames queued within flush_window seconds of the first
+# one, up to flush_bytes, are written with a single sendmsg()
+DEFAULT_FLUSH_WINDOW = 0.0  # Only coalesce what is already queued
+DEFAULT_FLUSH_BYTES = 256 * 1024
+
+# Bytes each sender's queued chat frames may take per round of the fair scheduler
+DEFAULT_QUANTUM = 4096
+
+# Frames a client is waiting on; they end the flush window early
+FLUSH_NOW_TYPES = frozenset({KEY_EXCHANGE, AUTH_ERROR})
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class QueueFullError(ConnectionError):
+    """Raised when a client's outbound queue overflows under DISCONNECT/BLOCK"""
+
+
+def send_buffers(sock, buffers):
+    """Write a list of buffers with as few sendmsg() calls as possible"""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(data) for data in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        # Skip whole buffers that went out, then trim a partly sent one
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+def check_policy(policy):
+    """Validate an overflow policy name"""
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown queue policy {policy!r}, expected one of {POLICIES}")
+    return policy
+
+
+class FairQueue:
+    """Frames waiting for one client, interleaved fairly across senders
+
+    Each flow (the username a chat frame came from; None for history and
+    other frames without a sender) keeps its frames in order in its own deque. Flows with frames
+    take turns by deficit round-robin: a turn allows quantum bytes, plus
+    whatever the flow did not use last time, so a user who floods a room
+    gets one share of the client's writes and another user's message waits
+    about one round instead of behind the whole backlog.
+    """
+
+    def __init__(self, quantum=DEFAULT_QUANTUM):
+        self.quantum = quantum
+        self.flows = {}  # flow -> deque of frames
+        self.deficits = {}  # flow -> bytes it may still send this turn
+        self.active = deque()  # Flows with frames; the first one has the turn
+        self.count = 0
+
+    def append(self, data, flow=None):
+        frames = self.flows.get(flow)
+        if frames is None:
+            frames = self.flows[flow] = deque()
+            self.deficits[flow] = self.quantum
+            self.active.append(flow)
+        frames.append(data)
+        self.count += 1
+
+    def peek(self):
+        """The frame popleft() returns next"""
+        return self.flows[self._next_flow()][0]
+
+    def popleft(self):
+        flow = self._next_flow()
+        frames = self.flows[flow]
+        data = frames.popleft()
+        self.deficits[flow] -= len(data)
+        self.count -= 1
+        if not frames:
+            self._retire(flow)
+            self.active.popleft()
+        return data
+
+    def drop(self):
+        """Discard the oldest frame of the longest flow, so the busiest sender pays for an overflow"""
+        flow = max(self.active, key=lambda flow: len(self.flows[flow]))
+        frames = self.flows[flow]
+        data = frames.popleft()
+        self.count -= 1
+        if not frames:
+            self._retire(flow)
+            self.active.remove(flow)
+        return data
+
+    def clear(self):
+        self.flows.clear()
+        self.deficits.clear()
+        self.active.clear()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _next_flow(self):
+        # Pass the turn on until a flow can afford its next frame
+        while True:
+            flow = self.active[0]
+            if self.deficits[flow] >= len(self.flows[flow][0]):
+                return flow
+            self.deficits[flow] += self.quantum
+            self.active.rotate(-1)
+
+    def _retire(self, flow):
+        # An idle flow starts its next turn afresh rather than saving up credit
+        del self.flows[flow]
+        del self.deficits[flow]
+
+
+class LaneQueue:
+    """Frames waiting for one client in two lanes, control ahead of chat
+
+    The control lane is a FIFO of key exchanges, notices, presence and
+    pings; the chat lane is a FairQueue of chat messages and history. The
+    next frame out is the oldest control frame if there is one, so a room
+    key is never written after a backlog of chat that was queued before it.
+    Each lane has its own limit, so a chat backlog cannot push control
+    frames out either. Control frames record how long they waited.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, control_size=DEFAULT_CONTROL_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.control_size = control_size
+        self.control = deque()  # (data, frame type, time queued)
+        self.chat = FairQueue()
+
+    def append(self, data, flow=None, control=None):
+        """control is the type of a control frame; None queues data as chat from flow"""
+        if control:
+            self.control.append((data, control, time.monotonic()))
+        else:
+            self.chat.append(data, flow)
+
+    def full(self, control=None):
+        """True if the lane a frame would join is at its limit"""
+        if control:
+            return len(self.control) >= self.control_size
+        return len(self.chat) >= self.maxsize
+
+    def overflowing(self):
+        return len(self.control) > self.control_size or len(self.chat) > self.maxsize
+
+    def drop(self, control=None):
+        """Discard the oldest frame of a lane that may be lost; None if there is none
+
+        Chat drops from the busiest sender. Control drops the oldest notice,
+        presence change or ping, never one of KEEP_TYPES.
+        """
+        if not control:
+            return self.chat.drop()
+        for i, (data, frame_type, _) in enumerate(self.control):
+            if frame_type not in KEEP_TYPES:
+                del self.control[i]
+                return data
+        return None
+
+    def peek(self):
+        return self.control[0][0] if self.control else self.chat.peek()
+
+    def popleft(self):
+        if self.control:
+            data, frame_type, queued = self.control.popleft()
+            CONTROL_WAIT_SECONDS.observe(time.monotonic() - queued, type=frame_type)
+            return data
+        return self.chat.popleft()
+
+    def clear(self):
+        self.control.clear()
+        self.chat.clear()
+
+    def __len__(self):
+        return len(self.control) + len(self.chat)
+
+
+def lane_name(control):
+    return "control" if control else "chat"
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client"""
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT,
+                 control_size=DEFAULT_CONTROL_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.control_size = control_size
+        self.policy = check_policy(policy)
+        self.block_timeout = block_timeout
+        self.frames = LaneQueue(maxsize, control_size)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.queued_bytes = 0
+        self.flush_now = False  # An urgent frame is queued
+
+    def put(self, data, flush=False, flow=None, control=None):
+        """Queue a frame, applying the overflow policy when its lane is full
+
+        flush ends a pending flush window so the frame goes out right away.
+        flow names the sender whose fair share a chat frame counts against;
+        control, the frame type of a control frame, puts it in the control lane.
+        """
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if self.frames.full(control):
+                if self.policy == DROP_OLDEST:
+                    dropped = self.frames.drop(control)
+                    if dropped is None:
+                        raise QueueFullError("Outbound queue full of frames that cannot be dropped")
+                    self.queued_bytes -= len(dropped)
+                    self.dropped += 1
+                    FRAMES_DROPPED.inc(lane=lane_name(control))
+                elif self.policy == DISCONNECT:
+                    raise QueueFullError("Outbound queue full")
+                else:
+                    has_room = self.cond.wait_for(
+                        lambda: self.closed or not self.frames.full(control),
+                        timeout=self.block_timeout
+                    )
+                    if self.closed:
+                        raise ConnectionError("Connection closed")
+                    if not has_room:
+                        raise QueueFullError("Outbound queue full")
+            self.frames.append(data, flow, control)
+            self.queued_bytes += len(data)
+            self.flush_now = self.flush_now or flush
+            self.cond.notify_all()
+
+    def get(self):
+        """Wait for the next frame; returns None once closed and drained"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed)
+            if not self.frames:
+                return None
+            data = self.frames.popleft()
+            self.queued_bytes -= len(data)
+            self.flush_now = self.flush_now and bool(self.frames)
+            self.cond.notify_all()
+            return data
+
+    def get_batch(self, max_bytes=DEFAULT_FLUSH_BYTES, flush_window=DEFAULT_FLUSH_WINDOW):
+        """Wait for frames and take up to max_bytes of them; returns [] once closed and drained
+
+        With a flush_window, waits up to that long after the first frame for
+        more to arrive, unless max_bytes is already queued or a frame was
+        put with flush=True. A single frame larger than max_bytes is still
+        returned on its own.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed)
+            if flush_window > 0:
+                deadline = time.monotonic() + flush_window
+                while not (self.closed or self.flush_now or self.queued_bytes >= max_bytes):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            batch = []
+            size = 0
+            while self.frames and (not batch or size + len(self.frames.peek()) <= max_bytes):
+                data = self.frames.popleft()
+                batch.append(data)
+                size += len(data)
+            self.queued_bytes -= size
+            self.flush_now = self.flush_now and bool(self.frames)
+            self.cond.notify_all()
+            return batch
+
+    def close(self, discard=False):
+        """Stop accepting frames, optionally discarding the ones still queued"""
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.frames.clear()
+                self.queued_bytes = 0
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class FrameSender:
+    """Mixin encoding Frames in the wire format the client negotiated
+
+    Subclasses provide sendall(data, flush=False, flow=None, control=None)
+    and set self.wire_lock.
+    The lock makes the switch to a new wire format atomic with respect to
+    concurrent broadcasts, so no frame is encoded for the old format after
+    the acknowledgement that announces the new one.
+    
+    close_reason, when set, is why the server ended the connection; it
+    labels the disconnect in the metrics. username is set once the
+    handshake is accepted and last_seen whenever the client sends anything.
+    """
+    wire = WIRE_JSON
+    close_reason = None
+    username = None
+
+    def send_frame(self, frame):
+        # Control frames jump ahead of chat, which is scheduled fairly per sender
+        control = frame.type if frame.type in CONTROL_TYPES else None
+        flow = frame.message.get("sender") if frame.type == MESSAGE else None
+        with self.wire_lock:
+            self.sendall(frame.encode(self.wire), flush=frame.type in FLUSH_NOW_TYPES, flow=flow, control=control)
+
+    def send_binary_batch(self, data):
+        """Send concatenated binary frames in one write, transcoding for JSON clients"""
+        with self.wire_lock:
+            if self.wire != WIRE_BINARY:
+                data = b"".join(Frame.from_binary(record).encode(self.wire) for record in iter_frames(data))
+            self.sendall(data)
+            
+    def switch_wire(self, wire, ack_frame):
+        """Send ack_frame in the current format, then switch to wire"""
+        with self.wire_lock:
+            self.sendall(ack_frame.encode(self.wire), control=ack_frame.type)
+            self.wire = wire
+
+
+class QueuedSocket(FrameSender):
+    """Socket wrapper whose sendall() enqueues instead of blocking
+
+    A dedicated writer thread drains the queue to the real socket, so a
+    client with a full TCP window only ever stalls its own writer. Whatever
+    has queued up by the time the writer runs (after waiting up to
+    flush_window, and up to flush_bytes) goes out in one sendmsg().
+    """
+
+    def __init__(self, sock, queue, flush_window=DEFAULT_FLUSH_WINDOW, flush_bytes=DEFAULT_FLUSH_BYTES):
+        self.sock = sock
+        self.queue = queue
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        self.closed = False
+        self.close_lock = threading.Lock()  # Shutdown must reach the socket before the writer closes it
+        self.opened_at = self.last_seen = time.monotonic()
+        self.wire_lock = threading.Lock()
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def recv_into(self, buffer):
+        return self.sock.recv_into(buffer)
+
+    def sendall(self, data, flush=False, flow=None, control=None):
+        try:
+            self.queue.put(data, flush, flow, control)
+        except QueueFullError:
+            self.close_reason = self.close_reason or "queue_full"
+            self.abort()
+            raise
+
+    def close(self):
+        """Close once every queued frame has been written"""
+        self.queue.close()
+
+    def abort(self):
+        """Close immediately, discarding queued frames"""
+        self.queue.close(discard=True)
+        self._shutdown()
+
+    def _write_frames(self):
+        try:
+            while True:
+                batch = self.queue.get_batch(self.flush_bytes, self.flush_window)
+                if not batch:
+                    break
+                QUEUE_DEPTH.observe(len(batch) + len(self.queue))
+                send_buffers(self.sock, batch)
+                BYTES_SENT.inc(sum(map(len, batch)))
+        except OSError:
+            self.close_reason = self.close_reason or "write_error"
+            self.queue.close(discard=True)
+        finally:
+            self._shutdown()
+            with self.close_lock:
+                self.sock.close()
+
+    def _shutdown(self):
+        # Also wakes the connection thread blocked in recv()
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,38 @@
+# rate_limit.py
+
+"""
+Per-user token buckets for chat messages
+"""
+
+import time
+
+DEFAULT_RATE_LIMIT = 20.0  # Messages per second a user may sustain; None turns limiting off
+DEFAULT_RATE_BURST = 40  # Messages a user may send at once after being quiet
+
+
+class TokenBucket:
+    """Holds up to burst tokens and refills at rate tokens per second
+
+    Each message takes a token, so a user can send burst messages back to
+    back and then rate per second. throttled is set while messages are
+    being refused, so the user is told once per episode rather than once
+    per dropped message.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'throttled')
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_RATE_BURST, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+        self.throttled = False
+
+    def take(self, now=None):
+        """Spend a token if one is available; False means the message is over the limit"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -1,13 +1,10 @@
 # server.py
 
+import signal
 import socket
 import threading
-import json
+import time
 import base64
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
 from cryptography.fernet import Fernet
 
 import sys
@@ -16,12 +13,95 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from user_manager import UserManager
-from shared.protocol import Protocol
+from key_wrap import KeyWrapper, HandshakeBusy, DEFAULT_MAX_PENDING
+from history import HistoryLog
+from tickets import TicketSealer, DEFAULT_TICKET_LIFETIME
+from rate_limit import TokenBucket, DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST
+from liveness import Liveness, PING, DEFAULT_HANDSHAKE_TIMEOUT, DEFAULT_PING_INTERVAL, DEFAULT_PING_TIMEOUT
+from log import get_logger, configure_logging
+from metrics import (MetricsServer, CONNECTIONS_ACCEPTED, CONNECTIONS_OPEN, DISCONNECTS, HANDSHAKES,
+                     HANDSHAKE_SECONDS, MESSAGES_RELAYED, MESSAGES_THROTTLED, BYTES_RECEIVED, PINGS_SENT)
+from outbound import (OutboundQueue, QueuedSocket, check_policy, DEFAULT_QUEUE_SIZE, DEFAULT_CONTROL_QUEUE_SIZE,
+                      DEFAULT_BLOCK_TIMEOUT, DROP_OLDEST, DEFAULT_FLUSH_WINDOW, DEFAULT_FLUSH_BYTES)
+from shared.protocol import Protocol, Frame, WIRE_FORMATS, CIPHER_SUITES, DEFAULT_ROOM, USER_JOINED, USER_LEFT
+from shared.stream_reader import FrameReader, FrameTooLarge, DEFAULT_MAX_FRAME_SIZE
+
+DEFAULT_HISTORY_REPLAY = 50
+
+log = get_logger("server")
 
 class ChatServer:
-    def __init__(self, host='localhost', port=8888):
+    def __init__(self, host='localhost', port=8888, backlog=socket.SOMAXCONN,
+                 queue_size=DEFAULT_QUEUE_SIZE, queue_policy=DROP_OLDEST, queue_timeout=DEFAULT_BLOCK_TIMEOUT,
+                 flush_window=DEFAULT_FLUSH_WINDOW, flush_bytes=DEFAULT_FLUSH_BYTES,
+                 wire_formats=WIRE_FORMATS, max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 handshake_workers=None, max_pending_handshakes=DEFAULT_MAX_PENDING,
+                 cipher_suites=CIPHER_SUITES, compressions=(), reuse_port=False,
+                 history_dir=None, history_replay=DEFAULT_HISTORY_REPLAY, metrics_port=None,
+                 ticket_lifetime=DEFAULT_TICKET_LIFETIME, handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+                 ping_interval=DEFAULT_PING_INTERVAL, ping_timeout=DEFAULT_PING_TIMEOUT,
+                 rate_limit=DEFAULT_RATE_LIMIT, rate_burst=DEFAULT_RATE_BURST, send_buffer=None,
+                 control_queue_size=DEFAULT_CONTROL_QUEUE_SIZE):
         self.host = host
         self.port = port
+        self.backlog = backlog  # Accept queue length passed to listen()
+        self.reuse_port = reuse_port  # Let several worker processes accept on one port
+        
+        # Per-client outbound queue limits and what to do with a client that stays full.
+        # Control frames (key exchange, notices, presence) have their own lane,
+        # written ahead of chat, and their own limit.
+        self.queue_size = queue_size
+        self.control_queue_size = control_queue_size
+        self.queue_policy = check_policy(queue_policy)
+        self.queue_timeout = queue_timeout
+        
+        # Frames queued within flush_window seconds, up to flush_bytes, share one write
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        
+        # Kernel send buffer per client (SO_SNDBUF), None for the OS default. A
+        # small one keeps a slow client's backlog in its outbound queue, where
+        # chat frames are interleaved fairly across senders, instead of in the
+        # kernel, where they leave in the order they were written.
+        self.send_buffer = send_buffer
+        
+        # Wire formats offered to clients during the handshake
+        self.wire_formats = wire_formats
+        self.max_frame_size = max_frame_size  # Larger inbound frames drop the client
+        
+        # RSA wrapping of the room key runs on a process pool (None = one worker per core)
+        self.key_wrapper = KeyWrapper(handshake_workers, max_pending_handshakes)
+        
+        # Cipher suites clients may send with. The server never decrypts; it
+        # only relays each message's suite tag. Restrict this to Fernet when
+        # clients without AEAD support share the room.
+        self.cipher_suites = cipher_suites
+        
+        # Compressions clients may use before encrypting, none unless enabled.
+        # Every client can undo zlib; only allow zstd when all of them have it.
+        self.compressions = compressions
+        
+        # Encrypted chat frames are logged per room when history_dir is set,
+        # and the last history_replay of them are replayed to each new member
+        self.history = HistoryLog(history_dir) if history_dir else None
+        self.history_replay = history_replay
+        
+        # Clients reconnecting within ticket_lifetime seconds skip the RSA key wrap
+        self.tickets = self.new_ticket_sealer(ticket_lifetime) if ticket_lifetime else None
+        
+        # Connections must finish the handshake within handshake_timeout; after
+        # ping_interval of silence they are pinged and dropped if nothing
+        # arrives within ping_timeout. None disables either check.
+        self.liveness = Liveness(handshake_timeout, ping_interval, ping_timeout)
+        
+        # Each user may relay rate_limit chat messages per second, in bursts of
+        # up to rate_burst; the rest are dropped. None disables the limit.
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        
+        # Counters and timings are served as text on localhost:metrics_port when set
+        self.metrics_port = metrics_port
+        self.metrics_server = None
         self.socket = None
         self.running = False
         self.user_manager = UserManager()
@@ -31,25 +111,39 @@ class ChatServer:
         
         # Generate a global symmetric key for the chat room
         self.symmetric_key = Fernet.generate_key()
-        print(f"Chat Server Started")
-        print(f"Server Address: {self.host}:{self.port}")
-        print(f"Server Password: {self.server_password}")
-        print("Waiting for connections...")
+        
+        # Every other room gets its own key when its first member joins
+        self.room_keys = {DEFAULT_ROOM: self.symmetric_key}
+        self.room_keys_lock = threading.Lock()
+        log.info("Chat Server Started")
+        log.info("Server Address: %s:%s", self.host, self.port)
+        log.info("Server Password: %s", self.server_password)
+        log.info("Waiting for connections...")
         
     def start(self):
         """Start the chat server"""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
         try:
             self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            self.socket.listen(self.backlog)
+            self.key_wrapper.start()
+            self.start_metrics()
             self.running = True
+            threading.Thread(target=self.run_liveness, daemon=True).start()
             
             while self.running:
                 try:
                     client_socket, address = self.socket.accept()
-                    print(f"Connection attempt from {address}")
+                    # Writes are already coalesced per client; don't let Nagle hold them
+                    # back waiting for a delayed ACK (asyncio sets this by default)
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    if self.send_buffer:
+                        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+                    log.debug("Connection attempt from %s", address)
                     
                     client_thread = threading.Thread(
                         target=self.handle_client,
@@ -60,11 +154,11 @@ class ChatServer:
                     
                 except socket.error:
                     if self.running:
-                        print("Socket error occurred")
+                        log.error("Socket error occurred")
                     break
                     
         except Exception as e:
-            print(f"Server error: {e}")
+            log.error("Server error: %s", e)
         finally:
             self.stop()
             
@@ -73,176 +167,504 @@ class ChatServer:
         self.running = False
         if self.socket:
             self.socket.close()
-        print("Server stopped")
+        self.release_resources()
+        log.info("Server stopped")
+        
+    def stop_on_sigterm(self):
+        """Let SIGTERM (kill, Popen.terminate) stop the server like Ctrl+C; call from the main thread"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        
+    def release_resources(self):
+        """Shut down what both engines share: key wrapping workers, history and metrics"""
+        self.key_wrapper.shutdown()
+        if self.history:
+            self.history.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        
+    def start_metrics(self):
+        """Serve metrics on localhost if a metrics port was configured"""
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(port=self.metrics_port).start()
+            log.info("Metrics on http://localhost:%s/metrics", self.metrics_server.port)
+        
+    def run_liveness(self):
+        """Sweep the connection deadlines once a tick while the server runs"""
+        while self.running:
+            time.sleep(self.liveness.wheel.tick)
+            self.check_liveness()
+            
+    def check_liveness(self):
+        """Ping quiet clients and reap the ones that missed a deadline"""
+        timed_out = []
+        for client_socket, action in self.liveness.expired():
+            if action == PING:
+                PINGS_SENT.inc()
+                try:
+                    client_socket.send_frame(Frame(Protocol.create_ping()))
+                except Exception:
+                    pass
+            else:
+                timed_out.append((client_socket, action))
+        if timed_out:
+            self.reap(timed_out)
+            
+    def reap(self, timed_out):
+        """Drop (socket, reason) connections, telling each room once who left"""
+        departed = self.user_manager.remove_sessions(
+            [(client_socket.username, client_socket) for client_socket, _ in timed_out if client_socket.username]
+        )
+        for client_socket, reason in timed_out:
+            # Already gone from the user manager; the connection's own cleanup must not remove a newer login
+            client_socket.username = None
+            client_socket.close_reason = client_socket.close_reason or reason
+            client_socket.abort()
+        for room, usernames in departed.items():
+            self.user_manager.broadcast_departures(room, usernames)
+            self.user_manager.broadcast(self.room_notice(room, f"{', '.join(usernames)} timed out"), room=room)
+            self.forget_room_key(room)
+        log.info("Reaped %d connections", len(timed_out))
         
     def handle_client(self, client_socket, address):
         """Handle individual client connection"""
-        buffer = ""
+        client_socket = QueuedSocket(client_socket, self.make_outbound_queue(), self.flush_window, self.flush_bytes)
+        self.liveness.accepted(client_socket)
+        reader = FrameReader(max_frame_size=self.max_frame_size)
         username = None
+        error = None
+        CONNECTIONS_ACCEPTED.inc()
+        CONNECTIONS_OPEN.inc()
         
         try:
             while self.running:
-                data = client_socket.recv(1024).decode('utf-8', errors='ignore')
-                if not data:
+                received = reader.recv_into(client_socket)
+                if not received:
                     break
+                BYTES_RECEIVED.inc(received)
+                client_socket.last_seen = time.monotonic()
                     
-                buffer += data
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        username = self.process_client_message(line, client_socket, username, address)
+                for record in reader.frames():
+                    username = self.process_client_message(record, client_socket, username, address)
+                    reader.wire = client_socket.wire
                         
         except Exception as e:
-            print(f"Client handling error from {address}: {e}")
+            error = e
+            log.info("Client handling error from %s: %s", address, e)
         finally:
-            if username:
-                self.user_manager.remove_user(username)
-                self.user_manager.broadcast_user_list()
-                leave_msg = json.dumps({
-                    "type": "system",
-                    "message": f"{username} has left the chat"
-                })
-                self.user_manager.broadcast(leave_msg)
-                print(f"User {username} disconnected")
+            self.liveness.closed(client_socket)
+            if username and client_socket.username:
+                self.handle_disconnect(username)
                 
             client_socket.close()
+            self.record_disconnect(client_socket, error)
+            
+    def record_disconnect(self, client_socket, error=None):
+        """Count a closed connection under the reason it ended"""
+        if client_socket.close_reason:
+            reason = client_socket.close_reason
+        elif isinstance(error, FrameTooLarge):
+            reason = "frame_too_large"
+        elif error is not None:
+            reason = "error"
+        elif not self.running:
+            reason = "server_stopped"
+        else:
+            reason = "client_closed"
+        DISCONNECTS.inc(reason=reason)
+        CONNECTIONS_OPEN.dec()
+        
+    def make_outbound_queue(self):
+        """Create the bounded outbound queue for a new connection"""
+        return OutboundQueue(self.queue_size, self.queue_policy, self.queue_timeout, self.control_queue_size)
+        
+    def handle_disconnect(self, username):
+        """Remove a departed user and notify the rest of each of their rooms"""
+        for room, version in self.user_manager.remove_user(username).items():
+            self.user_manager.broadcast_presence(USER_LEFT, username, room, version)
+            self.user_manager.broadcast(self.room_notice(room, f"{username} has left the chat"), room=room)
+            self.forget_room_key(room)
+        log.info("User %s disconnected", username)
+        
+    def get_room_key(self, room):
+        """Get a room's symmetric key, generating it for a new room"""
+        with self.room_keys_lock:
+            key = self.room_keys.get(room)
+            if key is None:
+                key = self.room_keys[room] = self.new_room_key(room)
+            return key
+            
+    def new_room_key(self, room):
+        """Create the symmetric key for a room that has none yet"""
+        return Fernet.generate_key()
+            
+    def new_ticket_sealer(self, lifetime):
+        """Tickets are sealed with a key of this process; restarting voids them"""
+        return TicketSealer(lifetime)
+        
+    def issue_ticket(self, username):
+        """Resumption ticket for a user who holds the lobby key, or None"""
+        session = self.user_manager.get_user(username)
+        if self.tickets is None or session is None:
+            return None
+        return self.tickets.issue(username, session.public_key, self.get_room_key(DEFAULT_ROOM))
+        
+    def forget_room_key(self, room):
+        """Drop the key of a room nobody is in any more"""
+        if room == DEFAULT_ROOM:
+            return
+        with self.room_keys_lock:
+            if not self.user_manager.get_room_members(room):
+                self.room_keys.pop(room, None)
+                
+    def room_notice(self, room, message):
+        """System message about a room; lobby notices stay unlabelled"""
+        notice = {
+            "type": "system",
+            "message": message
+        }
+        if room != DEFAULT_ROOM:
+            notice["room"] = room
+        return Frame(notice)
             
     def process_client_message(self, message_data, client_socket, current_username, address):
         """Process message from client"""
         try:
-            data = json.loads(message_data)
+            data = Protocol.decode(message_data, client_socket.wire)
             msg_type = data.get("type")
             
             if msg_type == "handshake" and not current_username:
-                return self.handle_handshake(data, client_socket, address)
+                username = self.handle_handshake(data, client_socket, address)
+                if username:
+                    client_socket.username = username
+                    self.liveness.authenticated(client_socket)
+                return username
+            elif msg_type == "ping":
+                client_socket.send_frame(Frame(Protocol.create_pong()))
+            elif msg_type == "pong":
+                pass  # Receiving it already counted as activity
             elif msg_type == "message" and current_username:
                 self.handle_chat_message(data, current_username)
+            elif msg_type == "join_room" and current_username:
+                self.handle_join_room(data, current_username, client_socket)
+            elif msg_type == "leave_room" and current_username:
+                self.handle_leave_room(data, current_username, client_socket)
+            elif msg_type == "user_list_request" and current_username:
+                self.handle_user_list_request(data, current_username)
                 
-        except json.JSONDecodeError as e:
-            print(f"Invalid JSON from client: {e}")
+        except ValueError as e:
+            log.info("Invalid frame from client: %s", e)
             
         return current_username
         
     def handle_handshake(self, data, client_socket, address):
         """Handle client handshake and registration"""
+        started = time.perf_counter()
         username = data["username"]
         server_password = data["server_password"]  # Password sent by client
         public_key_pem = data["public_key"]
         
         # Check if server password is correct
         if server_password != self.server_password:
-            print(f"Access denied from {address} - wrong password")
-            auth_error = json.dumps({
+            log.warning("Access denied from %s - wrong password", address)
+            HANDSHAKES.inc(outcome="bad_password")
+            client_socket.close_reason = "auth_failed"
+            auth_error = Frame({
                 "type": "auth_error",
                 "message": "Invalid server password"
             })
-            client_socket.sendall((auth_error + '\n').encode())
+            client_socket.send_frame(auth_error)
             client_socket.close()
             return None
         
-        print(f"Access granted to {username} from {address}")
+        log.debug("Access granted to %s from %s", username, address)
         
         # Add user to manager
         if self.user_manager.add_user(username, client_socket, public_key_pem):
-            print(f"User {username} joined the chat")
+            log.info("User %s joined the chat", username)
+            HANDSHAKE_SECONDS.observe(time.perf_counter() - started, stage="auth")
+            
+            cipher_suite = None
+            if "cipher_suites" in data:
+                cipher_suite = Protocol.choose_suite(data["cipher_suites"], self.cipher_suites)
+            
+            # A valid ticket means the client still holds the current lobby key
+            resumed = (self.tickets is not None and "ticket" in data and
+                       self.tickets.redeem(data["ticket"], username, public_key_pem, self.get_room_key(DEFAULT_ROOM)))
             
-            # Send welcome message
-            welcome_msg = json.dumps({
+            # Send welcome message, announcing the wire format for the rest of the session
+            wire = Protocol.choose_wire(data.get("wire"), self.wire_formats)
+            welcome = {
                 "type": "system", 
                 "message": f"Welcome {username}! Establishing secure connection..."
-            })
-            client_socket.sendall((welcome_msg + '\n').encode())
-            
-            # Encrypt symmetric key with user's public key
-            try:
-                public_key = serialization.load_pem_public_key(
-                    public_key_pem.encode(),
-                    backend=default_backend()
-                )
-                
-                encrypted_key = public_key.encrypt(
-                    self.symmetric_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
-                
-                encrypted_key_b64 = base64.b64encode(encrypted_key).decode()
-                
-                # Send key exchange message
-                key_exchange_msg = json.dumps({
-                    "type": "key_exchange",
-                    "encrypted_key": encrypted_key_b64
-                })
-                client_socket.sendall((key_exchange_msg + '\n').encode())
-                
-                # Send connection established message
-                secure_msg = json.dumps({
-                    "type": "system",
-                    "message": "Secure connection established! You can now send encrypted messages."
-                })
-                client_socket.sendall((secure_msg + '\n').encode())
-                
-            except Exception as e:
-                print(f"Key encryption error for {username}: {e}")
-                error_msg = json.dumps({
-                    "type": "system",
-                    "message": "Error establishing secure connection"
-                })
-                client_socket.sendall((error_msg + '\n').encode())
-                return username
+            }
+            if "wire" in data:
+                welcome["wire"] = wire
+            compression = Protocol.choose_compression(data.get("compression"), self.compressions)
+            if compression:
+                welcome["compression"] = compression
+            if resumed:
+                welcome["message"] = f"Welcome back {username}! Session resumed."
+                welcome["resumed"] = True
+                welcome["ticket"] = self.issue_ticket(username)
+                if cipher_suite:
+                    welcome["cipher_suite"] = cipher_suite
+            client_socket.switch_wire(wire, Frame(welcome))
             
-            # Update all users with new user list
-            self.user_manager.broadcast_user_list()
+            # Only join the lobby once the welcome is queued. Control frames like
+            # the welcome are written ahead of chat, so a chat frame encoded in the
+            # old wire format could otherwise be written after it.
+            version = self.user_manager.join_room(username, DEFAULT_ROOM)
+            self.user_manager.broadcast_presence(USER_JOINED, username, DEFAULT_ROOM, version)
             
-            # Broadcast join message to all OTHER users
-            join_msg = json.dumps({
-                "type": "system", 
-                "message": f"{username} has joined the chat"
-            })
-            self.user_manager.broadcast(join_msg, exclude_user=username)
+            if resumed:
+                HANDSHAKES.inc(outcome="resumed")
+                HANDSHAKE_SECONDS.observe(time.monotonic() - client_socket.opened_at, stage="resumed")
+                self.welcome_member(username, client_socket, DEFAULT_ROOM)
+                return username
+            
+            # Wrap the room key for this user; finishes the handshake when done
+            if not self.start_key_exchange(username, client_socket, public_key_pem, cipher_suite):
+                return None
             
             return username
         else:
-            error_msg = json.dumps({
+            HANDSHAKES.inc(outcome="name_taken")
+            error_msg = Frame({
                 "type": "system",
                 "message": "Username already taken"
             })
-            client_socket.sendall((error_msg + '\n').encode())
+            client_socket.send_frame(error_msg)
             return None
             
+    def start_key_exchange(self, username, client_socket, public_key_pem, cipher_suite=None, room=DEFAULT_ROOM):
+        """Encrypt the room key with user's public key off the connection thread"""
+        started = time.perf_counter()
+        try:
+            encrypted_key = self.key_wrapper.wrap(public_key_pem, self.get_room_key(room))
+        except HandshakeBusy:
+            return self.key_exchange_busy(username, client_socket, room)
+        except Exception as e:
+            self.key_exchange_failed(username, client_socket, e)
+            return True
+            
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - started, stage="key_wrap")
+        self.finish_key_exchange(username, client_socket, encrypted_key, cipher_suite, room)
+        return True
+        
+    def finish_key_exchange(self, username, client_socket, encrypted_key, cipher_suite=None, room=DEFAULT_ROOM):
+        """Deliver the wrapped room key and announce the new member"""
+        encrypted_key_b64 = base64.b64encode(encrypted_key).decode()
+        
+        # Send key exchange message, naming the suite to send with if the client asked
+        key_exchange = {
+            "type": "key_exchange",
+            "encrypted_key": encrypted_key_b64
+        }
+        if cipher_suite:
+            key_exchange["cipher_suite"] = cipher_suite
+        if room != DEFAULT_ROOM:
+            key_exchange["room"] = room
+        elif self.tickets is not None:
+            key_exchange["ticket"] = self.issue_ticket(username)
+        client_socket.send_frame(Frame(key_exchange))
+        if room == DEFAULT_ROOM:
+            HANDSHAKES.inc(outcome="completed")
+            HANDSHAKE_SECONDS.observe(time.monotonic() - client_socket.opened_at, stage="total")
+        
+        # Send connection established message
+        if room == DEFAULT_ROOM:
+            secure_msg = self.room_notice(room, "Secure connection established! You can now send encrypted messages.")
+        else:
+            secure_msg = self.room_notice(room, f"You joined {room}")
+        client_socket.send_frame(secure_msg)
+        self.welcome_member(username, client_socket, room)
+        
+    def welcome_member(self, username, client_socket, room):
+        """Catch up a member who holds the room key and announce them"""
+        # The others already got a user_joined delta; the new member needs the whole roster
+        self.user_manager.send_user_list(username, room)
+        
+        # Catch the new member up on what was said before they arrived
+        self.replay_history(client_socket, room)
+        
+        # Broadcast join message to all OTHER members
+        join_msg = self.room_notice(room, f"{username} has joined the chat")
+        self.user_manager.broadcast(join_msg, exclude_user=username, room=room)
+        
+    def key_exchange_busy(self, username, client_socket, room):
+        """Handle a saturated handshake pool; False if the client was turned away"""
+        if room == DEFAULT_ROOM:
+            self.reject_busy(username, client_socket)
+            return False
+        version = self.user_manager.leave_room(username, room)
+        if version:
+            self.user_manager.broadcast_presence(USER_LEFT, username, room, version)
+        self.forget_room_key(room)
+        client_socket.send_frame(self.room_notice(room, f"Server busy, please try joining {room} again shortly"))
+        return True
+        
+    def key_exchange_failed(self, username, client_socket, error):
+        """Tell the user the room key could not be delivered"""
+        log.error("Key encryption error for %s: %s", username, error)
+        HANDSHAKES.inc(outcome="key_wrap_failed")
+        error_msg = Frame({
+            "type": "system",
+            "message": "Error establishing secure connection"
+        })
+        client_socket.send_frame(error_msg)
+        
+    def reject_busy(self, username, client_socket):
+        """Turn a client away when the handshake pool is saturated"""
+        log.warning("Handshake pool busy, rejecting %s", username)
+        HANDSHAKES.inc(outcome="busy")
+        client_socket.close_reason = "handshake_busy"
+        for room, version in self.user_manager.remove_user(username).items():
+            self.user_manager.broadcast_presence(USER_LEFT, username, room, version)
+        busy_msg = Frame({
+            "type": "system",
+            "message": "Server busy, please try again shortly"
+        })
+        client_socket.send_frame(busy_msg)
+        client_socket.close()
+        
+    def handle_join_room(self, data, username, client_socket):
+        """Add a user to a room and send them its key"""
+        room = data.get("room")
+        if not Protocol.valid_room(room):
+            client_socket.send_frame(self.room_notice(DEFAULT_ROOM, "Invalid room name"))
+            return
+            
+        # Joining and forget_room_key are serialized so a room's key is never
+        # dropped between a new member joining and its key being wrapped
+        with self.room_keys_lock:
+            version = self.user_manager.join_room(username, room)
+        if not version:
+            client_socket.send_frame(self.room_notice(room, f"You are already in {room}"))
+            return
+            
+        log.info("User %s joined room %s", username, room)
+        self.user_manager.broadcast_presence(USER_JOINED, username, room, version)
+        public_key_pem = self.user_manager.get_user(username).public_key
+        self.start_key_exchange(username, client_socket, public_key_pem, room=room)
+        
+    def handle_leave_room(self, data, username, client_socket):
+        """Remove a user from a room and tell the remaining members"""
+        room = data.get("room")
+        version = self.user_manager.leave_room(username, room)
+        if not version:
+            client_socket.send_frame(self.room_notice(DEFAULT_ROOM, f"You are not in {room}"))
+            return
+            
+        log.info("User %s left room %s", username, room)
+        client_socket.send_frame(self.room_notice(room, f"You left {room}"))
+        self.user_manager.broadcast_presence(USER_LEFT, username, room, version)
+        self.user_manager.broadcast(self.room_notice(room, f"{username} has left the chat"), room=room)
+        self.forget_room_key(room)
+        
+    def record_history(self, room, frame):
+        """Append an encrypted chat frame to the room's history"""
+        if not self.history:
+            return
+        try:
+            self.history.append(room, frame, self.get_room_key(room))
+        except OSError as e:
+            log.error("History write failed: %s", e)
+            
+    def replay_history(self, client_socket, room):
+        """Send a room's recent history to one client in a single write"""
+        if not self.history or not self.history_replay:
+            return
+        try:
+            data = self.history.read_last(room, self.history_replay, self.get_room_key(room))
+        except OSError as e:
+            log.error("History read failed: %s", e)
+            return
+        if data:
+            client_socket.send_binary_batch(data)
+            
+    def handle_user_list_request(self, data, username):
+        """Resend a room's roster to a client that missed a presence update"""
+        room = data.get("room", DEFAULT_ROOM)
+        if self.user_manager.is_member(username, room):
+            self.user_manager.send_user_list(username, room)
+            
     def handle_chat_message(self, data, username):
         """Handle incoming chat message"""
         message = data["message"]
         encrypted = data.get("encrypted", False)
+        room = data.get("room", DEFAULT_ROOM)
         
-        print(f"Message from {username}")
+        if not self.user_manager.is_member(username, room):
+            self.user_manager.send_to_user(username, self.room_notice(DEFAULT_ROOM, f"You are not in {room}"))
+            return
+            
+        if not self.within_rate_limit(username):
+            return
+            
+        log.debug("Message from %s", username)
+        MESSAGES_RELAYED.inc()
         
-        # Broadcast message to all OTHER users
-        chat_msg = json.dumps({
+        # Broadcast message to all OTHER members of the room
+        chat = {
             "type": "message",
             "sender": username,
             "message": message,
             "encrypted": encrypted
-        })
+        }
+        if "suite" in data:
+            # Relayed unchanged so receivers know how to decrypt
+            chat["suite"] = data["suite"]
+        if "compression" in data:
+            if data["compression"] not in self.compressions:
+                self.user_manager.send_to_user(username, self.room_notice(
+                    room, f"Compression {data['compression']} is not enabled on this server"))
+                return
+            chat["compression"] = data["compression"]
+        if room != DEFAULT_ROOM:
+            chat["room"] = room
+        chat_msg = Frame(chat)
+        if encrypted:
+            self.record_history(room, chat_msg)
         
-        disconnected = self.user_manager.broadcast(chat_msg, exclude_user=username)
+        self.user_manager.broadcast(chat_msg, exclude_user=username, room=room)
         
         # Also send the message back to the sender so they can see their own message
         self.user_manager.send_to_user(username, chat_msg)
-        
-        # Update user list if any users disconnected
-        if disconnected:
-            self.user_manager.broadcast_user_list()
+
+    def within_rate_limit(self, username):
+        """Spend one of the user's chat tokens; tells them once when they run out"""
+        if self.rate_limit is None:
+            return True
+        session = self.user_manager.get_user(username)
+        if session is None:
+            return False
+        if session.bucket is None:
+            session.bucket = TokenBucket(self.rate_limit, self.rate_burst)
+        bucket = session.bucket
+        if bucket.take():
+            bucket.throttled = False
+            return True
+            
+        MESSAGES_THROTTLED.inc()
+        if not bucket.throttled:
+            bucket.throttled = True
+            log.warning("Throttling %s", username)
+            self.user_manager.send_to_user(username, Frame({
+                "type": "system",
+                "message": f"You are sending messages too fast; messages over {self.rate_limit:g} per second are not delivered",
+                "throttled": True
+            }))
+        return False
 
 def main():
+    configure_logging()
     server = ChatServer()
+    server.stop_on_sigterm()
     try:
         server.start()
     except KeyboardInterrupt:
-        print("\nShutting down server...")
+        log.info("Shutting down server...")
         server.stop()
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+# tickets.py
+
+"""
+Session resumption tickets
+
+After a full handshake the server hands the client a ticket sealed with a
+key only the server knows. A client that reconnects with its ticket and
+the same key pair skips the RSA wrap of the lobby key: it still holds that
+key, and the ticket proves the server gave it out.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from cryptography.fernet import Fernet, InvalidToken
+
+from key_wrap import fingerprint
+
+DEFAULT_TICKET_LIFETIME = 600  # Seconds; 0 turns resumption off
+MIN_PRUNE_SIZE = 1024
+
+
+def room_key_id(room_key):
+    """Short public identifier of a room key; a ticket is void once the key changes"""
+    return hashlib.sha256(room_key).hexdigest()[:32]
+
+
+class TicketSealer:
+    """Issues and redeems tickets bound to a user, their key pair and the lobby key
+
+    Tickets are Fernet tokens, so they are authenticated, opaque to the
+    client and carry their own issue time. Each ticket can be redeemed
+    once; its id is remembered until the ticket would have expired anyway.
+    Nodes that share key (e.g. derived from a backplane secret) accept
+    each other's tickets.
+    """
+
+    def __init__(self, lifetime=DEFAULT_TICKET_LIFETIME, key=None):
+        self.lifetime = lifetime
+        self.fernet = Fernet(key or Fernet.generate_key())
+        self.redeemed = {}  # ticket id -> time after which it would be expired
+        self.prune_at = MIN_PRUNE_SIZE
+        self.lock = threading.Lock()
+
+    def issue(self, username, public_key_pem, room_key):
+        """Seal a new ticket for this session"""
+        claims = {
+            "id": os.urandom(12).hex(),
+            "user": username,
+            "key": fingerprint(public_key_pem),
+            "room_key": room_key_id(room_key)
+        }
+        return self.fernet.encrypt(json.dumps(claims, separators=(',', ':')).encode()).decode()
+
+    def redeem(self, ticket, username, public_key_pem, room_key):
+        """True if ticket was issued to this user and key pair under room_key, is fresh and unused"""
+        try:
+            claims = json.loads(self.fernet.decrypt(ticket, ttl=self.lifetime))
+        except (InvalidToken, TypeError, ValueError):
+            return False
+        if (claims.get("user") != username or claims.get("key") != fingerprint(public_key_pem)
+                or claims.get("room_key") != room_key_id(room_key)):
+            return False
+
+        now = time.time()
+        with self.lock:
+            if claims["id"] in self.redeemed:
+                return False
+            if len(self.redeemed) >= self.prune_at:
+                self.redeemed = {ticket_id: until for ticket_id, until in self.redeemed.items() if until > now}
+                self.prune_at = max(MIN_PRUNE_SIZE, 2 * len(self.redeemed))
+            self.redeemed[claims["id"]] = now + self.lifetime
+        return True
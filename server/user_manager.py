@@ -1,13 +1,47 @@
 # user_manager.py
 
 import threading
-import json
-from cryptography.fernet import Fernet
-from shared.protocol import Protocol
+import time
+from shared.protocol import Frame, DEFAULT_ROOM
+from log import get_logger
+from metrics import USERS_ONLINE, FANOUT_SECONDS, FRAMES_QUEUED
+
+log = get_logger("user_manager")
+
+EVERYONE = None  # Snapshot key of all users
+
+
+class Session:
+    """One logged-in user; rooms is a frozenset replaced on every join/leave
+
+    bucket is the user's chat rate limit, created by the server on their
+    first message when limiting is on.
+    """
+    __slots__ = ('username', 'socket', 'public_key', 'symmetric_key', 'rooms', 'bucket')
+    
+    def __init__(self, username, socket, public_key):
+        self.username = username
+        self.socket = socket
+        self.public_key = public_key
+        self.symmetric_key = None
+        self.rooms = frozenset()
+        self.bucket = None
+        
 
 class UserManager:
+    """Logged-in users and room membership
+
+    Writers take the lock. Readers don't: broadcasts iterate an immutable
+    tuple of a room's sessions, rebuilt under the lock by the first read
+    after a join or leave replaced it, so a burst of joins costs one copy
+    and a broadcast never waits for a join.
+    """
+    
     def __init__(self):
-        self.users = {}  # username -> (socket, public_key, symmetric_key)
+        self.users = {}  # username -> Session
+        self.rooms = {}  # room -> set of member usernames
+        self.versions = {}  # room -> roster version, bumped on every join/leave
+        self.snapshots = {}  # room (or EVERYONE) -> tuple of Sessions, dropped when membership changes
         self.lock = threading.Lock()
         
     def add_user(self, username, socket, public_key):
@@ -16,84 +50,210 @@ class UserManager:
             if username in self.users:
                 return False
                 
-            self.users[username] = {
-                'socket': socket,
-                'public_key': public_key,
-                'symmetric_key': None
-            }
+            self.users[username] = Session(username, socket, public_key)
+            self.snapshots.pop(EVERYONE, None)
+            USERS_ONLINE.inc()
             return True
             
     def remove_user(self, username):
-        """Remove a user from the manager"""
+        """Remove a user from the manager, returning {room: new roster version} for the rooms they were in"""
         with self.lock:
-            if username in self.users:
+            session = self.users.pop(username, None)
+            if session is None:
+                return {}
+            self.snapshots.pop(EVERYONE, None)
+            USERS_ONLINE.dec()
+            return {room: self._discard_member(room, username) for room in sorted(session.rooms)}
+            
+    def remove_sessions(self, sessions):
+        """Remove many users under one lock, returning {room: usernames that left it}
+
+        sessions are (username, socket) pairs; a user who has since logged
+        in again on another socket is left alone.
+        """
+        departed = {}
+        with self.lock:
+            for username, socket in sessions:
+                session = self.users.get(username)
+                if session is None or session.socket is not socket:
+                    continue
                 del self.users[username]
-                return True
-            return False
+                self.snapshots.pop(EVERYONE, None)
+                USERS_ONLINE.dec()
+                for room in session.rooms:
+                    self._discard_member(room, username)
+                    departed.setdefault(room, []).append(username)
+        return departed
+        
+    def join_room(self, username, room):
+        """Add a user to a room, returning the new roster version; 0 if unknown or already a member"""
+        with self.lock:
+            session = self.users.get(username)
+            if session is None or room in session.rooms:
+                return 0
+            session.rooms = session.rooms | {room}
+            self.rooms.setdefault(room, set()).add(username)
+            self.snapshots.pop(room, None)
+            return self._bump_version(room)
             
-    def get_user(self, username):
-        """Get user information"""
+    def leave_room(self, username, room):
+        """Remove a user from a room, returning the new roster version; 0 if they were not in it"""
+        with self.lock:
+            session = self.users.get(username)
+            if session is None or room not in session.rooms:
+                return 0
+            session.rooms = session.rooms - {room}
+            return self._discard_member(room, username)
+            
+    def is_member(self, username, room):
+        """Check whether a user is in a room"""
+        session = self.users.get(username)
+        return session is not None and room in session.rooms
+            
+    def get_room_members(self, room):
+        """Get the usernames in a room"""
+        return [session.username for session in self.snapshot(room)]
+        
+    def snapshot(self, room=EVERYONE):
+        """Immutable tuple of the Sessions in a room, or of everyone; safe to iterate without the lock"""
+        sessions = self.snapshots.get(room)
+        if sessions is None:
+            with self.lock:
+                sessions = self.snapshots.get(room)
+                if sessions is None:
+                    if room is EVERYONE:
+                        sessions = tuple(self.users.values())
+                    elif room not in self.rooms:
+                        return ()  # Not cached: nothing would ever evict an empty room's entry
+                    else:
+                        sessions = tuple(self.users[username] for username in self.rooms[room])
+                    self.snapshots[room] = sessions
+        return sessions
+            
+    def get_room_names(self):
+        """Get all rooms that currently have members"""
         with self.lock:
-            return self.users.get(username)
+            return list(self.rooms.keys())
+            
+    def get_roster(self, room):
+        """Get a room's roster version and members as one consistent snapshot"""
+        with self.lock:
+            return self.versions.get(room, 0), sorted(self.rooms.get(room, ()))
+            
+    def _discard_member(self, room, username):
+        # Caller holds the lock; empty rooms are forgotten
+        self.snapshots.pop(room, None)
+        version = self._bump_version(room)
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(username)
+            if not members:
+                del self.rooms[room]
+                del self.versions[room]
+        return version
+        
+    def _bump_version(self, room):
+        # Caller holds the lock
+        version = self.versions.get(room, 0) + 1
+        self.versions[room] = version
+        return version
+            
+    def get_user(self, username):
+        """Get a user's Session, or None"""
+        return self.users.get(username)
             
     def get_all_users(self):
         """Get all usernames"""
-        with self.lock:
-            return list(self.users.keys())
+        return [session.username for session in self.snapshot()]
             
     def set_symmetric_key(self, username, symmetric_key):
         """Set symmetric key for a user"""
-        with self.lock:
-            if username in self.users:
-                self.users[username]['symmetric_key'] = symmetric_key
-                return True
+        session = self.users.get(username)
+        if session is None:
             return False
+        session.symmetric_key = symmetric_key
+        return True
             
-    def broadcast(self, message, exclude_user=None):
-        """Broadcast message to all users"""
-        with self.lock:
-            disconnected_users = []
-            for username, user_info in self.users.items():
-                if username == exclude_user:
-                    continue
-                    
-                try:
-                    # Ensure message ends with newline
-                    if not message.endswith('\n'):
-                        message_to_send = message + '\n'
-                    else:
-                        message_to_send = message
-                    user_info['socket'].sendall(message_to_send.encode())
-                    print(f"Broadcasted to {username}")
-                except Exception as e:
-                    print(f"Failed to send to {username}: {e}")
-                    disconnected_users.append(username)
-                    
-            # Remove disconnected users
-            for username in disconnected_users:
-                del self.users[username]
+    def broadcast(self, message, exclude_user=None, room=None):
+        """Broadcast message to all users, or only to the members of a room
+
+        Returns the users whose queue rejected the frame. Their connections
+        are already shutting down, and the normal disconnect path removes them.
+        """
+        frame = message if isinstance(message, Frame) else Frame.from_text(message)
+        started = time.perf_counter()
+        
+        # Sockets only enqueue, but a BLOCK policy may still wait, so send
+        # from a snapshot without holding the lock
+        recipients = self.snapshot(room)
+            
+        disconnected_users = []
+        sent = 0
+        for session in recipients:
+            if session.username == exclude_user:
+                continue
+            try:
+                session.socket.send_frame(frame)
+                sent += 1
+            except Exception as e:
+                log.warning("Failed to send to %s: %s", session.username, e)
+                disconnected_users.append(session.username)
                 
-            return disconnected_users
+        FRAMES_QUEUED.inc(sent)
+        FANOUT_SECONDS.observe(time.perf_counter() - started)
+        return disconnected_users
             
     def send_to_user(self, username, message):
         """Send message to specific user"""
-        user_info = self.get_user(username)
-        if user_info:
+        frame = message if isinstance(message, Frame) else Frame.from_text(message)
+        session = self.get_user(username)
+        if session:
             try:
-                if not message.endswith('\n'):
-                    message += '\n'
-                user_info['socket'].sendall(message.encode())
+                session.socket.send_frame(frame)
                 return True
             except Exception as e:
-                print(f"Failed to send to {username}: {e}")
-                self.remove_user(username)
+                log.warning("Failed to send to %s: %s", username, e)
         return False
         
-    def broadcast_user_list(self):
-        """Broadcast updated user list to all users"""
-        user_list = self.get_all_users()
-        user_list_msg = json.dumps({
+    def send_user_list(self, username, room=DEFAULT_ROOM):
+        """Send one user a full snapshot of a room's roster"""
+        version, members = self.get_roster(room)
+        user_list = {
             "type": "user_list",
-            "users": user_list
-        })
-        self.broadcast(user_list_msg)
\ No newline at end of file
+            "users": members,
+            "version": version
+        }
+        if room != DEFAULT_ROOM:
+            user_list["room"] = room
+        return self.send_to_user(username, Frame(user_list))
+        
+    def broadcast_presence(self, msg_type, username, room, version):
+        """Tell a room's other members that username joined or left
+
+        Sent instead of the whole roster; receivers apply it on top of the
+        snapshot they hold and ask for a new one if they see a version gap.
+        """
+        self.broadcast(self.presence_frame(msg_type, username, room, version), exclude_user=username, room=room)
+        
+    def broadcast_departures(self, room, usernames):
+        """Tell a room's remaining members that several users left, in one roster snapshot"""
+        version, members = self.get_roster(room)
+        user_list = {
+            "type": "user_list",
+            "users": members,
+            "version": version
+        }
+        if room != DEFAULT_ROOM:
+            user_list["room"] = room
+        self.broadcast(Frame(user_list), room=room)
+        
+    def presence_frame(self, msg_type, username, room, version):
+        """Build a user_joined/user_left frame"""
+        presence = {
+            "type": msg_type,
+            "username": username,
+            "version": version
+        }
+        if room != DEFAULT_ROOM:
+            presence["room"] = room
+        return Frame(presence)
\ No newline at end of file
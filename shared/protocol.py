@@ -4,12 +4,197 @@
 Shared protocol definitions for client-server communication
 """
 
+import base64
+import json
+import struct
+
 # Message types
 HANDSHAKE = "handshake"
 KEY_EXCHANGE = "key_exchange"
 MESSAGE = "message"
 USER_LIST = "user_list"
 SYSTEM = "system"
+AUTH_ERROR = "auth_error"
+JOIN_ROOM = "join_room"
+LEAVE_ROOM = "leave_room"
+USER_JOINED = "user_joined"
+USER_LEFT = "user_left"
+USER_LIST_REQUEST = "user_list_request"
+PING = "ping"
+PONG = "pong"
+
+# Rooms. Every user starts in DEFAULT_ROOM; messages, key exchanges and
+# user lists without a "room" field belong to it.
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME_LENGTH = 64
+
+# Wire formats, in order of preference. The handshake is always a JSON
+# line; the client lists the formats it speaks and the server's welcome
+# message names the one both sides use from the next frame on.
+WIRE_BINARY = "binary"
+WIRE_JSON = "json"
+WIRE_FORMATS = (WIRE_BINARY, WIRE_JSON)
+
+# Cipher suites for chat payloads, in order of preference. The client lists
+# the suites it supports in the handshake, the server names the one to
+# send with in key_exchange, and each chat message carries its "suite"
+# (absent means Fernet) so receivers can decrypt whatever the room relays.
+SUITE_AES_GCM = "aes-256-gcm"
+SUITE_CHACHA20 = "chacha20-poly1305"
+SUITE_FERNET = "fernet"
+CIPHER_SUITES = (SUITE_AES_GCM, SUITE_CHACHA20, SUITE_FERNET)
+
+# Optional compression of chat plaintext before encryption, in order of
+# preference. A client that opts in lists what it can produce in the
+# handshake, the welcome message names the one to send with, and each
+# compressed message carries its "compression" so receivers can undo it.
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSIONS = (COMPRESSION_ZSTD, COMPRESSION_ZLIB)
+
+# Binary frame layout:
+#   u32 body length | u8 type code | u32 meta length | meta | payload
+# where body = meta + payload, meta is a JSON object with the remaining
+# fields and payload carries the raw bytes of the type's payload field
+# (the ciphertext of a chat message) without any base64 wrapping.
+BINARY_HEADER = struct.Struct('!IBI')
+TYPE_CODES = {
+    HANDSHAKE: 1,
+    KEY_EXCHANGE: 2,
+    MESSAGE: 3,
+    USER_LIST: 4,
+    SYSTEM: 5,
+    AUTH_ERROR: 6,
+    JOIN_ROOM: 7,
+    LEAVE_ROOM: 8,
+    USER_JOINED: 9,
+    USER_LEFT: 10,
+    USER_LIST_REQUEST: 11,
+    PING: 12,
+    PONG: 13,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+GENERIC_TYPE_CODE = 0  # Unknown types keep their "type" inside the meta
+PAYLOAD_FIELDS = {MESSAGE: "message"}
+
+
+class ProtocolError(ValueError):
+    """Raised for frames that cannot be decoded"""
+
+
+class Frame:
+    """Immutable wire frame, serialized and encoded once per event
+
+    Broadcasting a Frame hands the same bytes object to every recipient
+    queue instead of re-encoding the message per user. Each wire format is
+    encoded lazily the first time a recipient needs it and then cached.
+    """
+    __slots__ = ('type', 'message', '_encoded')
+    
+    def __init__(self, message):
+        object.__setattr__(self, 'type', message.get("type"))
+        object.__setattr__(self, 'message', message)
+        object.__setattr__(self, '_encoded', {})
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("Frame is immutable")
+        
+    @classmethod
+    def from_text(cls, text):
+        """Wrap an already serialized JSON line"""
+        return cls(json.loads(text))
+        
+    @classmethod
+    def from_binary(cls, record):
+        """Wrap a received binary frame, reusing its bytes for binary recipients"""
+        frame = cls(decode_binary(record))
+        frame._encoded[WIRE_BINARY] = bytes(record)
+        return frame
+        
+    def encode(self, wire=WIRE_JSON):
+        """Return the frame's bytes in the given wire format"""
+        data = self._encoded.get(wire)
+        if data is None:
+            if wire == WIRE_BINARY:
+                data = encode_binary(self.message)
+            else:
+                data = encode_json(self.message)
+            self._encoded[wire] = data
+        return data
+        
+    @property
+    def data(self):
+        """The JSON-lines encoding"""
+        return self.encode(WIRE_JSON)
+        
+    def __len__(self):
+        return len(self.data)
+
+
+def encode_json(message):
+    """Encode a message as one JSON line, base64-wrapping raw payloads"""
+    field = PAYLOAD_FIELDS.get(message.get("type"))
+    if field and isinstance(message.get(field), (bytes, bytearray, memoryview)):
+        message = dict(message)
+        message[field] = base64.b64encode(message[field]).decode()
+    return (json.dumps(message) + '\n').encode()
+
+
+def encode_binary(message):
+    """Encode a message as a length-prefixed binary frame"""
+    msg_type = message.get("type")
+    code = TYPE_CODES.get(msg_type, GENERIC_TYPE_CODE)
+    meta = dict(message)
+    if code != GENERIC_TYPE_CODE:
+        del meta["type"]
+        
+    payload = b""
+    field = PAYLOAD_FIELDS.get(msg_type)
+    if field and field in meta:
+        payload = meta.pop(field)
+        if isinstance(payload, str):
+            # JSON senders deliver ciphertext base64 wrapped and plain text as str
+            payload = base64.b64decode(payload) if meta.get("encrypted") else payload.encode()
+            
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode() if meta else b""
+    try:
+        header = BINARY_HEADER.pack(len(meta_bytes) + len(payload), code, len(meta_bytes))
+    except struct.error:
+        raise ProtocolError(f"{msg_type} frame of {len(meta_bytes) + len(payload)} bytes is too large to encode")
+    return b"".join((header, meta_bytes, payload))
+
+
+def decode_binary(record):
+    """Decode one complete binary frame (header included) into a message dict"""
+    if len(record) < BINARY_HEADER.size:
+        raise ProtocolError("Truncated frame header")
+    body_length, code, meta_length = BINARY_HEADER.unpack_from(record)
+    body = memoryview(record)[BINARY_HEADER.size:]
+    if len(body) != body_length or meta_length > body_length:
+        raise ProtocolError("Frame length mismatch")
+        
+    message = json.loads(bytes(body[:meta_length])) if meta_length else {}
+    if code != GENERIC_TYPE_CODE:
+        if code not in TYPE_NAMES:
+            raise ProtocolError(f"Unknown frame type {code}")
+        message["type"] = TYPE_NAMES[code]
+        
+    field = PAYLOAD_FIELDS.get(message.get("type"))
+    if field:
+        payload = bytes(body[meta_length:])
+        message[field] = payload if message.get("encrypted") else payload.decode('utf-8', errors='replace')
+    return message
+
+
+def iter_frames(data):
+    """Yield each frame of a run of concatenated binary frames"""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        size = BINARY_HEADER.size + BINARY_HEADER.unpack_from(view, offset)[0]
+        yield view[offset:offset + size]
+        offset += size
+
 
 class Protocol:
     @staticmethod
@@ -37,15 +222,90 @@ class Protocol:
         }
     
     @staticmethod
-    def create_user_list(users):
-        return {
+    def create_user_list(users, version=None):
+        user_list = {
             "type": USER_LIST,
             "users": users
         }
+        if version is not None:
+            user_list["version"] = version
+        return user_list
+    
+    @staticmethod
+    def create_user_list_request(room=DEFAULT_ROOM):
+        request = {"type": USER_LIST_REQUEST}
+        if room != DEFAULT_ROOM:
+            request["room"] = room
+        return request
+    
+    @staticmethod
+    def create_ping():
+        return {"type": PING}
+    
+    @staticmethod
+    def create_pong():
+        return {"type": PONG}
     
     @staticmethod
     def create_system_message(message):
         return {
             "type": SYSTEM,
             "message": message
-        }
\ No newline at end of file
+        }
+        
+    @staticmethod
+    def create_join_room(room):
+        return {
+            "type": JOIN_ROOM,
+            "room": room
+        }
+    
+    @staticmethod
+    def create_leave_room(room):
+        return {
+            "type": LEAVE_ROOM,
+            "room": room
+        }
+        
+    @staticmethod
+    def valid_room(room):
+        """Room names are short non-blank strings"""
+        return isinstance(room, str) and 0 < len(room) <= MAX_ROOM_NAME_LENGTH and room.strip() == room
+        
+    @staticmethod
+    def choose_wire(offered, supported=WIRE_FORMATS):
+        """Pick the first wire format offered by the client that we support"""
+        for wire in offered or ():
+            if wire in supported:
+                return wire
+        return WIRE_JSON
+        
+    @staticmethod
+    def choose_suite(offered, supported=CIPHER_SUITES):
+        """Pick the first cipher suite offered by the client that we allow"""
+        for suite in offered or ():
+            if suite in supported:
+                return suite
+        return SUITE_FERNET
+        
+    @staticmethod
+    def choose_compression(offered, supported=COMPRESSIONS):
+        """Pick the first compression offered by the client that we allow, or None"""
+        for compression in offered or ():
+            if compression in supported:
+                return compression
+        return None
+        
+    @staticmethod
+    def decode(record, wire=WIRE_JSON):
+        """Decode one frame from a FrameReader into a message dict
+
+        Binary frames are far below 16 MiB, so their first byte is always
+        zero; a nonzero first byte in binary mode is a JSON line the peer
+        sent before it saw the switch.
+        """
+        if wire == WIRE_BINARY and record[:1] == b'\x00':
+            return decode_binary(record)
+        if isinstance(record, memoryview):
+            record = record.tobytes()
+        return json.loads(record)
\ No newline at end of file
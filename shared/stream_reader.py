@@ -0,0 +1,141 @@
+# stream_reader.py
+
+"""
+Incremental frame reader shared by the server and client receive loops
+"""
+
+from shared.protocol import BINARY_HEADER, WIRE_BINARY, WIRE_JSON, ProtocolError
+
+DEFAULT_MAX_FRAME_SIZE = 4 * 1024 * 1024
+INITIAL_BUFFER_SIZE = 4096
+MIN_READ_SIZE = 1024
+
+# Binary frames rely on the top byte of the length prefix being zero
+MAX_FRAME_LIMIT = 1 << 24
+
+
+class FrameTooLarge(ProtocolError):
+    """Raised when a peer sends a frame above the reader's limit"""
+
+
+class FrameReader:
+    """Reassemble frames from a byte stream in linear time
+
+    Data is received straight into one reusable bytearray, allocated on
+    the first read. Bytes passed to feed() while nothing is pending are
+    parsed where they are, so an idle connection holds no buffer of its
+    own and only a frame split across reads is copied. Consumed bytes
+    are only tracked by an offset, newline scanning resumes where the last
+    scan stopped, and the buffer grows geometrically, so both one huge frame
+    arriving in small reads and a burst of many small frames cost O(n).
+
+    frames() yields memoryviews into the buffer. They are only valid until
+    the next recv_into()/feed(); decode or copy them before reading again.
+    """
+
+    def __init__(self, wire=WIRE_JSON, max_frame_size=DEFAULT_MAX_FRAME_SIZE, initial_size=INITIAL_BUFFER_SIZE):
+        if max_frame_size >= MAX_FRAME_LIMIT:
+            raise ValueError(f"max_frame_size must be below {MAX_FRAME_LIMIT}")
+        self.wire = wire
+        self.max_frame_size = max_frame_size
+        self.initial_size = initial_size
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        self.start = 0     # First byte not yet handed out as a frame
+        self.end = 0       # End of received data
+        self.scanned = 0   # Newline search resumes here
+        self.wanted = 0    # Full size of a partially received binary frame
+
+    def recv_into(self, sock):
+        """Receive from a socket straight into the buffer; returns 0 on EOF"""
+        self._make_room(MIN_READ_SIZE)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """Append data obtained elsewhere, e.g. from an asyncio StreamReader"""
+        if self.start == self.end and isinstance(data, bytes):
+            self.buffer = data
+            self.view = memoryview(data)
+            self.start = self.scanned = self.wanted = 0
+            self.end = len(data)
+            return
+        self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """Yield every complete frame currently buffered"""
+        while self.start < self.end:
+            if self.wire == WIRE_BINARY and self.buffer[self.start] == 0:
+                frame = self._next_binary()
+            else:
+                frame = self._next_line()
+            if frame is None:
+                break
+            if len(frame):
+                yield frame
+
+    def _next_binary(self):
+        available = self.end - self.start
+        if available < BINARY_HEADER.size:
+            return None
+        size = BINARY_HEADER.size + BINARY_HEADER.unpack_from(self.buffer, self.start)[0]
+        if size > self.max_frame_size:
+            raise FrameTooLarge(f"Frame of {size} bytes exceeds {self.max_frame_size}")
+        if available < size:
+            self.wanted = size
+            return None
+        frame = self.view[self.start:self.start + size]
+        self.start += size
+        self.scanned = self.start
+        self.wanted = 0
+        return frame
+
+    def _next_line(self):
+        newline = self.buffer.find(b'\n', max(self.scanned, self.start), self.end)
+        if newline < 0:
+            self.scanned = self.end
+            if self.end - self.start > self.max_frame_size:
+                raise FrameTooLarge(f"Line exceeds {self.max_frame_size} bytes")
+            return None
+        if newline - self.start > self.max_frame_size:
+            # The whole line can arrive in one read, before the check above sees it
+            raise FrameTooLarge(f"Line exceeds {self.max_frame_size} bytes")
+        frame = self.view[self.start:newline]
+        self.start = newline + 1
+        self.scanned = self.start
+        return frame
+
+    def _make_room(self, min_free):
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > self.initial_size * 16 and min_free <= self.initial_size:
+                # Give back the space a one-off large frame needed
+                self.buffer = bytearray(self.initial_size)
+                self.view = memoryview(self.buffer)
+        min_free = max(min_free, self.wanted - pending)
+        writable = isinstance(self.buffer, bytearray)
+        if writable and len(self.buffer) - self.end >= min_free:
+            return
+
+        needed = pending + min_free
+        scanned = self.scanned - self.start
+        if writable and needed <= len(self.buffer) and self.start >= pending:
+            # Slide the partial frame to the front; same-size slice
+            # assignment never resizes, so outstanding views stay legal
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            # Grow into a fresh buffer (or leave fed bytes); old views keep the old one alive
+            capacity = self.initial_size
+            while capacity < needed:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+        self.scanned = scanned
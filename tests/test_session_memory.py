@@ -0,0 +1,26 @@
+# test_session_memory.py
+
+"""
+Server RSS growth per idle session stays within bench/session_memory.py's budget
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'bench')))
+
+from session_memory import run, DEFAULT_BUDGET_KIB
+from loadgen import process_usage
+
+# Enough sessions that RSS page granularity is small next to the budget,
+# few enough to connect in seconds
+SESSIONS = 500
+
+
+@pytest.mark.skipif(process_usage(os.getpid()) is None, reason="RSS is read from /proc")
+def test_idle_sessions_within_budget():
+    results = run(SESSIONS, engine="asyncio")
+    assert results["sessions"] == SESSIONS
+    assert results["kib_per_session"] <= DEFAULT_BUDGET_KIB, results